@@ -0,0 +1,899 @@
+#! /usr/bin/env python3
+
+# local stand-in for github rest and graphql api, used by benchmarks
+#
+# serves subset of api used by rgh.py: graphql queries for issues, prs and
+# search, rest endpoints for issues, pulls, labels, org members, workflow
+# runs and rate limit; responses have etags, so conditional requests get
+# 304, and x-ratelimit headers, so that rate limit handling can be tested
+#
+# state is generated from fixed seed and can be changed via test hooks:
+#   POST /_update {"repo": ..., "pr": N, "fields": {...}}  - modify pr
+#   GET  /_stats                                          - request counters
+#   POST /_reset                                          - clear counters
+#
+# examples:
+#   fakegh.py --port 8765 --latency 0.05
+#   fakegh.py --limit 100 --window 10 --secondary 4
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+# graphql subset: queries, variables, aliases, arguments,
+# named and inline fragments
+
+TOKEN_RX = re.compile(r'''
+    (?P<ws>[\s,]+|\#[^\n]*)
+  | (?P<spread>\.\.\.)
+  | (?P<punct>[{}()\[\]:!$=@])
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<name>[_A-Za-z][_0-9A-Za-z]*)
+''', re.X)
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = TOKEN_RX.match(text, pos)
+        if not m:
+            raise ValueError(f'unexpected character at {pos}: {text[pos:pos+20]!r}')
+        pos = m.end()
+        if m.lastgroup != 'ws':
+            tokens.append((m.lastgroup, m.group()))
+    return tokens
+
+class Parser:
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, value=None):
+        if self.pos >= len(self.tokens):
+            return None
+        tok = self.tokens[self.pos]
+        if value is not None and tok[1] != value:
+            return None
+        return tok
+
+    def take(self, value=None):
+        tok = self.peek()
+        if tok is None or (value is not None and tok[1] != value):
+            raise ValueError(f'expected {value!r}, got {tok!r}')
+        self.pos += 1
+        return tok[1]
+
+    def document(self):
+        operation, fragments = None, {}
+        while self.peek():
+            if self.peek('fragment'):
+                self.take()
+                name = self.take()
+                self.take('on')
+                type_name = self.take()
+                fragments[name] = (type_name, self.selection_set())
+            else:
+                if self.peek('query'):
+                    self.take()
+                    if not self.peek('(') and not self.peek('{'):
+                        self.take()
+                    if self.peek('('):
+                        self.variable_definitions()
+                operation = self.selection_set()
+        return operation, fragments
+
+    def variable_definitions(self):
+        self.take('(')
+        while not self.peek(')'):
+            self.take('$')
+            self.take()
+            self.take(':')
+            self.type_ref()
+            if self.peek('='):
+                self.take()
+                self.value()
+        self.take(')')
+
+    def type_ref(self):
+        if self.peek('['):
+            self.take()
+            self.type_ref()
+            self.take(']')
+        else:
+            self.take()
+        if self.peek('!'):
+            self.take()
+
+    def selection_set(self):
+        self.take('{')
+        selections = []
+        while not self.peek('}'):
+            selections.append(self.selection())
+        self.take('}')
+        return selections
+
+    def selection(self):
+        if self.peek('...'):
+            self.take()
+            if self.peek('on'):
+                self.take()
+                type_name = self.take()
+                return ('inline', type_name, self.selection_set())
+            return ('spread', self.take())
+        name = self.take()
+        alias = name
+        if self.peek(':'):
+            self.take()
+            name = self.take()
+        args = {}
+        if self.peek('('):
+            self.take()
+            while not self.peek(')'):
+                arg = self.take()
+                self.take(':')
+                args[arg] = self.value()
+            self.take(')')
+        children = None
+        if self.peek('{'):
+            children = self.selection_set()
+        return ('field', alias, name, args, children)
+
+    def value(self):
+        kind, text = self.tokens[self.pos]
+        self.pos += 1
+        if text == '$':
+            return ('var', self.take())
+        if kind == 'string':
+            return ('const', json.loads(text))
+        if kind == 'number':
+            return ('const', float(text) if '.' in text else int(text))
+        if text == '[':
+            items = []
+            while not self.peek(']'):
+                items.append(self.value())
+            self.take(']')
+            return ('list', items)
+        if text == '{':
+            items = {}
+            while not self.peek('}'):
+                key = self.take()
+                self.take(':')
+                items[key] = self.value()
+            self.take('}')
+            return ('object', items)
+        return ('const', {'true': True, 'false': False, 'null': None}.get(text, text))
+
+def eval_value(value, variables):
+    kind = value[0]
+    if kind == 'var':
+        return variables.get(value[1])
+    if kind == 'list':
+        return [eval_value(v, variables) for v in value[1]]
+    if kind == 'object':
+        return {k: eval_value(v, variables) for k, v in value[1].items()}
+    return value[1]
+
+class GraphqlError(Exception):
+    pass
+
+# resolve selections against object graph: dicts with '__typename' key,
+# whose values are plain values, nested objects, or callables(args)
+def execute(obj, selections, fragments, variables, errors=None):
+    if errors is None:
+        errors = []
+    if obj is None:
+        return None
+    if isinstance(obj, list):
+        return [execute(o, selections, fragments, variables, errors) for o in obj]
+
+    result = {}
+    for sel in selections:
+        if sel[0] == 'spread':
+            type_name, children = fragments[sel[1]]
+            if matches_type(obj, type_name):
+                result.update(execute(obj, children, fragments, variables, errors))
+        elif sel[0] == 'inline':
+            if matches_type(obj, sel[1]):
+                result.update(execute(obj, sel[2], fragments, variables, errors))
+        else:
+            _, alias, name, args, children = sel
+            if name == '__typename':
+                result[alias] = obj['__typename']
+                continue
+            if name not in obj:
+                raise GraphqlError(
+                    f"Field '{name}' doesn't exist on type '{obj['__typename']}'")
+            value = obj[name]
+            try:
+                if callable(value):
+                    value = value({k: eval_value(v, variables) for k, v in args.items()})
+                if children is not None:
+                    value = execute(value, children, fragments, variables, errors)
+            except GraphqlError as e:
+                # like github, report error and return null for failed field
+                errors.append({'message': str(e), 'type': 'NOT_FOUND', 'path': [alias]})
+                value = None
+            result[alias] = value
+    return result
+
+def matches_type(obj, type_name):
+    return obj['__typename'] == type_name or type_name in obj.get('__implements', ())
+
+def connection(items):
+    def resolve(args):
+        start, end = 0, len(items)
+        if args.get('after'):
+            start = int(args['after'])
+        if args.get('first') is not None:
+            end = min(end, start + args['first'])
+        if args.get('last') is not None:
+            start = max(start, end - args['last'])
+        page = items[start:end]
+        return {
+            '__typename': 'Connection',
+            'nodes': page,
+            'edges': [{'__typename': 'Edge', 'node': n, 'cursor': str(start + i + 1)}
+                      for i, n in enumerate(page)],
+            'totalCount': len(items),
+            'issueCount': len(items),
+            'pageInfo': {
+                '__typename': 'PageInfo',
+                'hasNextPage': end < len(items),
+                'endCursor': str(end),
+            },
+        }
+    return resolve
+
+# fake github state
+
+def iso(ts):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+
+class State:
+    def __init__(self, org='roc-streaming', repos=('roc-toolkit',), n_prs=20, n_issues=20,
+                 remote=None, seed=1):
+        rnd = random.Random(seed)
+        self.lock = threading.RLock()
+        self.org = org
+        self.members = {'gavv', 'maintainer'}
+        self.repos = {}
+        self.remote = remote
+        base_time = 1700000000
+        users = ['gavv', 'maintainer', 'alice', 'bob', 'carol', 'dave']
+        for repo in repos:
+            r = {'name': repo, 'prs': {}, 'issues': {}, 'labels': {}}
+            for i in range(1, n_issues + 1):
+                r['issues'][i] = {
+                    'number': i,
+                    'title': f'Issue {i}',
+                    'body': f'Issue body {i}',
+                    'state': 'open' if i % 3 else 'closed',
+                    'author': rnd.choice(users),
+                    'milestone': f'v0.{i % 4}' if i % 2 else None,
+                    'labels': sorted(rnd.sample(['bug', 'help wanted', 'C-api', 'S-stalled'], 2)),
+                    'created_at': base_time + i * 3600,
+                    'updated_at': base_time + i * 3600,
+                }
+            for j in range(1, n_prs + 1):
+                n = n_issues + j
+                author = users[j % len(users)]
+                r['prs'][n] = {
+                    'number': n,
+                    'title': f'Pull request {n}',
+                    'body': f'Fixes #{(j % n_issues) + 1}' if j % 4 else 'No link here',
+                    'state': 'open' if j % 5 else 'closed',
+                    'draft': j % 7 == 0,
+                    'author': author,
+                    'created_at': base_time + (n_issues + j) * 3600,
+                    'updated_at': base_time + (n_issues + j) * 3600,
+                    'milestone': 'v0.1' if j % 2 else None,
+                    'labels': ['S-ready-for-review'] if j % 2 else ['S-work-in-progress'],
+                    'head_ref': f'feature-{n}',
+                    'head_sha': hashlib.sha1(f'{repo}-{n}'.encode()).hexdigest(),
+                    'base_ref': 'main',
+                    'mergeable': True,
+                    'rebaseable': True,
+                    'reviews': [
+                        {'author': 'gavv', 'state': 'COMMENTED'},
+                        {'author': 'gavv', 'state': 'APPROVED' if j % 3 else 'CHANGES_REQUESTED'},
+                    ],
+                    'review_requests': ['gavv'] if j % 2 else [],
+                    'commits': [
+                        {'sha': hashlib.sha1(f'{repo}-{n}-{k}'.encode()).hexdigest(),
+                         'message': f'Commit {k} of pr {n}',
+                         'author': author.capitalize(),
+                         'email': f'{author}@example.com'}
+                        for k in range(1, 4)
+                    ],
+                    'checks': [
+                        {'workflow': 'build', 'name': 'linux', 'status': 'completed',
+                         'conclusion': 'success'},
+                        {'workflow': 'build', 'name': 'macos', 'status': 'completed',
+                         'conclusion': 'success'},
+                    ],
+                }
+            r['labels'] = {
+                'bug': {'color': 'd73a4a', 'description': "Something isn't working"},
+                'help wanted': {'color': '9fe84c', 'description': 'Looking for contributors'},
+            }
+            self.repos[repo] = r
+
+    def repo(self, org, name):
+        if org != self.org or name not in self.repos:
+            return None
+        return self.repos[name]
+
+    def ssh_url(self, repo):
+        if self.remote:
+            return self.remote
+        return f'git@github.com:{self.org}/{repo}.git'
+
+    def association(self, login):
+        if login in self.members:
+            return 'MEMBER'
+        return 'CONTRIBUTOR'
+
+    # rest representations
+
+    def rest_user(self, login):
+        return {'login': login, 'type': 'User'}
+
+    def rest_labels(self, names, repo):
+        return [{'name': n, 'color': repo['labels'].get(n, {}).get('color', 'ededed'),
+                 'description': repo['labels'].get(n, {}).get('description', '')}
+                for n in names]
+
+    def rest_issue(self, repo, issue):
+        return {
+            'number': issue['number'],
+            'title': issue['title'],
+            'body': issue['body'],
+            'state': issue['state'],
+            'html_url': f"https://github.com/{self.org}/{repo['name']}/issues/{issue['number']}",
+            'user': self.rest_user(issue['author']),
+            'milestone': {'title': issue['milestone']} if issue['milestone'] else None,
+            'labels': self.rest_labels(issue['labels'], repo),
+            'updated_at': iso(issue['updated_at']),
+        }
+
+    def rest_pr(self, repo, pr):
+        return {
+            'number': pr['number'],
+            'title': pr['title'],
+            'body': pr['body'],
+            'state': pr['state'],
+            'draft': pr['draft'],
+            'html_url': f"https://github.com/{self.org}/{repo['name']}/pull/{pr['number']}",
+            'user': self.rest_user(pr['author']),
+            'milestone': {'title': pr['milestone']} if pr['milestone'] else None,
+            'labels': self.rest_labels(pr['labels'], repo),
+            'mergeable': pr['mergeable'],
+            'rebaseable': pr['rebaseable'],
+            'mergeable_state': 'clean' if pr['mergeable'] else 'unknown',
+            'merged': bool(pr.get('merged')),
+            'head': {'ref': pr['head_ref'], 'sha': pr['head_sha'],
+                     'repo': {'ssh_url': self.ssh_url(repo['name'])}},
+            'base': {'ref': pr['base_ref'],
+                     'repo': {'ssh_url': self.ssh_url(repo['name'])}},
+            'author_association': self.association(pr['author']),
+            'updated_at': iso(pr['updated_at']),
+        }
+
+    # graphql representations
+
+    def gql_actor(self, login):
+        return {'__typename': 'User', 'login': login}
+
+    def gql_labels(self, names):
+        return connection([{'__typename': 'Label', 'name': n} for n in names])
+
+    def gql_milestone(self, title):
+        return {'__typename': 'Milestone', 'title': title} if title else None
+
+    def gql_repo_ref(self, repo):
+        return {'__typename': 'Repository', 'name': repo['name'],
+                'owner': {'__typename': 'Organization', 'login': self.org},
+                'sshUrl': self.ssh_url(repo['name'])}
+
+    def gql_issue(self, repo, issue):
+        return {
+            '__typename': 'Issue',
+            'number': issue['number'],
+            'title': issue['title'],
+            'body': issue['body'],
+            'state': issue['state'].upper(),
+            'url': f"https://github.com/{self.org}/{repo['name']}/issues/{issue['number']}",
+            'author': self.gql_actor(issue['author']),
+            'milestone': self.gql_milestone(issue['milestone']),
+            'labels': self.gql_labels(issue['labels']),
+            'createdAt': iso(issue['created_at']),
+            'updatedAt': iso(issue['updated_at']),
+            'repository': self.gql_repo_ref(repo),
+        }
+
+    def gql_pr(self, repo, pr):
+        checks = [{
+            '__typename': 'CheckRun',
+            'name': c['name'],
+            'status': c['status'].upper(),
+            'conclusion': (c['conclusion'] or '').upper() or None,
+            'checkSuite': {'__typename': 'CheckSuite', 'workflowRun': {
+                '__typename': 'WorkflowRun',
+                'workflow': {'__typename': 'Workflow', 'name': c['workflow']}}},
+        } for c in pr['checks']]
+        commits = [{
+            '__typename': 'PullRequestCommit',
+            'commit': {
+                '__typename': 'Commit',
+                'oid': c['sha'],
+                'message': c['message'],
+                'messageHeadline': c['message'].split('\n')[0],
+                'authors': connection([{'__typename': 'GitActor',
+                                        'name': c['author'], 'email': c['email']}]),
+                'statusCheckRollup': {'__typename': 'StatusCheckRollup',
+                                      'state': 'SUCCESS',
+                                      'contexts': connection(checks)},
+            },
+        } for c in pr['commits']]
+        if pr['mergeable'] is None:
+            mergeable = 'UNKNOWN'
+        else:
+            mergeable = 'MERGEABLE' if pr['mergeable'] else 'CONFLICTING'
+        state = pr['state'].upper()
+        if pr.get('merged'):
+            state = 'MERGED'
+        return {
+            '__typename': 'PullRequest',
+            'number': pr['number'],
+            'title': pr['title'],
+            'body': pr['body'],
+            'url': f"https://github.com/{self.org}/{repo['name']}/pull/{pr['number']}",
+            'state': state,
+            'isDraft': pr['draft'],
+            'createdAt': iso(pr['created_at']),
+            'updatedAt': iso(pr['updated_at']),
+            'mergeable': mergeable,
+            'canBeRebased': bool(pr['rebaseable']),
+            'mergeStateStatus': 'CLEAN' if pr['mergeable'] else 'UNKNOWN',
+            'author': self.gql_actor(pr['author']),
+            'authorAssociation': self.association(pr['author']),
+            'headRefName': pr['head_ref'],
+            'headRefOid': pr['head_sha'],
+            'headRepository': self.gql_repo_ref(repo),
+            'baseRefName': pr['base_ref'],
+            'baseRepository': self.gql_repo_ref(repo),
+            'milestone': self.gql_milestone(pr['milestone']),
+            'labels': self.gql_labels(pr['labels']),
+            'closingIssuesReferences': connection([]),
+            'reviewRequests': connection([{'__typename': 'ReviewRequest'}
+                                          for _ in pr['review_requests']]),
+            'reviews': connection([{
+                '__typename': 'PullRequestReview',
+                'author': self.gql_actor(r['author']),
+                'authorAssociation': self.association(r['author']),
+                'state': r['state'],
+            } for r in pr['reviews']]),
+            'commits': connection(commits),
+            'repository': self.gql_repo_ref(repo),
+        }
+
+    def gql_repo(self, args):
+        repo = self.repo(args.get('owner'), args.get('name'))
+        if repo is None:
+            raise GraphqlError(
+                f"Could not resolve to a Repository with the name "
+                f"'{args.get('owner')}/{args.get('name')}'.")
+
+        def pull_request(a):
+            pr = repo['prs'].get(a['number'])
+            if pr is None:
+                raise GraphqlError(
+                    f"Could not resolve to a PullRequest with the number of {a['number']}.")
+            return self.gql_pr(repo, pr)
+
+        def issue(a):
+            it = repo['issues'].get(a['number'])
+            if it is None:
+                raise GraphqlError(
+                    f"Could not resolve to an Issue with the number of {a['number']}.")
+            return self.gql_issue(repo, it)
+
+        def issue_or_pr(a):
+            if a['number'] in repo['prs']:
+                return self.gql_pr(repo, repo['prs'][a['number']])
+            return issue(a)
+
+        def sort_items(items, a):
+            items = sorted(items, key=lambda x: x['updated_at'])
+            order = a.get('orderBy') or {}
+            if order.get('direction', 'ASC') == 'DESC':
+                items.reverse()
+            return items
+
+        def pull_requests(a):
+            states = a.get('states') or ['OPEN', 'CLOSED', 'MERGED']
+            items = [pr for pr in repo['prs'].values() if pr['state'].upper() in states]
+            return connection([self.gql_pr(repo, pr) for pr in sort_items(items, a)])(a)
+
+        def issues(a):
+            states = a.get('states') or ['OPEN', 'CLOSED']
+            items = [it for it in repo['issues'].values() if it['state'].upper() in states]
+            return connection([self.gql_issue(repo, it) for it in sort_items(items, a)])(a)
+
+        obj = self.gql_repo_ref(repo)
+        obj.update({
+            'pullRequest': pull_request,
+            'issue': issue,
+            'issueOrPullRequest': issue_or_pr,
+            'pullRequests': pull_requests,
+            'issues': issues,
+        })
+        return obj
+
+    def gql_search(self, args):
+        terms = args['query'].split()
+        repo_name, author, created_before, sort_asc = None, None, None, False
+        for term in terms:
+            if term.startswith('repo:'):
+                repo_name = term[5:]
+            elif term.startswith('author:'):
+                author = term[7:]
+            elif term.startswith('created:<'):
+                created_before = term[9:]
+            elif term == 'sort:created-asc':
+                sort_asc = True
+        items = []
+        for repo in self.repos.values():
+            if repo_name and repo_name != f"{self.org}/{repo['name']}":
+                continue
+            for pr in repo['prs'].values():
+                if author and pr['author'] != author:
+                    continue
+                if created_before and iso(pr['created_at']) >= created_before:
+                    continue
+                items.append((repo, pr))
+        items.sort(key=lambda x: x[1]['created_at'], reverse=not sort_asc)
+        return connection([self.gql_pr(repo, pr) for repo, pr in items])(args)
+
+    def graphql(self, query, variables):
+        operation, fragments = Parser(query).document()
+        root = {
+            '__typename': 'Query',
+            'repository': self.gql_repo,
+            'search': self.gql_search,
+            'rateLimit': {'__typename': 'RateLimit', 'cost': 1, 'remaining': 5000},
+        }
+        errors = []
+        with self.lock:
+            data = execute(root, operation, fragments, variables or {}, errors)
+        return data, errors
+
+# http server
+
+class RateLimiter:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.used = {}
+        self.reset = {}
+
+    def status(self, resource):
+        with self.lock:
+            now = time.time()
+            if now >= self.reset.get(resource, 0):
+                self.reset[resource] = int(now + self.window) + 1
+                self.used[resource] = 0
+            return {'limit': self.limit, 'used': self.used[resource],
+                    'remaining': self.limit - self.used[resource],
+                    'reset': self.reset[resource]}
+
+    def consume(self, resource, cost=1):
+        with self.lock:
+            now = time.time()
+            if now >= self.reset.get(resource, 0):
+                self.reset[resource] = int(now + self.window) + 1
+                self.used[resource] = 0
+            exhausted = self.used[resource] + cost > self.limit
+            if not exhausted:
+                self.used[resource] += cost
+            return not exhausted, {
+                'x-ratelimit-limit': str(self.limit),
+                'x-ratelimit-remaining': str(self.limit - self.used[resource]),
+                'x-ratelimit-used': str(self.used[resource]),
+                'x-ratelimit-reset': str(self.reset[resource]),
+                'x-ratelimit-resource': resource,
+            }
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def handle_request(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        if server.prefix and path.startswith(server.prefix):
+            path = path[len(server.prefix):]
+        query = urllib.parse.parse_qs(url.query)
+
+        if not path.startswith('/_'):
+            key = method + ' ' + re.sub(r'/\d+|/[0-9a-f]{40}', '/N', path)
+            with server.stats_lock:
+                server.stats[key] = server.stats.get(key, 0) + 1
+
+        resource = 'graphql' if path == '/graphql' else 'core'
+        if path == '/rate_limit':
+            # doesn't count against limit
+            return self.reply(200, {'resources': {
+                r: server.limiter.status(r) for r in ['core', 'graphql']}}, {})
+        allowed, rl_headers = server.limiter.consume(resource)
+        if not allowed:
+            return self.reply(403, {'message': 'API rate limit exceeded'}, rl_headers)
+
+        with server.stats_lock:
+            server.in_flight += 1
+            too_many = server.secondary and server.in_flight > server.secondary
+            if too_many:
+                server.stats['secondary'] = server.stats.get('secondary', 0) + 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if too_many:
+                return self.reply(403, {
+                    'message': 'You have exceeded a secondary rate limit. Please wait.'},
+                    dict(rl_headers, **{'retry-after': '1'}))
+            return self.handle_routed(method, path, query, body, rl_headers)
+        finally:
+            with server.stats_lock:
+                server.in_flight -= 1
+
+    def handle_routed(self, method, path, query, body, rl_headers):
+        if self.server.latency:
+            time.sleep(self.server.latency * (0.5 + random.random()))
+
+        try:
+            status, payload, headers = self.route(method, path, query, body)
+        except GraphqlError as e:
+            status, payload, headers = 200, {'data': None, 'errors': [{'message': str(e)}]}, {}
+        headers = dict(headers or {})
+        headers.update(rl_headers)
+        self.reply(status, payload, headers)
+
+    def reply(self, status, payload, headers):
+        data = b'' if payload is None else json.dumps(payload).encode()
+        if status == 200 and self.command == 'GET':
+            etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+            headers['etag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status, data = 304, b''
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if data:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self, method, path, query, body):
+        state = self.server.state
+        not_found = (404, {'message': 'Not Found'}, {})
+
+        if path == '/graphql' and method == 'POST':
+            request = json.loads(body)
+            try:
+                data, errors = state.graphql(request['query'], request.get('variables'))
+            except ValueError as e:
+                return 400, {'message': f'Parse error: {e}'}, {}
+            if errors:
+                return 200, {'data': data, 'errors': errors}, {}
+            return 200, {'data': data}, {}
+
+        if path == '/_stats':
+            with self.server.stats_lock:
+                return 200, dict(self.server.stats, max_in_flight=self.server.max_in_flight), {}
+
+        if path == '/_update' and method == 'POST':
+            # test hook: {"repo": "...", "pr": N, "fields": {...}}
+            request = json.loads(body)
+            with state.lock:
+                pr = state.repos[request['repo']]['prs'][request['pr']]
+                pr.update(request['fields'])
+                pr['updated_at'] = time.time()
+            return 200, {}, {}
+
+        if path == '/_reset':
+            with self.server.stats_lock:
+                self.server.stats.clear()
+                self.server.max_in_flight = 0
+            return 200, {}, {}
+
+        m = re.fullmatch(r'/orgs/([^/]+)/members/([^/]+)', path)
+        if m:
+            if m.group(1) == state.org and m.group(2) in state.members:
+                return 204, None, {}
+            return not_found
+
+        m = re.fullmatch(r'/repos/([^/]+)/([^/]+)(/.*)?', path)
+        if not m:
+            return not_found
+        with state.lock:
+            repo = state.repo(m.group(1), m.group(2))
+            if repo is None:
+                return not_found
+            return self.route_repo(method, repo, m.group(3) or '', query, body)
+
+    def route_repo(self, method, repo, path, query, body):
+        state = self.server.state
+        not_found = (404, {'message': 'Not Found'}, {})
+
+        m = re.fullmatch(r'/issues/(\d+)', path)
+        if m:
+            n = int(m.group(1))
+            if method == 'PATCH' and n in repo['issues']:
+                repo['issues'][n].update(json.loads(body))
+            if n in repo['issues']:
+                return 200, state.rest_issue(repo, repo['issues'][n]), {}
+            if n in repo['prs']:
+                return 200, state.rest_issue(repo, repo['prs'][n]), {}
+            return not_found
+
+        m = re.fullmatch(r'/pulls/(\d+)', path)
+        if m:
+            n = int(m.group(1))
+            if n not in repo['prs']:
+                return not_found
+            pr = repo['prs'][n]
+            if method == 'PATCH':
+                for k, v in json.loads(body).items():
+                    pr[k] = v
+                pr['updated_at'] = time.time()
+            return 200, state.rest_pr(repo, pr), {}
+
+        m = re.fullmatch(r'/pulls/(\d+)/merge', path)
+        if m and method == 'PUT':
+            n = int(m.group(1))
+            if n not in repo['prs']:
+                return not_found
+            repo['prs'][n].update({'state': 'closed', 'merged': True, 'updated_at': time.time()})
+            return 200, {'merged': True, 'message': 'Pull Request successfully merged'}, {}
+
+        if path == '/labels':
+            if method == 'POST':
+                label = json.loads(body)
+                repo['labels'][label['name']] = {
+                    'color': label.get('color', 'ededed').lstrip('#'),
+                    'description': label.get('description', '')}
+                return 201, label, {}
+            labels = [{'name': k, 'color': v['color'], 'description': v['description']}
+                      for k, v in sorted(repo['labels'].items())]
+            return self.paginate(labels, query)
+
+        m = re.fullmatch(r'/labels/(.+)', path)
+        if m:
+            name = urllib.parse.unquote(m.group(1))
+            if name not in repo['labels']:
+                return not_found
+            if method == 'PATCH':
+                label = json.loads(body)
+                repo['labels'][name] = {
+                    'color': label.get('color', repo['labels'][name]['color']).lstrip('#'),
+                    'description': label.get('description', repo['labels'][name]['description'])}
+            return 200, {'name': name, **repo['labels'][name]}, {}
+
+        if path == '/actions/runs':
+            sha = (query.get('head_sha') or [None])[0]
+            runs = {}
+            listed_runs = []
+            for pr in repo['prs'].values():
+                if sha and pr['head_sha'] != sha:
+                    continue
+                # runs set explicitly via /_update, e.g. several attempts
+                if pr.get('runs') is not None:
+                    listed_runs += [dict(run, head_sha=pr['head_sha']) for run in pr['runs']]
+                    continue
+                for c in pr['checks']:
+                    run = runs.setdefault(c['workflow'], {
+                        'name': c['workflow'], 'head_sha': pr['head_sha'],
+                        'status': 'completed', 'conclusion': 'success'})
+                    if c['status'] != 'completed':
+                        run['status'], run['conclusion'] = c['status'], None
+                    elif run['status'] == 'completed' and c['conclusion'] != 'success':
+                        run['conclusion'] = c['conclusion']
+            runs = list(runs.values()) + listed_runs
+            return 200, {'total_count': len(runs), 'workflow_runs': runs}, {}
+
+        return not_found
+
+    def paginate(self, items, query):
+        per_page = int((query.get('per_page') or ['30'])[0])
+        page = int((query.get('page') or ['1'])[0])
+        chunk = items[(page - 1) * per_page:page * per_page]
+        headers = {}
+        if page * per_page < len(items):
+            base = f'http://{self.server.server_address[0]}:{self.server.server_address[1]}'
+            url = urllib.parse.urlsplit(self.path)
+            q = urllib.parse.parse_qs(url.query)
+            q['page'] = [str(page + 1)]
+            headers['link'] = '<{}{}?{}>; rel="next"'.format(
+                base, url.path, urllib.parse.urlencode(q, doseq=True))
+        return 200, chunk, headers
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state, latency=0, limit=5000, window=3600, verbose=False,
+                 secondary=0):
+        super().__init__(address, Handler)
+        self.state = state
+        self.latency = latency
+        self.limiter = RateLimiter(limit, window)
+        self.secondary = secondary
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.prefix = ''
+        self.verbose = verbose
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+def main():
+    parser = argparse.ArgumentParser(prog='fakegh.py')
+    parser.add_argument('--port', type=int, default=8765,
+                        help="port to listen on, 0 to choose free one (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="mean response latency in seconds (default: %(default)s)")
+    parser.add_argument('--limit', type=int, default=5000,
+                        help="rate limit per resource and window (default: %(default)s)")
+    parser.add_argument('--window', type=int, default=3600,
+                        help="rate limit window in seconds (default: %(default)s)")
+    parser.add_argument('--secondary', type=int, default=0,
+                        help="max concurrent requests before secondary rate limit,"
+                        " 0 to disable (default: %(default)s)")
+    parser.add_argument('--remote', default=None,
+                        help="git url reported for all repos (default: github ssh url)")
+    parser.add_argument('--repos', default='roc-toolkit,roc-vad,rocd',
+                        help="comma-separated repo names (default: %(default)s)")
+    parser.add_argument('--prs', type=int, default=20,
+                        help="number of prs per repo (default: %(default)s)")
+    parser.add_argument('--issues', type=int, default=20,
+                        help="number of issues per repo, prs are numbered after them"
+                        " (default: %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="log every request")
+    args = parser.parse_args()
+    state = State(repos=args.repos.split(','), n_prs=args.prs, n_issues=args.issues,
+                  remote=args.remote)
+    server = Server(('127.0.0.1', args.port), state, latency=args.latency,
+                    limit=args.limit, window=args.window, verbose=args.verbose,
+                    secondary=args.secondary)
+    print(f'listening on http://127.0.0.1:{server.server_address[1]}', flush=True)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
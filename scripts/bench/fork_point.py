@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+
+# measure fork point computation on synthetic repository
+#
+# target branch has --commits linear commits; pr branch forks from it
+# at 10% and has --pr-commits own commits, merging target every 500 commits,
+# like a long-lived branch does
+#
+# compares algorithm used by previous versions of rgh.py (read whole
+# rev-list, then rev-parse parent) with find_fork_point() from rgh.py;
+# repository initially has no commit-graph, so first call of
+# find_fork_point() includes writing it, and later calls show steady
+# state; 'old (graph)' shows previous algorithm when graph is present
+#
+# find_fork_point() is loaded from rgh.py itself, so that benchmark
+# measures exactly the code that runs
+#
+# examples:
+#   fork_point.py
+#   fork_point.py --commits 20000 --keep /tmp/forkrepo
+import argparse
+import os
+import os.path
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RGH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rgh.py')
+
+def git(repo, *args, **kwargs):
+    return subprocess.run(['git', '-C', repo, *args], check=True, **kwargs)
+
+# generate history using fast-import, which takes seconds even for 100k commits
+def make_repo(path, n_commits, n_pr_commits):
+    git(path, 'init', '-q')
+
+    chunks = []
+    def _commit(ref, mark, parents, message):
+        data = message.encode()
+        chunks.append(f'commit {ref}\nmark :{mark}\n'
+                      f'committer Bench <bench@example.com> {1700000000 + mark} +0000\n'
+                      f'data {len(data)}\n'.encode())
+        chunks.append(data + b'\n')
+        if parents:
+            chunks.append(f'from :{parents[0]}\n'.encode())
+        for parent in parents[1:]:
+            chunks.append(f'merge :{parent}\n'.encode())
+        chunks.append(b'\n')
+
+    for mark in range(1, n_commits + 1):
+        _commit('refs/heads/target', mark, [mark - 1] if mark > 1 else [],
+                f'target commit {mark}')
+
+    fork_mark = n_commits // 10
+    prev = fork_mark
+    for i in range(1, n_pr_commits + 1):
+        mark = n_commits + i
+        parents = [prev]
+        if i % 500 == 0:
+            # merge target as it was at that moment
+            parents.append(min(n_commits, fork_mark + i * 10))
+        _commit('refs/heads/pr', mark, parents, f'pr commit {i}')
+        prev = mark
+
+    subprocess.run(['git', '-C', path, 'fast-import', '--quiet'],
+                   input=b''.join(chunks), check=True)
+
+    # fork point is target commit from which pr branch was created
+    return git(path, 'rev-parse', f'target~{n_commits - fork_mark}',
+               stdout=subprocess.PIPE, text=True).stdout.strip()
+
+# algorithm used by previous versions of rgh.py
+def fork_point_old(repo, source, target):
+    first_commit = git(repo, 'rev-list', '--first-parent', '^'+target, source,
+                       stdout=subprocess.PIPE, text=True).stdout.split()[-1].strip()
+    return git(repo, 'rev-parse', first_commit+'^',
+               stdout=subprocess.PIPE, text=True).stdout.strip()
+
+# execute definitions from rgh.py, without its command-line part, and
+# return find_fork_point() with persistent cache disabled
+def load_fork_point(rgh):
+    with open(rgh) as fp:
+        source = fp.read()
+    source = source[:source.index("\nparser = argparse.ArgumentParser(prog='rgh.py')")]
+    env = {'__name__': 'rgh', '__file__': rgh}
+    exec(compile(source, rgh, 'exec'), env)
+    env['GIT_CACHE'] = None
+    find_fork_point = env['find_fork_point']
+
+    def fork_point_new(repo, source, target):
+        find_fork_point.cache_clear()
+        cwd = os.getcwd()
+        os.chdir(repo)
+        try:
+            return find_fork_point(source, target)
+        finally:
+            os.chdir(cwd)
+
+    return fork_point_new
+
+def measure(name, fn, count, expected):
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+        if result != expected:
+            print(f'{name}: got {result}, expected {expected}', file=sys.stderr)
+            sys.exit(1)
+    print(f'{name:<24} min {min(timings):8.1f}ms'
+          f'  median {statistics.median(timings):8.1f}ms')
+
+parser = argparse.ArgumentParser(prog='fork_point.py')
+parser.add_argument('--commits', type=int, default=100000,
+                    help="number of commits in target branch")
+parser.add_argument('--pr-commits', type=int, default=2000,
+                    help="number of commits in pr branch")
+parser.add_argument('-n', '--count', type=int, default=5,
+                    help="number of runs per case")
+parser.add_argument('--rgh', default=RGH,
+                    help="path to rgh.py to measure (default: %(default)s)")
+parser.add_argument('--keep', metavar='PATH',
+                    help="create repository at PATH and don't remove it")
+
+args = parser.parse_args()
+
+fork_point_new = load_fork_point(args.rgh)
+
+repo = args.keep or tempfile.mkdtemp(prefix='rgh-bench-')
+try:
+    start = time.perf_counter()
+    os.makedirs(repo, exist_ok=True)
+    expected = make_repo(repo, args.commits, args.pr_commits)
+    print(f'created repo with {args.commits + args.pr_commits} commits'
+          f' in {time.perf_counter() - start:.1f}s')
+
+    source = git(repo, 'rev-parse', 'pr', stdout=subprocess.PIPE, text=True).stdout.strip()
+    target = git(repo, 'rev-parse', 'target', stdout=subprocess.PIPE, text=True).stdout.strip()
+
+    measure('old',
+            lambda: fork_point_old(repo, source, target), args.count, expected)
+    measure('new (first call)',
+            lambda: fork_point_new(repo, source, target), 1, expected)
+    measure('new',
+            lambda: fork_point_new(repo, source, target), args.count, expected)
+    measure('old (graph)',
+            lambda: fork_point_old(repo, source, target), args.count, expected)
+finally:
+    if not args.keep:
+        shutil.rmtree(repo, ignore_errors=True)
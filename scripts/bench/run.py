@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+
+# run rgh.py scenarios against local github stand-in and report percentiles
+#
+# starts fakegh.py on free port and creates scratch repository: bare
+# upstream with --commits commits on main and refs/pull/N/head of benchmarked
+# pr, which forks --behind commits before main and has --pr-commits own
+# commits, and its clone where merge scenarios run; fake gh from bin/ is
+# put first in PATH, so nothing talks to real github
+#
+# every scenario runs --count times with empty cache directory ('cold') and
+# with cache directory populated by previous runs ('warm'); reported are
+# wall time percentiles and number of api requests per run, which doesn't
+# depend on machine load and is a regression gate by itself
+#
+# examples:
+#   run.py
+#   run.py --latency 0.1 -n 20 show_pr merge_pr_squash
+#   run.py --api gh sync_labels
+#   run.py --save /tmp/before.json
+#   run.py --compare /tmp/before.json
+#   run.py --rgh /tmp/old/rgh.py --save /tmp/before.json
+import argparse
+import json
+import math
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import OrderedDict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RGH = os.path.join(BENCH_DIR, '..', 'rgh.py')
+
+ORG = 'roc-streaming'
+REPO = 'roc-toolkit'
+
+# issue and pr used by scenarios; fakegh.py numbers prs after issues
+ISSUE_NUMBER = 2
+PR_NUMBER = 21
+
+# scenario name -> rgh.py arguments
+SCENARIOS = OrderedDict([
+    ('show_pr', ['show_pr', PR_NUMBER, '--json']),
+    ('show_issue', ['show_issue', ISSUE_NUMBER, '--json']),
+    ('merge_pr_rebase', ['merge_pr', PR_NUMBER, '--rebase', '--no-push',
+                         '--no-issue', '--no-milestone', '--yes']),
+    ('merge_pr_squash', ['merge_pr', PR_NUMBER, '--squash', '--no-push',
+                         '--no-issue', '--no-milestone', '--yes']),
+    ('sync_labels', ['sync_labels', '--dry-run']),
+])
+
+def git(repo, *args, **kwargs):
+    return subprocess.run(['git', '-C', repo, *args], check=True, **kwargs)
+
+# generate upstream history using fast-import; every commit changes one of
+# 100 files on main, or its own file on pr branch, so that rebase and
+# squash do real work
+# returns list of pr commits, oldest first, as (sha, message)
+def make_upstream(path, n_commits, n_pr_commits, behind):
+    subprocess.run(['git', 'init', '-q', '--bare', path], check=True)
+    git(path, 'symbolic-ref', 'HEAD', 'refs/heads/main')
+
+    chunks = []
+    def _commit(ref, mark, parent, message, filename):
+        data = message.encode()
+        content = f'{message}\n'.encode()
+        chunks.append(f'commit {ref}\nmark :{mark}\n'
+                      f'author Bench <bench@example.com> {1700000000 + mark} +0000\n'
+                      f'committer Bench <bench@example.com> {1700000000 + mark} +0000\n'
+                      f'data {len(data)}\n'.encode())
+        chunks.append(data + b'\n')
+        if parent:
+            chunks.append(f'from :{parent}\n'.encode())
+        chunks.append(f'M 100644 inline {filename}\ndata {len(content)}\n'.encode())
+        chunks.append(content + b'\n')
+
+    for mark in range(1, n_commits + 1):
+        _commit('refs/heads/main', mark, mark - 1 if mark > 1 else None,
+                f'main commit {mark}', f'src/file{mark % 100}.txt')
+
+    parent = max(1, n_commits - behind)
+    for i in range(1, n_pr_commits + 1):
+        mark = n_commits + i
+        _commit(f'refs/pull/{PR_NUMBER}/head', mark, parent,
+                f'pr commit {i}', f'pr/file{i}.txt')
+        parent = mark
+
+    subprocess.run(['git', '-C', path, 'fast-import', '--quiet'],
+                   input=b''.join(chunks), check=True)
+
+    log = git(path, 'log', '--reverse', '--format=%H %s', f'main..refs/pull/{PR_NUMBER}/head',
+              stdout=subprocess.PIPE, text=True).stdout
+    return [tuple(line.split(' ', 1)) for line in log.splitlines()]
+
+def make_clone(upstream, path):
+    subprocess.run(['git', 'clone', '-q', upstream, path], check=True)
+    git(path, 'config', 'user.name', 'Bench')
+    git(path, 'config', 'user.email', 'bench@example.com')
+
+def start_server(args, upstream):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'fakegh.py'),
+         '--port', '0',
+         '--latency', str(args.latency),
+         '--limit', str(args.limit),
+         '--window', str(args.window),
+         '--secondary', str(args.secondary),
+         '--remote', upstream,
+         ],
+        stdout=subprocess.PIPE, text=True)
+    # 'listening on <url>'
+    url = proc.stdout.readline().split()[-1]
+    return proc, url
+
+def api(url, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url + path, data=data, method=method)
+    with urllib.request.urlopen(req) as resp:
+        return json.loads(resp.read() or b'null')
+
+# make benchmarked pr match scratch repository
+def setup_pr(url, pr_commits):
+    api(url, 'POST', '/_update', {
+        'repo': REPO,
+        'pr': PR_NUMBER,
+        'fields': {
+            'head_sha': pr_commits[-1][0],
+            'state': 'open',
+            'draft': False,
+            'commits': [{'sha': sha, 'message': message, 'author': 'Bench',
+                         'email': 'bench@example.com'} for sha, message in pr_commits],
+        },
+    })
+
+# run rgh.py once; returns wall time in milliseconds and number of api requests
+def run_once(cmd, env, cwd, url):
+    api(url, 'POST', '/_reset')
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, env=env, cwd=cwd, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        print(f'command failed: {" ".join(cmd)}\n{proc.stderr}', file=sys.stderr)
+        sys.exit(1)
+    stats = api(url, 'GET', '/_stats')
+    requests = sum(v for k, v in stats.items() if k not in ['max_in_flight', 'secondary'])
+    return elapsed, requests
+
+# run scenario `count` times; if `cold` is true, every run gets fresh cache
+# directory, otherwise cache is populated by one run that isn't measured
+def run_case(cmd, count, cold, env, cwd, url, workdir):
+    timings, requests = [], []
+    cache_dir = tempfile.mkdtemp(prefix='cache-', dir=workdir)
+    try:
+        env = dict(env, RGH_CACHE_DIR=cache_dir)
+        if not cold:
+            run_once(cmd, env, cwd, url)
+        for _ in range(count):
+            if cold:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            elapsed, n_requests = run_once(cmd, env, cwd, url)
+            timings.append(elapsed)
+            requests.append(n_requests)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return timings, requests
+
+# nearest-rank percentile
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize(timings, requests):
+    return OrderedDict([
+        ('p50', percentile(timings, 50)),
+        ('p90', percentile(timings, 90)),
+        ('p99', percentile(timings, 99)),
+        ('max', max(timings)),
+        ('requests', sum(requests) / len(requests)),
+    ])
+
+def print_header():
+    print(f'{"scenario":<18} {"cache":<6} {"p50":>9} {"p90":>9} {"p99":>9}'
+          f' {"max":>9} {"requests":>9}')
+
+def print_row(name, result, baseline=None):
+    line = (f'{name.split("/")[0]:<18} {name.split("/")[1]:<6}'
+            f' {result["p50"]:7.1f}ms {result["p90"]:7.1f}ms {result["p99"]:7.1f}ms'
+            f' {result["max"]:7.1f}ms {result["requests"]:9.1f}')
+    if baseline:
+        line += (f'  p50 {(result["p50"] / baseline["p50"] - 1) * 100:+6.1f}%'
+                 f'  requests {result["requests"] - baseline["requests"]:+.1f}')
+    print(line, flush=True)
+
+# names of results that got worse than baseline
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if result['p50'] > baseline[name]['p50'] * (1 + threshold / 100) or \
+           result['requests'] > baseline[name]['requests']:
+            regressions.append(name)
+    return regressions
+
+parser = argparse.ArgumentParser(prog='run.py')
+parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                    help=f"scenarios to run (default: all): {', '.join(SCENARIOS)}")
+parser.add_argument('-n', '--count', type=int, default=10,
+                    help="number of runs per scenario and cache mode (default: %(default)s)")
+parser.add_argument('--rgh', default=RGH,
+                    help="path to rgh.py to measure (default: %(default)s)")
+parser.add_argument('--api', choices=['http', 'gh'],
+                    help="api backend used by rgh.py (default: chosen by rgh.py);"
+                    " without it, versions of rgh.py that don't have --api can be measured")
+parser.add_argument('--cache', choices=['cold', 'warm', 'both'], default='both',
+                    help="cache modes to measure (default: %(default)s)")
+parser.add_argument('--latency', type=float, default=0.02,
+                    help="mean latency of fake api in seconds (default: %(default)s)")
+parser.add_argument('--limit', type=int, default=5000,
+                    help="rate limit of fake api per window (default: %(default)s)")
+parser.add_argument('--window', type=int, default=3600,
+                    help="rate limit window of fake api in seconds (default: %(default)s)")
+parser.add_argument('--secondary', type=int, default=0,
+                    help="concurrent requests that trigger secondary rate limit,"
+                    " 0 to disable (default: %(default)s)")
+parser.add_argument('--commits', type=int, default=10000,
+                    help="number of commits on main in scratch repo (default: %(default)s)")
+parser.add_argument('--pr-commits', type=int, default=10,
+                    help="number of commits in benchmarked pr (default: %(default)s)")
+parser.add_argument('--behind', type=int, default=100,
+                    help="how many commits of main pr is behind (default: %(default)s)")
+parser.add_argument('--save', metavar='FILE',
+                    help="save results to FILE in json format")
+parser.add_argument('--compare', metavar='FILE',
+                    help="compare with results saved by --save and exit with error"
+                    " if any scenario regressed")
+parser.add_argument('--threshold', type=float, default=20,
+                    help="allowed p50 increase in percent for --compare (default: %(default)s)")
+parser.add_argument('--keep', metavar='PATH',
+                    help="create scratch repos at PATH and don't remove them")
+
+args = parser.parse_args()
+
+for name in args.scenarios:
+    if name not in SCENARIOS:
+        parser.error(f'unknown scenario: {name}')
+
+baseline = None
+if args.compare:
+    with open(args.compare) as fp:
+        baseline = json.load(fp)
+
+# older versions of rgh.py would fail every run with usage error
+if args.api and '--api' not in subprocess.run(
+        [sys.executable, args.rgh, 'show_pr', '--help'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout:
+    print(f"{args.rgh} doesn't support --api", file=sys.stderr)
+    sys.exit(1)
+
+workdir = os.path.abspath(args.keep or tempfile.mkdtemp(prefix='rgh-bench-'))
+server = None
+try:
+    start = time.perf_counter()
+    os.makedirs(workdir, exist_ok=True)
+    upstream = os.path.join(workdir, 'upstream.git')
+    clone = os.path.join(workdir, 'clone')
+    pr_commits = make_upstream(upstream, args.commits, args.pr_commits, args.behind)
+    make_clone(upstream, clone)
+    print(f'created repo with {args.commits + args.pr_commits} commits'
+          f' in {time.perf_counter() - start:.1f}s')
+
+    server, url = start_server(args, upstream)
+    setup_pr(url, pr_commits)
+
+    env = dict(os.environ,
+               PATH=os.path.join(BENCH_DIR, 'bin') + os.pathsep + os.environ['PATH'],
+               FAKEGH_URL=url,
+               FAKEGH_REPO=f'{ORG}/{REPO}',
+               RGH_API_URL=url,
+               GH_TOKEN='fake-token',
+               RGH_WORKTREE_DIR=os.path.join(workdir, 'worktrees'))
+    for var in ['GH_HOST', 'GITHUB_TOKEN', 'RGH_METRICS']:
+        env.pop(var, None)
+    os.makedirs(env['RGH_WORKTREE_DIR'], exist_ok=True)
+
+    modes = ['cold', 'warm'] if args.cache == 'both' else [args.cache]
+
+    results = OrderedDict()
+    print_header()
+    for scenario in args.scenarios or SCENARIOS:
+        cmd = [sys.executable, args.rgh, *map(str, SCENARIOS[scenario]),
+               '-R', f'{ORG}/{REPO}']
+        if args.api:
+            cmd += ['--api', args.api]
+        for mode in modes:
+            name = f'{scenario}/{mode}'
+            timings, requests = run_case(cmd, args.count, mode == 'cold',
+                                         env, clone, url, workdir)
+            results[name] = summarize(timings, requests)
+            print_row(name, results[name], baseline.get(name) if baseline else None)
+finally:
+    if server:
+        server.terminate()
+        server.wait()
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if args.save:
+    with open(args.save, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+if baseline:
+    regressions = find_regressions(results, baseline, args.threshold)
+    if regressions:
+        print(f'regressed: {", ".join(regressions)}', file=sys.stderr)
+        sys.exit(1)
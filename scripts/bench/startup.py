@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+
+# measure startup cost of rgh.py
+#
+# runs each case several times and reports wall time; 'cold' runs use empty
+# cache directory every time, 'warm' runs share cache directory populated by
+# the first run, like subsequent invocations from composite actions do
+#
+# with --baseline, every rgh.py case is also measured for another version
+# of rgh.py, given as file path or git revision, and change of median is
+# reported
+#
+# examples:
+#   startup.py
+#   startup.py -- show_issue 123 --json
+#   startup.py --baseline HEAD~10
+#   startup.py --baseline /tmp/rgh_old.py -- show_pr 456 --json
+import argparse
+import os
+import os.path
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RGH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rgh.py')
+
+# run command once and return wall time in milliseconds
+def run_once(cmd, env):
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        print(f'command failed: {" ".join(cmd)}\n{proc.stderr}', file=sys.stderr)
+        sys.exit(1)
+    return elapsed
+
+# run command `count` times and return list of timings
+# if `cold` is true, every run gets fresh cache directory
+def run_case(cmd, count, cold):
+    timings = []
+    cache_dir = tempfile.mkdtemp(prefix='rgh-bench-')
+    try:
+        env = dict(os.environ, RGH_CACHE_DIR=cache_dir)
+        if not cold:
+            # populate cache
+            run_once(cmd, env)
+        for _ in range(count):
+            if cold:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            timings.append(run_once(cmd, env))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return timings
+
+# python interpreter module import time, in milliseconds, from -X importtime
+def import_time(rgh):
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', rgh, '--help'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    total = 0
+    for line in proc.stderr.splitlines():
+        # 'import time: self | cumulative | name', top-level imports aren't indented
+        parts = line.split('|')
+        if len(parts) != 3 or parts[2].startswith('  '):
+            continue
+        try:
+            total += int(parts[1])
+        except ValueError:
+            pass
+    return total / 1000
+
+# resolve --baseline to path of rgh.py, extracting it from git if needed
+# returns path and whether it's a temporary file
+def baseline_path(rgh, baseline):
+    if os.path.isfile(baseline):
+        return baseline, False
+    proc = subprocess.run(
+        ['git', '-C', os.path.dirname(os.path.abspath(rgh)), 'show',
+         f'{baseline}:./{os.path.basename(rgh)}'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        print(f"can't find baseline '{baseline}': {proc.stderr.strip()}", file=sys.stderr)
+        sys.exit(1)
+    fd, path = tempfile.mkstemp(prefix='rgh-baseline-', suffix='.py')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(proc.stdout)
+    return path, True
+
+def print_row(name, timings, baseline=None):
+    line = (f'{name:<14} min {min(timings):7.1f}ms'
+            f'  median {statistics.median(timings):7.1f}ms'
+            f'  max {max(timings):7.1f}ms')
+    if baseline:
+        change = statistics.median(timings) / statistics.median(baseline) - 1
+        line += f'  median {change * 100:+6.1f}%'
+    print(line)
+
+# measure rgh.py case, and same case for baseline, if any
+def compare_case(name, rgh_args, cold):
+    base_timings = None
+    if base_rgh:
+        base_timings = run_case(python + [base_rgh] + rgh_args, args.count, cold)
+        print_row(name + ' (base)', base_timings)
+    print_row(name, run_case(rgh + rgh_args, args.count, cold), base_timings)
+
+parser = argparse.ArgumentParser(prog='startup.py')
+parser.add_argument('-n', '--count', type=int, default=10,
+                    help="number of runs per case")
+parser.add_argument('--rgh', default=RGH,
+                    help="path to rgh.py to measure (default: %(default)s)")
+parser.add_argument('--baseline', metavar='REV|PATH',
+                    help="also measure rgh.py from git revision or file and report"
+                    " change relative to it")
+parser.add_argument('args', nargs='*',
+                    help="rgh.py arguments for cold/warm cases, e.g. 'show_issue 123'")
+
+args = parser.parse_args()
+
+python = [sys.executable]
+rgh = python + [args.rgh]
+
+base_rgh, base_temp = None, False
+if args.baseline:
+    base_rgh, base_temp = baseline_path(args.rgh, args.baseline)
+
+try:
+    imports = import_time(args.rgh)
+    if base_rgh:
+        base_imports = import_time(base_rgh)
+        print(f'{"imports (base)":<14} {base_imports:7.1f}ms')
+        print(f'{"imports":<14} {imports:7.1f}ms'
+              f'  {(imports / base_imports - 1) * 100:+6.1f}%')
+    else:
+        print(f'{"imports":<14} {imports:7.1f}ms')
+    print_row('python', run_case(python + ['-c', 'pass'], args.count, cold=True))
+    compare_case('help', ['--help'], cold=True)
+
+    if args.args:
+        compare_case('cold', args.args, cold=True)
+        compare_case('warm', args.args, cold=False)
+finally:
+    if base_temp:
+        os.unlink(base_rgh)
@@ -1,28 +1,57 @@
 #! /usr/bin/env python3
 from collections import OrderedDict
-from colorama import Fore, Style
 import argparse
-import colorama
+import atexit
+import fcntl
 import functools
+import hashlib
+import io
 import itertools
 import json
 import os
 import os.path
+import queue
 import random
 import re
 import shutil
-import string
 import subprocess
 import sys
-import tempfile
+import threading
 import time
+import urllib.parse
 
 DRY_RUN = False
 ASK = True
 TOKEN = None
 
-def error(message):
+# placeholder for colorama's Fore and Style, used when colors are disabled
+class NoColor:
+    def __getattr__(self, name):
+        return ''
+
+Fore = Style = NoColor()
+
+# colorama is imported only when output goes to terminal; it also strips
+# colors from the stream that is redirected, if only one of them is
+def setup_colors():
+    global Fore, Style
+    if not (sys.stdout.isatty() or sys.stderr.isatty()):
+        return
+    try:
+        import colorama
+    except ImportError:
+        return
+    colorama.init()
+    Fore, Style = colorama.Fore, colorama.Style
+
+# max number of queries running concurrently
+MAX_WORKERS = 8
+
+def print_error(message):
     print(f'{Fore.RED}{Style.BRIGHT}error:{Style.RESET_ALL} {message}', file=sys.stderr)
+
+def error(message):
+    print_error(message)
     sys.exit(1)
 
 def ask(message):
@@ -41,11 +70,441 @@ def print_cmd(cmd):
     pretty = ' '.join(['"'+c+'"' if ' ' in c else c for c in map(str, cmd)])
     print(f'{Fore.YELLOW}{pretty}{Style.RESET_ALL}')
 
+# profiler enabled by --profile, or None
+PROFILER = None
+
+# records wall time of subprocesses, github requests, waits and phases of
+# the run, and writes them as chrome trace events (chrome://tracing or
+# ui.perfetto.dev) when program exits; also prints summary table to stderr
+class Profiler:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.threads = {}
+        self.running = set()
+
+    # microseconds since start of the run
+    def now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def _tid(self):
+        ident = threading.get_ident()
+        with self.lock:
+            if ident not in self.threads:
+                self.threads[ident] = (len(self.threads) + 1, threading.current_thread().name)
+            return self.threads[ident][0]
+
+    # record finished span; `args` may be updated by caller afterwards
+    def record(self, category, name, start, args, tid=None):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start,
+            'dur': self.now() - start,
+            'pid': os.getpid(),
+            'tid': tid or self._tid(),
+            'args': args,
+        }
+        with self.lock:
+            self.events.append(event)
+        return event
+
+    # run fn(*args, **kwargs) inside span; span is marked failed if fn
+    # raises, including sys.exit() from error()
+    def span(self, category, name, fn, *args, **kwargs):
+        start = self.now()
+        span_args = {}
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            span_args['failed'] = True
+            raise
+        finally:
+            self.record(category, name, start, span_args)
+
+    def dump(self):
+        # subprocesses that are still running, like 'git cat-file --batch'
+        for proc in list(self.running):
+            proc.profile_finish(None)
+        self.record('phase', 'total', 0, {})
+
+        with self.lock:
+            events = list(self.events)
+            threads = list(self.threads.values())
+
+        metadata = [{
+            'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+            'args': {'name': name},
+            } for tid, name in threads]
+        try:
+            with open(self.path, 'w') as fp:
+                json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, fp)
+        except OSError as e:
+            print_error(f"can't write profile: {e}")
+
+        self.print_summary(events)
+
+    # spans grouped by category and name, sorted by total time; long-lived
+    # processes that were still running at exit are only in trace
+    def print_summary(self, events):
+        groups = {}
+        for event in events:
+            if event['args'].get('running'):
+                continue
+            group = groups.setdefault((event['cat'], event['name']), {
+                'count': 0, 'total': 0, 'max': 0, 'failed': 0, 'bytes': 0})
+            group['count'] += 1
+            group['total'] += event['dur']
+            group['max'] = max(group['max'], event['dur'])
+            if event['args'].get('failed'):
+                group['failed'] += 1
+            group['bytes'] += event['args'].get('bytes_in', 0) + \
+                event['args'].get('bytes_out', 0)
+
+        print(f'{"category":<10} {"name":<40} {"count":>6} {"total ms":>10}'
+              f' {"mean ms":>9} {"max ms":>9} {"failed":>6} {"bytes":>10}', file=sys.stderr)
+        for (category, name), group in sorted(
+                groups.items(), key=lambda item: -item[1]['total']):
+            print(f'{category:<10} {name[:40]:<40} {group["count"]:>6}'
+                  f' {group["total"] / 1000:>10.1f}'
+                  f' {group["total"] / group["count"] / 1000:>9.1f}'
+                  f' {group["max"] / 1000:>9.1f} {group["failed"]:>6}'
+                  f' {group["bytes"]:>10}', file=sys.stderr)
+        print(f'profile written to {self.path}', file=sys.stderr)
+
+# short name of command for profile, e.g. 'git fetch' or 'gh pr merge'
+def command_name(cmd):
+    words = [os.path.basename(str(cmd[0]))]
+    for arg in cmd[1:]:
+        arg = str(arg)
+        if arg.startswith('-') or len(words) == (3 if words[0] == 'gh' else 2):
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+# subprocess.Popen that reports every process to profiler and metrics;
+# installed by enable_profiler() or enable_metrics(), so it covers run_cmd()
+# and direct subprocess calls
+def make_instrumented_popen():
+    class InstrumentedPopen(subprocess.Popen):
+        def __init__(self, args, *rest, **kwargs):
+            cmd = [args] if isinstance(args, (str, bytes)) else list(args)
+            self.profile_name = command_name(cmd)
+            self.profile_cmd = ' '.join(map(str, cmd))
+            self.profile_event = None
+            if PROFILER:
+                self.profile_start = PROFILER.now()
+                self.profile_tid = PROFILER._tid()
+            super().__init__(args, *rest, **kwargs)
+            count('rgh_subprocess_spawns_total', command=self.profile_name)
+            if PROFILER:
+                PROFILER.running.add(self)
+
+        def profile_finish(self, returncode):
+            if PROFILER is None or self.profile_event is not None:
+                return
+            PROFILER.running.discard(self)
+            args = {'cmd': self.profile_cmd, 'status': returncode}
+            if returncode is None:
+                args['running'] = True
+            elif returncode != 0:
+                args['failed'] = True
+            self.profile_event = PROFILER.record(
+                'process', self.profile_name, self.profile_start, args, self.profile_tid)
+
+        def communicate(self, input=None, timeout=None):
+            stdout, stderr = super().communicate(input, timeout)
+            self.profile_finish(self.returncode)
+            if self.profile_event is not None:
+                self.profile_event['args']['bytes_in'] = len(input or '')
+                self.profile_event['args']['bytes_out'] = \
+                    len(stdout or '') + len(stderr or '')
+            return stdout, stderr
+
+        def wait(self, timeout=None):
+            returncode = super().wait(timeout)
+            self.profile_finish(returncode)
+            return returncode
+
+    return InstrumentedPopen
+
+def instrument_subprocesses():
+    if subprocess.Popen.__name__ != 'InstrumentedPopen':
+        subprocess.Popen = make_instrumented_popen()
+
+def enable_profiler(path):
+    global PROFILER
+    PROFILER = Profiler(path)
+    instrument_subprocesses()
+    atexit.register(PROFILER.dump)
+
+# run fn(*args, **kwargs), inside profile span if profiling is enabled
+def profiled(category, name, fn, *args, **kwargs):
+    if PROFILER is None:
+        return fn(*args, **kwargs)
+    return PROFILER.span(category, name, fn, *args, **kwargs)
+
+# decorator for logical phases of the run, shown as spans in profile
+def phase(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return profiled('phase', fn.__name__, fn, *args, **kwargs)
+    return wrapper
+
+# metrics enabled by --metrics or $RGH_METRICS, or None
+METRICS = None
+
+# per-invocation counters of github requests, rate limit usage, subprocesses,
+# caches and retries; written when program exits, either merged into
+# prometheus textfile (if path ends with .prom), or appended as one ndjson
+# line, so that cost of automation can be graphed over time
+class Metrics:
+    def __init__(self, path, command):
+        self.path = path
+        self.command = command
+        self.repo = ''
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = {}
+
+    def add(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # all counters, optionally with labels common for the whole invocation
+    def _series(self, common):
+        with self.lock:
+            counters = dict(self.counters)
+        common = [('command', self.command), ('repo', self.repo)] if common else []
+        return sorted((name, tuple(sorted(common + list(labels))), value)
+                      for (name, labels), value in counters.items())
+
+    def dump(self):
+        self.add('rgh_invocations_total', 1, {})
+        self.add('rgh_run_seconds_total', round(time.time() - self.start, 3), {})
+        try:
+            if self.path.endswith('.prom'):
+                self._write_textfile(self._series(common=True))
+            else:
+                self._append_ndjson(self._series(common=False))
+        except OSError as e:
+            print_error(f"can't write metrics: {e}")
+
+    def _append_ndjson(self, series):
+        line = json.dumps(OrderedDict([
+            ('time', int(self.start)),
+            ('command', self.command),
+            ('repo', self.repo),
+            ('counters', [{'name': name, 'labels': dict(labels), 'value': value}
+                          for name, labels, value in series]),
+            ]))
+        # single write() of line shorter than pipe buffer isn't interleaved
+        # with concurrent invocations appending to the same file
+        with open(self.path, 'a') as fp:
+            fp.write(line + '\n')
+
+    # textfile is shared by all invocations on the host, so counters are
+    # accumulated in it under lock and file is replaced atomically, like
+    # node_exporter textfile collector expects
+    def _write_textfile(self, series):
+        import tempfile
+
+        def _format(name, labels):
+            text = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                            for k, v in labels)
+            return f'{name}{{{text}}}'
+
+        lock_fd = os.open(self.path + '.lock', os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            totals = OrderedDict()
+            try:
+                with open(self.path) as fp:
+                    for line in fp:
+                        m = re.match(r'^(\w+\{.*\}) (\S+)$', line.strip())
+                        if m:
+                            totals[m.group(1)] = float(m.group(2))
+            except FileNotFoundError:
+                pass
+            for name, labels, value in series:
+                key = _format(name, labels)
+                totals[key] = totals.get(key, 0) + value
+
+            lines = []
+            for name in sorted(set(key.split('{')[0] for key in totals)):
+                lines.append(f'# TYPE {name} counter')
+                for key, value in sorted(totals.items()):
+                    if key.split('{')[0] == name:
+                        lines.append(f'{key} {value:g}')
+
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)), prefix='.tmp-')
+            with os.fdopen(fd, 'w') as fp:
+                fp.write('\n'.join(lines) + '\n')
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        finally:
+            os.close(lock_fd)
+
+# increment counter if metrics are enabled
+def count(name, value=1, **labels):
+    if METRICS is not None:
+        METRICS.add(name, value, labels)
+
+def enable_metrics(path, command):
+    global METRICS
+    METRICS = Metrics(path, command)
+    instrument_subprocesses()
+    atexit.register(METRICS.dump)
+
+# retry policy of run_cmd(): exponential backoff with jitter, limited both
+# by number of attempts and by overall deadline of the command
+RETRY_MAX_TRIES = 6
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+RETRY_DEADLINE = 180
+
+# errors of github and of network, after which repeating command usually helps
+TRANSIENT_ERROR_REGEXP = re.compile('|'.join([
+    r'HTTP 5\d\d',
+    r'returned error: 5\d\d',
+    r'secondary rate limit',
+    r'Could not resolve host',
+    r'Connection (timed out|reset|refused)',
+    r'connection reset by peer',
+    r'i/o timeout',
+    r'TLS handshake timeout',
+    r'unexpected EOF',
+    r'early EOF',
+    r'RPC failed',
+    r'The remote end hung up unexpectedly',
+    ]), re.IGNORECASE)
+
+# github rejected command because budget of requests is exhausted; budget is
+# restored only at reset time, up to an hour later, so retrying would only
+# waste time and requests
+PRIMARY_RATE_LIMIT_REGEXP = re.compile(r'API rate limit exceeded', re.IGNORECASE)
+
+# git subcommands that talk to remote and can be safely repeated after
+# failure; push is retried only by callers that check remote state first
+GIT_RETRIED_COMMANDS = ['fetch', 'ls-remote', 'clone']
+
+# gh subcommands that can be safely repeated after failure: read-only ones,
+# and edits that set fields to absolute values; merge is retried only by
+# callers that check pr state first
+GH_RETRIED_COMMANDS = [
+    ['pr', 'view'],
+    ['pr', 'list'],
+    ['pr', 'checks'],
+    ['pr', 'edit'],
+    ['pr', 'ready'],
+    ['issue', 'view'],
+    ['issue', 'list'],
+    ['issue', 'edit'],
+    ['repo', 'view'],
+    ['auth', 'status'],
+    ['auth', 'token'],
+]
+
+# seconds that github asked to wait, according to command output, or None
+def retry_after(output):
+    m = re.search(r'^retry-after:\s*(\d+)', output, re.IGNORECASE | re.MULTILINE)
+    if m:
+        return int(m.group(1))
+    if 'secondary rate limit' in output.lower():
+        return 60
+    return None
+
+# retry classifier used for all github and git network commands
+def transient_error(output):
+    if not TRANSIENT_ERROR_REGEXP.search(output):
+        return False
+    return retry_after(output) or True
+
+# check if repeating `cmd` can't apply its effect twice
+def is_idempotent(cmd):
+    if cmd[0] == 'git':
+        return cmd[1] in GIT_RETRIED_COMMANDS
+    if cmd[0] == 'gh' and cmd[1] == 'api':
+        # 'gh api' sends GET unless method or fields are given
+        return not any(arg in ['-X', '--method', '-f', '-F', '--field',
+                               '--raw-field', '--input'] or
+                       arg.startswith(('--method=', '--field=', '--raw-field=', '--input='))
+                       for arg in cmd[2:])
+    if cmd[0] == 'gh':
+        return cmd[1:3] in GH_RETRIED_COMMANDS
+    return False
+
+# classifiers to check output of failed `cmd`; transient errors are
+# retried automatically only for idempotent github and git network commands,
+# others are retried only if caller's `retry_fn` says so
+def retry_classifiers(cmd, retry_fn):
+    classifiers = []
+    if retry_fn:
+        classifiers.append(retry_fn)
+    if is_idempotent(cmd):
+        classifiers.append(transient_error)
+    return classifiers
+
+# delay before retry number `attempt` (starting from 0)
+# `hint` is the value returned by classifier: True, or seconds to wait at least
+def retry_delay(attempt, hint):
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    delay *= random.uniform(0.5, 1.0)
+    if hint is not True:
+        delay = max(delay, hint)
+    return delay
+
+# run process, copying its stdout and stderr to ours as soon as they're
+# written, so that progress of long fetch or push is visible
+# returns exit code and everything process has written
+def run_tee(cmd, input, env):
+    import codecs
+
+    proc = subprocess.Popen(cmd, env=env,
+                            stdin=subprocess.PIPE if input else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    chunks = []
+    lock = threading.Lock()
+
+    def _copy(src, dst):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for data in iter(lambda: src.read1(65536), b''):
+            text = decoder.decode(data)
+            with lock:
+                chunks.append(text)
+            dst.write(text)
+            dst.flush()
+
+    threads = [threading.Thread(target=inherit_request(functools.partial(_copy, src, dst)))
+               for src, dst in [(proc.stdout, sys.stdout), (proc.stderr, sys.stderr)]]
+    for thread in threads:
+        thread.start()
+    if input:
+        try:
+            proc.stdin.write(input)
+        except BrokenPipeError:
+            pass
+        proc.stdin.close()
+    for thread in threads:
+        thread.join()
+
+    return proc.wait(), ''.join(chunks)
+
 # runs `cmd` (must be a list)
 # prints command output to stdout
 # dies if command fails
-# if `retry_fn` is given, retries failed command while retry_fn(cmd_output) returns True
-def run_cmd(cmd, input=None, env=None, retry_fn=None):
+# idempotent github and git network commands are retried after transient
+# errors; if `retry_fn` is given, failed command is also retried while
+# retry_fn(cmd_output) returns True, or number of seconds to wait before
+# retrying; if `done_fn` is given, it's called after every failure, and if
+# it returns True, command is considered successful (e.g. github applied
+# merge, but response was lost)
+def run_cmd(cmd, input=None, env=None, retry_fn=None, done_fn=None):
     cmd = [str(c) for c in cmd]
 
     environ = os.environ.copy()
@@ -57,53 +516,837 @@ def run_cmd(cmd, input=None, env=None, retry_fn=None):
     if input:
         input = input.encode()
 
-    stdout = None
-    if retry_fn:
-        stdout = subprocess.PIPE
+    classifiers = retry_classifiers(cmd, retry_fn)
+
+    # output is scanned only if it's needed to decide whether to retry
+    tee = bool(classifiers or done_fn)
+    if tee and cmd[0] == 'git' and cmd[1] in ['fetch', 'push', 'clone'] and \
+       sys.stderr.isatty():
+        # git reports progress only to terminal, but its stderr is a pipe now
+        cmd = cmd[:2] + ['--progress'] + cmd[2:]
 
-    max_tries = 6
+    deadline = time.monotonic() + RETRY_DEADLINE
+    attempt = 0
 
     while True:
-        try:
-            print_cmd(cmd)
-            if DRY_RUN:
-                return
-            proc = subprocess.run(cmd, input=input, stdout=stdout, env=environ, check=True)
-            if stdout is not None:
-                output = proc.stdout.decode()
-                print(output, end='')
-        except subprocess.CalledProcessError as e:
-            output = ''
-            if e.output:
-                output = e.output.decode()
-            if retry_fn is not None and retry_fn(output) and max_tries > 0:
-                print('Retrying...')
-                max_tries -= 1
-                time.sleep(1)
+        print_cmd(cmd)
+        if DRY_RUN:
+            return
+        if tee:
+            returncode, output = run_tee(cmd, input, environ)
+        else:
+            returncode, output = subprocess.run(cmd, input=input, env=environ).returncode, ''
+        if returncode == 0:
+            return
+        if done_fn and done_fn(output):
+            return
+        if PRIMARY_RATE_LIMIT_REGEXP.search(output):
+            reset = RATE_LIMITER.exhausted_until()
+            if reset:
+                error('github rate limit exceeded, resets at ' +
+                      time.strftime('%H:%M:%S', time.localtime(reset)))
+            error('github rate limit exceeded')
+        hint = False
+        for classify in classifiers:
+            hint = classify(output)
+            if hint:
+                break
+        if hint and attempt + 1 < RETRY_MAX_TRIES:
+            delay = retry_delay(attempt, hint)
+            if time.monotonic() + delay < deadline:
+                print(f'Retrying in {delay:.1f}s...')
+                count('rgh_retries_total', what=command_name(cmd))
+                profiled('wait', 'retry backoff', time.sleep, delay)
+                attempt += 1
                 continue
-            error('command failed')
-        return
+        error('command failed')
+
+# how long memoized results stay valid, in seconds; None means forever,
+# which is right for one-shot invocation, but not for 'serve' mode
+MEMO_TTL = None
+
+# like functools.cache, but safe to use from multiple threads:
+# concurrent calls with the same arguments run function only once,
+# and other callers wait for its result (or failure)
+# failure is reported only to callers that were waiting for it; results
+# expire after MEMO_TTL seconds
+def memoize(fn):
+    cache = {}
+    pending = {}
+    guard = threading.Lock()
+    # bumped on invalidation, so that results of calls that were already
+    # in progress are returned to their callers but not stored
+    generation = [0]
+
+    # call in progress, shared by its waiters
+    class Pending:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.failure = None
+
+    def _lookup(key):
+        entry = cache.get(key)
+        if entry is None:
+            return False, None
+        result, timestamp = entry
+        if MEMO_TTL is not None and time.monotonic() - timestamp > MEMO_TTL:
+            del cache[key]
+            return False, None
+        return True, result
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        with guard:
+            found, result = _lookup(key)
+            if found:
+                count('rgh_memo_requests_total', function=fn.__name__, result='hit')
+                return result
+            call = pending.setdefault(key, Pending())
+        with call.lock:
+            if call.failure is not None:
+                # error was already reported by the caller that failed
+                raise call.failure
+            with guard:
+                found, result = _lookup(key)
+                if found:
+                    count('rgh_memo_requests_total', function=fn.__name__, result='hit')
+                    return result
+            count('rgh_memo_requests_total', function=fn.__name__, result='miss')
+            with guard:
+                started = generation[0]
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                with guard:
+                    call.failure = e
+                    if pending.get(key) is call:
+                        del pending[key]
+                raise
+            with guard:
+                if generation[0] == started:
+                    cache[key] = (result, time.monotonic())
+                if pending.get(key) is call:
+                    del pending[key]
+            return result
+
+    def cache_clear():
+        with guard:
+            generation[0] += 1
+            cache.clear()
+
+    # store result obtained elsewhere, e.g. from batch query
+    def cache_prime(result, *args, **kwargs):
+        with guard:
+            cache[(args, tuple(sorted(kwargs.items())))] = (result, time.monotonic())
+
+    def cache_contains(*args, **kwargs):
+        with guard:
+            return _lookup((args, tuple(sorted(kwargs.items()))))[0]
+
+    # drop results for which predicate(args, result) is true
+    # returns number of dropped results
+    def cache_discard(predicate):
+        with guard:
+            generation[0] += 1
+            keys = [key for key, (result, _) in cache.items() if predicate(key[0], result)]
+            for key in keys:
+                del cache[key]
+            return len(keys)
+
+    # replace results for which predicate(args, result) is true with
+    # update(result), keeping their timestamps
+    # returns number of updated results
+    def cache_update(predicate, update):
+        with guard:
+            generation[0] += 1
+            keys = [key for key, (result, _) in cache.items() if predicate(key[0], result)]
+            for key in keys:
+                result, timestamp = cache[key]
+                cache[key] = (update(result), timestamp)
+            return len(keys)
+
+    wrapper.cache_clear = cache_clear
+    wrapper.cache_discard = cache_discard
+    wrapper.cache_update = cache_update
+    wrapper.cache_prime = cache_prime
+    wrapper.cache_contains = cache_contains
+    return wrapper
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# run functions concurrently and return their results in the same order
+# first function runs in current thread; a function that wasn't picked up
+# by the pool until its result is needed runs in current thread as well,
+# so nested calls can't deadlock on exhausted pool
+def run_parallel(*fns):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            import concurrent.futures
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix='rgh')
+
+    futures = [_executor.submit(inherit_request(fn)) for fn in fns[1:]]
+    try:
+        results = [fns[0]()]
+        for fn, future in zip(fns[1:], futures):
+            if future.cancel():
+                results.append(fn())
+            else:
+                results.append(future.result())
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
 
-# extract (org, repo) from --repo=org/repo
-def parse_repo(s):
-    org, repo = None, None
+    return results
 
-    if s:
-        if '/' in s:
-            org, repo = s.split('/', 2)
+# github api backend used for queries: built-in http client, when token is
+# available, or 'gh api' subprocess otherwise; see setup_api()
+API_URL = 'https://api.github.com'
+API_CLIENT = None
+# identifies token used for requests, without revealing it
+API_SCOPE = None
+
+# directory for persistent caches
+CACHE_DIR = os.environ.get('RGH_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'rgh')
+
+# unix socket of 'rgh.py serve'; clients use server only if $RGH_SOCKET is set
+SERVE_SOCKET = os.environ.get('RGH_SOCKET') or os.path.join(CACHE_DIR, 'serve.sock')
+
+# sqlite file written by 'rgh.py export_state'
+SNAPSHOT_PATH = os.environ.get('RGH_SNAPSHOT') or os.path.join(CACHE_DIR, 'snapshot.sqlite')
+
+# persistent cache of json values in a directory, one file per key
+# entries not stored or touched during `max_age` seconds are expired, and
+# when total size exceeds `max_size` bytes, least recently used are removed
+# get() may use shorter `max_age` for entries that must be fresher
+class DiskCache:
+    def __init__(self, path, max_age, max_size):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.evicted = False
+        self.name = os.path.basename(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key, max_age=None):
+        path = self._file(key)
+        try:
+            if time.time() - os.stat(path).st_mtime > (max_age or self.max_age):
+                count('rgh_cache_requests_total', cache=self.name, result='expired')
+                return None
+            with open(path) as fp:
+                value = json.load(fp)
+        except (OSError, ValueError):
+            count('rgh_cache_requests_total', cache=self.name, result='miss')
+            return None
+        count('rgh_cache_requests_total', cache=self.name, result='hit')
+        return value
+
+    # mark entry as recently used and still valid
+    def touch(self, key):
+        try:
+            os.utime(self._file(key))
+        except OSError:
+            pass
+
+    def put(self, key, value):
+        import tempfile
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(value, fp)
+            os.replace(tmp_path, self._file(key))
+        except OSError:
+            return
+        if not self.evicted:
+            self.evicted = True
+            self.evict()
+
+    def evict(self):
+        try:
+            entries = []
+            for entry in os.scandir(self.path):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        except OSError:
+            return
+
+        now = time.time()
+        total_size = 0
+        for mtime, size, path in sorted(entries, reverse=True):
+            total_size += size
+            if now - mtime > self.max_age or total_size > self.max_size:
+                try:
+                    os.unlink(path)
+                    count('rgh_cache_evictions_total', cache=self.name)
+                except OSError:
+                    pass
+
+# cache of github rest responses, revalidated using etag or last-modified,
+# so that unchanged resources come back as cheap 304 responses
+# set to None by --no-cache
+HTTP_CACHE = DiskCache(os.path.join(CACHE_DIR, 'http'),
+                       max_age=7*24*3600, max_size=64*1024*1024)
+
+# when author's first pr in repo was created, or that it was created before
+# some date; unlike membership, this never changes once known
+# set to None by --no-cache
+AUTHOR_CACHE = DiskCache(os.path.join(CACHE_DIR, 'authors'),
+                         max_age=30*24*3600, max_size=16*1024*1024)
+
+# results computed from immutable git objects, keyed by their shas
+# set to None by --no-cache
+GIT_CACHE = DiskCache(os.path.join(CACHE_DIR, 'git'),
+                      max_age=30*24*3600, max_size=4*1024*1024)
+
+# per-repo index of references between prs and issues, see index_refs()
+# set to None by --no-cache
+REFS_INDEX = DiskCache(os.path.join(CACHE_DIR, 'refs'),
+                       max_age=365*24*3600, max_size=256*1024*1024)
+
+# results of local environment checks, like 'gh auth status' and default repo,
+# which are costly to repeat on every invocation; keys include mtime of the
+# config file the result depends on, so editing it invalidates entry
+# set to None by --no-cache
+STATE_CACHE = DiskCache(os.path.join(CACHE_DIR, 'state'),
+                        max_age=24*3600, max_size=1024*1024)
+
+# how long successful 'gh auth status' is trusted, seconds
+AUTH_STATUS_TTL = 600
+
+# response of github api request, the same for both backends
+class ApiResponse:
+    def __init__(self, status, headers, body, stderr=''):
+        self.status = status
+        # header names are lower-case
+        self.headers = headers
+        self.body = body
+        self.stderr = stderr
+
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def json(self):
+        if not self.body:
+            return None
+        return json.loads(self.body)
+
+    def error_message(self):
+        try:
+            response = self.json()
+            if isinstance(response, dict):
+                if response.get('errors'):
+                    return '; '.join(e.get('message', str(e)) for e in response['errors'])
+                if response.get('message'):
+                    return f"HTTP {self.status}: {response['message']}"
+        except ValueError:
+            pass
+        if self.stderr:
+            return self.stderr.strip()
+        return f'HTTP {self.status}'
+
+# minimal github rest/graphql client with pool of keep-alive connections
+# shared by all threads, so that whole invocation pays for tls handshake
+# and authentication only once per connection
+class HttpClient:
+    def __init__(self, url, token):
+        url = urllib.parse.urlsplit(url)
+        self.secure = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip('/')
+        self.token = token
+        self.idle = queue.LifoQueue()
+
+    def _connect(self):
+        import http.client
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=60)
         else:
-            org = 'roc-streaming'
-            repo = s
+            return http.client.HTTPConnection(self.host, self.port, timeout=60)
 
-    if repo is None:
+    def _acquire(self):
         try:
-            def_repo = subprocess.check_output(
-                ['gh', 'repo', 'set-default', '--view'], text=True).strip()
-            if '/' in def_repo:
-                org, repo = def_repo.split('/', 2)
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def request(self, method, path, body=None, headers=None):
+        import gzip
+        import http.client
+
+        if path.startswith('http://') or path.startswith('https://'):
+            # absolute url, e.g. from 'link' header
+            url = urllib.parse.urlsplit(path)
+            path = url.path + ('?' + url.query if url.query else '')
+        else:
+            path = self.prefix + '/' + path.lstrip('/')
+
+        all_headers = {
+            'Accept': 'application/vnd.github+json',
+            'Accept-Encoding': 'gzip',
+            'Authorization': f'Bearer {self.token}',
+            'User-Agent': 'rgh.py',
+            'X-GitHub-Api-Version': '2022-11-28',
+        }
+        if body is not None:
+            all_headers['Content-Type'] = 'application/json'
+        if headers:
+            all_headers.update(headers)
+
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, path, body=body, headers=all_headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                # server may close idle keep-alive connection at any moment,
+                # retry once on fresh connection in this case
+                if reused:
+                    count('rgh_retries_total', what='http reconnect')
+                    continue
+                return ApiResponse(0, {}, b'', stderr=f'{method} {path}: {e}')
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+        headers = {k.lower(): v for k, v in resp.getheaders()}
+        if headers.get('content-encoding') == 'gzip':
+            data = gzip.decompress(data)
+
+        return ApiResponse(resp.status, headers, data)
+
+# parse output of 'gh api --include'
+def parse_gh_response(output, stderr):
+    m = re.match(rb'HTTP/\S+ (\d+)[^\n]*\n(.*?)\r?\n\r?\n', output, re.S)
+    if not m:
+        return ApiResponse(0, {}, b'', stderr=stderr)
+
+    headers = {}
+    for line in m.group(2).decode().splitlines():
+        if ':' in line:
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+
+    return ApiResponse(int(m.group(1)), headers, output[m.end():], stderr=stderr)
+
+# send github api request using configured backend
+# `path` is either rest api path or 'graphql', `body` is json-serializable
+# GET requests are served from HTTP_CACHE when server confirms that
+# cached response is still valid
+def api_request(method, path, body=None, headers=None):
+    if body is not None:
+        body = json.dumps(body).encode()
+
+    if method != 'GET' or not HTTP_CACHE:
+        return send_request(method, path, body, headers)
+
+    cache_key = json.dumps([API_SCOPE, API_URL, path, headers or {}], sort_keys=True)
+    cached = HTTP_CACHE.get(cache_key)
+
+    req_headers = dict(headers or {})
+    if cached:
+        if cached.get('etag'):
+            req_headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            req_headers['If-Modified-Since'] = cached['last_modified']
+
+    response = send_request(method, path, body, req_headers)
+
+    if cached and response.status == 304:
+        HTTP_CACHE.touch(cache_key)
+        return ApiResponse(cached['status'], response.headers, cached['body'].encode())
+
+    if response.status == 200 and \
+       (response.headers.get('etag') or response.headers.get('last-modified')):
+        HTTP_CACHE.put(cache_key, {
+            'etag': response.headers.get('etag'),
+            'last_modified': response.headers.get('last-modified'),
+            'status': response.status,
+            'body': response.body.decode(),
+        })
+
+    return response
+
+# max number of times request rejected by rate limit is repeated
+RATE_LIMIT_RETRIES = 3
+
+# budget of rate-limited github resource, from last seen x-ratelimit headers
+class RateBudget:
+    def __init__(self, limit, remaining, reset):
+        self.limit = limit
+        self.remaining = remaining
+        # unix time when budget is restored
+        self.reset = reset
+
+# seconds to wait before repeating request rejected by github because of
+# primary or secondary rate limit, or None if it wasn't rejected because of it
+def rate_limit_delay(response):
+    if response.status not in [403, 429]:
+        return None
+
+    try:
+        if response.headers.get('retry-after'):
+            return max(1, int(response.headers['retry-after']))
+        if response.headers.get('x-ratelimit-remaining') == '0':
+            return max(1, int(response.headers.get('x-ratelimit-reset', 0)) - time.time())
+    except ValueError:
+        pass
+
+    if 'secondary rate limit' in response.error_message().lower():
+        return 60
+
+    return None
+
+# schedules github requests according to rate limit budgets, shared by
+# all threads; budgets of 'core', 'graphql' and other resources are
+# tracked separately, from headers of responses of both api backends
+# as budget drains, fewer requests may run concurrently, and when it's
+# exhausted, requests wait until reset time; after secondary rate limit
+# response, all requests to the resource wait as github asks, and then
+# are sent one by one until the end of the run
+class RateLimiter:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.budgets = {}
+        self.active = {}
+        self.blocked_until = {}
+        self.announced = {}
+        self.serialized = set()
+
+    # resource that request will be accounted to
+    @staticmethod
+    def resource(path):
+        path = path.lstrip('/')
+        if path == 'graphql':
+            return 'graphql'
+        if path.startswith('search/'):
+            return 'search'
+        return 'core'
+
+    # max number of concurrent requests allowed with current budget
+    def _capacity(self, resource):
+        if resource in self.serialized:
+            return 1
+        budget = self.budgets.get(resource)
+        if not budget or budget.reset <= time.time():
+            return MAX_WORKERS
+        fraction = budget.remaining / max(budget.limit, 1)
+        if fraction > 0.2:
+            return MAX_WORKERS
+        if fraction > 0.05:
+            return max(1, MAX_WORKERS // 4)
+        return 1
+
+    # seconds to wait before request may be sent, or 0
+    def _delay(self, resource):
+        now = time.time()
+        delay = self.blocked_until.get(resource, 0) - now
+        budget = self.budgets.get(resource)
+        if budget and budget.reset > now and \
+           budget.remaining <= self.active.get(resource, 0):
+            # one second margin for clock skew
+            delay = max(delay, budget.reset - now + 1)
+        return max(delay, 0)
+
+    def acquire(self, resource):
+        start = PROFILER.now() if PROFILER else None
+        waited = False
+        with self.cond:
+            while True:
+                delay = self._delay(resource)
+                if delay > 0:
+                    # report once per wait, not on every wakeup
+                    until = time.time() + delay
+                    if abs(until - self.announced.get(resource, 0)) > 1:
+                        self.announced[resource] = until
+                        print(f'waiting {delay:.0f}s for github {resource} rate limit',
+                              file=sys.stderr)
+                    self.cond.wait(delay)
+                    waited = True
+                    continue
+                if self.active.get(resource, 0) < self._capacity(resource):
+                    break
+                self.cond.wait()
+                waited = True
+            self.active[resource] = self.active.get(resource, 0) + 1
+        if waited and PROFILER:
+            PROFILER.record('wait', f'{resource} rate limit', start, {})
+
+    def release(self, resource, response):
+        with self.cond:
+            self.active[resource] -= 1
+            if response is not None:
+                self._update(response)
+                delay = rate_limit_delay(response)
+                if delay is not None:
+                    self.blocked_until[resource] = max(
+                        self.blocked_until.get(resource, 0), time.time() + delay)
+                    if response.headers.get('x-ratelimit-remaining') != '0':
+                        # secondary limit is about concurrency, not budget
+                        self.serialized.add(resource)
+            self.cond.notify_all()
+
+    def _update(self, response):
+        headers = response.headers
+        try:
+            budget = RateBudget(int(headers['x-ratelimit-limit']),
+                                int(headers['x-ratelimit-remaining']),
+                                int(headers['x-ratelimit-reset']))
+        except (KeyError, ValueError):
+            return
+        resource = headers.get('x-ratelimit-resource') or 'core'
+        old = self.budgets.get(resource)
+        # responses may arrive out of order; within the same window,
+        # remaining budget only decreases
+        if old and old.reset == budget.reset and old.remaining < budget.remaining:
+            return
+        # points used by this run; cost of the first seen request is unknown
+        # and is counted as one point
+        if old and old.reset == budget.reset:
+            count('rgh_ratelimit_used_total', old.remaining - budget.remaining,
+                  resource=resource)
+        else:
+            count('rgh_ratelimit_used_total', 1, resource=resource)
+        self.budgets[resource] = budget
+
+    # latest reset time of known exhausted budgets, or None
+    def exhausted_until(self):
+        with self.cond:
+            now = time.time()
+            resets = [budget.reset for budget in self.budgets.values()
+                      if budget.remaining == 0 and budget.reset > now]
+            return max(resets) if resets else None
+
+    # last known budget of resource, or None
+    def budget(self, resource='core'):
+        with self.cond:
+            budget = self.budgets.get(resource)
+            if budget:
+                return RateBudget(budget.limit, budget.remaining, budget.reset)
+            return None
+
+    # minimum interval between requests of one poller, so that it doesn't
+    # use more than its share of remaining budget until reset; zero while
+    # more than half of budget is left
+    def pacing(self, resource='core'):
+        budget = self.budget(resource)
+        if not budget or budget.remaining > budget.limit / 2:
+            return 0
+        return max(0, budget.reset - time.time()) / max(budget.remaining, 1)
+
+RATE_LIMITER = RateLimiter()
+
+# send request through rate limiter, repeating it if it was rejected
+# because of rate limit
+def send_request(method, path, body, headers):
+    resource = RateLimiter.resource(path)
+
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        RATE_LIMITER.acquire(resource)
+        response = None
+        try:
+            if PROFILER is None:
+                response = send_request_once(method, path, body, headers)
+            else:
+                response = send_profiled_request(method, path, body, headers)
+        finally:
+            RATE_LIMITER.release(resource, response)
+        if METRICS is not None:
+            count('rgh_api_requests_total', method=method, endpoint=api_route(path),
+                  status=str(response.status))
+            count('rgh_api_received_bytes_total', len(response.body or b''),
+                  resource=resource)
+        if rate_limit_delay(response) is None:
+            break
+        if attempt < RATE_LIMIT_RETRIES:
+            count('rgh_retries_total', what=f'{resource} rate limit')
+
+    return response
+
+# endpoint of request path, used to group requests in profile and metrics,
+# e.g. 'repos/:org/:repo/issues/:n/comments'
+def api_route(path):
+    route = urllib.parse.urlsplit(path).path.lstrip('/')
+    route = re.sub(r'^(repos|orgs|users)/[^/]+(/[^/]+)?',
+                   lambda m: m.group(1) + ('/:org/:repo' if m.group(2) else '/:org'), route)
+    return re.sub(r'/\d+(?=/|$)', '/:n', route)
+
+# like send_request_once(), but reports request to profiler
+def send_profiled_request(method, path, body, headers):
+    route = api_route(path)
+
+    start = PROFILER.now()
+    response = None
+    try:
+        response = send_request_once(method, path, body, headers)
+        return response
+    finally:
+        args = {'path': path, 'bytes_in': len(body or b'')}
+        if response is None:
+            args['failed'] = True
+        else:
+            args['status'] = response.status
+            args['bytes_out'] = len(response.body or b'')
+            if not response.ok() and response.status != 304:
+                args['failed'] = True
+        PROFILER.record('http', f'{method} {route}', start, args)
+
+def send_request_once(method, path, body, headers):
+    if API_CLIENT:
+        return API_CLIENT.request(method, path, body, headers)
+
+    cmd = ['gh', 'api', '--include', '--method', method, path]
+    for k, v in (headers or {}).items():
+        cmd += ['-H', f'{k}: {v}']
+    if body is not None:
+        cmd += ['--input', '-']
+
+    environ = None
+    if TOKEN:
+        environ = os.environ.copy()
+        environ['GH_TOKEN'] = TOKEN
+
+    proc = subprocess.run(cmd, input=body, capture_output=True, env=environ)
+
+    return parse_gh_response(proc.stdout, proc.stderr.decode())
+
+# send github api request and return decoded json response
+# dies if request fails
+def api_call(what, method, path, body=None, headers=None):
+    response = profiled('api', what, api_request, method, path, body, headers)
+
+    if not response.ok():
+        error(f'failed to retrieve {what}: {response.error_message()}')
+
+    return response.json()
+
+# like api_call(), but for list endpoints: follows 'link' headers and
+# returns items from all pages
+def api_call_pages(what, path):
+    items = []
+
+    while path:
+        response = profiled('api', what, api_request, 'GET', path)
+        if not response.ok():
+            error(f'failed to retrieve {what}: {response.error_message()}')
+        items += response.json()
+
+        m = re.search(r'<([^>]+)>;\s*rel="next"', response.headers.get('link', ''))
+        path = m.group(1) if m else None
+
+    return items
+
+# choose api backend
+# 'auto' uses built-in client if token is available from environment
+# or from 'gh auth token', and falls back to 'gh api' otherwise
+@phase
+def setup_api(mode):
+    global API_URL, API_CLIENT, API_SCOPE
+
+    host = os.environ.get('GH_HOST')
+    if os.environ.get('RGH_API_URL'):
+        API_URL = os.environ['RGH_API_URL']
+    elif host and host != 'github.com':
+        API_URL = f'https://{host}/api/v3'
+
+    token = TOKEN or os.environ.get('GH_TOKEN') or os.environ.get('GITHUB_TOKEN')
+
+    if token:
+        API_SCOPE = hashlib.sha256(token.encode()).hexdigest()[:16]
+    else:
+        # whoever is logged in into gh
+        API_SCOPE = 'gh:' + (host or 'github.com')
+
+    if mode == 'gh':
+        return
+
+    if not token and shutil.which('gh'):
+        try:
+            token = subprocess.run(
+                ['gh', 'auth', 'token'],
+                capture_output=True, text=True, check=True).stdout.strip()
         except subprocess.CalledProcessError:
             pass
 
+    if not token:
+        if mode == 'http':
+            error("can't find github token for built-in client\n"
+                  "set GH_TOKEN or run 'gh auth login'")
+        return
+
+    API_SCOPE = hashlib.sha256(token.encode()).hexdigest()[:16]
+    API_CLIENT = HttpClient(API_URL, token)
+
+# mtime of file, or None if it doesn't exist
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+# find git directories of repo containing current directory, without
+# spawning git; returns (git_dir, common_dir), or (None, None) outside of repo
+# for linked worktree, git_dir is worktree's own directory with HEAD and
+# index, and common_dir is main repo's one with config, refs and objects
+def find_git_dirs():
+    path = os.getcwd()
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git, dot_git
+        if os.path.isfile(dot_git):
+            try:
+                with open(dot_git) as fp:
+                    git_dir = fp.read().split(':', 1)[-1].strip()
+                git_dir = os.path.normpath(os.path.join(path, git_dir))
+                common_dir = git_dir
+                if os.path.exists(os.path.join(git_dir, 'commondir')):
+                    with open(os.path.join(git_dir, 'commondir')) as fp:
+                        common_dir = os.path.normpath(
+                            os.path.join(git_dir, fp.read().strip()))
+                return git_dir, common_dir
+            except OSError:
+                return None, None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None, None
+        path = parent
+
+# find config of git repo containing current directory, without spawning git
+# for linked worktree, config of main repo is returned
+def find_git_config():
+    _, common_dir = find_git_dirs()
+    if not common_dir:
+        return None
+    return os.path.join(common_dir, 'config')
+
+# detect default repo of current directory: the one chosen by
+# 'gh repo set-default', or origin remote
+def detect_repo():
+    org, repo = None, None
+
+    try:
+        def_repo = subprocess.check_output(
+            ['gh', 'repo', 'set-default', '--view'], text=True).strip()
+        if '/' in def_repo:
+            org, repo = def_repo.split('/', 2)
+    except (subprocess.CalledProcessError, OSError):
+        pass
+
     if repo is None:
         url = subprocess.check_output(
             ['git', 'config', '--get', 'remote.origin.url'], text=True).strip()
@@ -112,70 +1355,405 @@ def parse_repo(s):
 
     return org, repo
 
+# extract (org, repo) from --repo=org/repo
+# without --repo, default repo is detected once and remembered until git
+# config of current repo is modified (both 'gh repo set-default' and
+# 'git remote' store their settings there)
+@phase
+def parse_repo(s):
+    if s:
+        if '/' in s:
+            org, repo = s.split('/', 2)
+        else:
+            org = 'roc-streaming'
+            repo = s
+        return org, repo
+
+    config_path = find_git_config()
+    config_mtime = file_mtime(config_path) if config_path else None
+
+    cache_key = None
+    if STATE_CACHE and config_mtime:
+        cache_key = json.dumps(['repo', config_path, config_mtime])
+        cached = STATE_CACHE.get(cache_key)
+        if cached:
+            return tuple(cached)
+
+    org, repo = detect_repo()
+
+    if cache_key:
+        STATE_CACHE.put(cache_key, [org, repo])
+
+    return org, repo
+
 # check availability of required tools
-def check_tools():
+# gh is not needed for read-only commands when built-in api client is used
+@phase
+def check_tools(need_gh):
     if not shutil.which('git'):
         error("'git' not found in PATH")
 
+    if not need_gh and API_CLIENT:
+        return
+
     if not shutil.which('gh'):
         error("'gh' not found in PATH")
 
+    # with built-in client, token is validated by first request
+    if API_CLIENT:
+        return
+
+    # 'gh auth status' makes network request, so its success is remembered
+    # for a short time; logging in or out modifies hosts.yml and resets it
+    config_dir = os.environ.get('GH_CONFIG_DIR') or os.path.join(
+        os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), 'gh')
+    cache_key = json.dumps([
+        'auth', API_SCOPE, os.environ.get('GH_HOST'),
+        file_mtime(os.path.join(config_dir, 'hosts.yml'))])
+    if STATE_CACHE and STATE_CACHE.get(cache_key, max_age=AUTH_STATUS_TTL):
+        return
+
     try:
         subprocess.check_call(['gh', 'auth', 'status'], stdout=subprocess.DEVNULL,
                               stderr=subprocess.DEVNULL)
     except subprocess.CalledProcessError:
         error("'gh' not logged in, run 'gh auth login'")
 
-# create worktree with unique name and path and chdir to it
-def enter_worktree():
-    def random_dir():
-        while True:
-            path = '/tmp/rgh-' + ''.join(random.choice(string.ascii_lowercase + string.digits)
-                for _ in range(8))
-            if not os.path.exists(path):
-                return path
+    if STATE_CACHE:
+        STATE_CACHE.put(cache_key, True)
+
+# long-lived 'git cat-file --batch' process, used to resolve revisions and
+# read objects over one pipe instead of spawning git for every query
+# one process per working directory, since HEAD differs between worktrees;
+# if process can't be started or dies, falls back to one-shot cat-file
+class GitBatch:
+    def __init__(self, path):
+        self.path = path
+        self.proc = None
+        self.broken = False
+        self.lock = threading.Lock()
+
+    def _start(self):
+        try:
+            self.proc = subprocess.Popen(
+                ['git', 'cat-file', '--batch'], cwd=self.path,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            self.broken = True
+
+    # returns (sha, type, contents) or None if revision can't be resolved
+    def query(self, rev):
+        with self.lock:
+            if self.proc is None and not self.broken:
+                self._start()
+            if not self.broken:
+                try:
+                    self.proc.stdin.write(rev.encode() + b'\n')
+                    self.proc.stdin.flush()
+                    return self._read(self.proc.stdout)
+                except (OSError, ValueError):
+                    self.close()
+                    self.broken = True
+
+        proc = subprocess.run(
+            ['git', 'cat-file', '--batch'], cwd=self.path,
+            input=rev.encode() + b'\n', capture_output=True)
+        if not proc.stdout:
+            return None
+        return self._read(io.BytesIO(proc.stdout))
+
+    def _read(self, fp):
+        header = fp.readline()
+        if not header:
+            raise OSError('cat-file exited')
+        # '<sha> <type> <size>', or '<rev> missing' / '<rev> ambiguous'
+        parts = header.split()
+        if len(parts) != 3:
+            return None
+        sha, obj_type, size = parts
+        contents = fp.read(int(size))
+        fp.read(1)
+        return sha.decode(), obj_type.decode(), contents
+
+    def close(self):
+        if self.proc:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self.proc.wait()
+            self.proc = None
+
+_git_batches = {}
+_git_batches_lock = threading.Lock()
+
+# resolve revision in repo of current directory
+# returns (sha, type, contents), or None if it doesn't exist
+def git_object(rev):
+    path = os.path.realpath(os.getcwd())
+    with _git_batches_lock:
+        if path not in _git_batches:
+            _git_batches[path] = GitBatch(path)
+        batch = _git_batches[path]
+    return batch.query(rev)
+
+@atexit.register
+def close_git_batches():
+    for batch in _git_batches.values():
+        batch.close()
+
+# full name of branch checked out in current worktree, or None if head is
+# detached; HEAD file is read directly, unless its format is unknown
+def read_head_ref():
+    git_dir, _ = find_git_dirs()
+    if git_dir:
+        try:
+            with open(os.path.join(git_dir, 'HEAD')) as fp:
+                head = fp.read().strip()
+            # reftable keeps placeholder in HEAD file
+            if head.startswith('ref: ') and head != 'ref: refs/heads/.invalid':
+                return head[len('ref: '):]
+            if re.match(r'^[0-9a-f]{40}([0-9a-f]{24})?$', head):
+                return None
+        except OSError:
+            pass
+    try:
+        return subprocess.run(
+            ['git', 'symbolic-ref', '-q', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except subprocess.CalledProcessError:
+        return None
 
-    old_path = os.path.abspath(os.getcwd())
-    new_path = random_dir()
+# directory where worktrees are kept by default
+WORKTREE_DIR = os.environ.get('RGH_WORKTREE_DIR') or '/tmp'
+
+# lock of worktree slot acquired by enter_worktree()
+WORKTREE_LOCK = None
+
+# pool slots not used during this time are removed, whichever repo they
+# belong to
+WORKTREE_MAX_AGE = 7*24*3600
+
+# paths of worktrees registered in current repo
+def list_worktrees():
+    output = subprocess.check_output(
+        ['git', 'worktree', 'list', '--porcelain'], text=True)
+    return [os.path.realpath(line[len('worktree '):])
+            for line in output.splitlines() if line.startswith('worktree ')]
 
+# remove pool slots, of any repo, not used during WORKTREE_MAX_AGE, and
+# lock files left without slots; slot is removed only while holding its
+# lock, and last use is recorded in mtime of lock file
+def gc_worktree_pool(registered):
+    now = time.time()
+
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return 0
+
+    for pool_dir in sorted({WORKTREE_DIR, '/dev/shm'}):
+        try:
+            names = os.listdir(pool_dir)
+        except OSError:
+            continue
+
+        slots = set()
+        for name in names:
+            m = re.match(r'^(rgh-[0-9a-f]{8}-\d+)(\.lock)?$', name)
+            if m:
+                slots.add(m.group(1))
+
+        for slot in sorted(slots):
+            path = os.path.join(pool_dir, slot)
+            lock_path = path + '.lock'
+            had_lock = os.path.exists(lock_path)
+            if now - max(_mtime(path), _mtime(lock_path)) < WORKTREE_MAX_AGE:
+                continue
+            try:
+                fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                # slot may have been used between stat() and flock()
+                last_used = _mtime(path)
+                if had_lock:
+                    last_used = max(last_used, _mtime(lock_path))
+                if now - last_used < WORKTREE_MAX_AGE or \
+                   os.fstat(fd).st_ino != os.stat(lock_path).st_ino:
+                    continue
+                if os.path.realpath(path) in registered:
+                    run_cmd([
+                        'git', 'worktree', 'remove', '-f', path,
+                        ])
+                elif os.path.exists(path):
+                    # belongs to another repo, which may not exist anymore;
+                    # its registration is pruned by that repo itself
+                    shutil.rmtree(path, ignore_errors=True)
+                os.unlink(lock_path)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+# remove worktrees left by crashed invocations
+# worktrees of previous versions had random names and were never reused;
+# pool slots are reused, so registrations of slots which directories are
+# gone (e.g. tmpfs was cleared) are pruned, and slots unused for long time
+# are removed by gc_worktree_pool()
+def gc_worktrees():
     run_cmd([
-        'git', 'worktree', 'add', '--no-checkout', new_path
+        'git', 'worktree', 'prune',
         ])
+    if DRY_RUN:
+        return
+
+    registered = list_worktrees()
+    gc_worktree_pool(registered)
+
+    for path in registered:
+        if not re.match(r'^rgh-[a-z0-9]{8}$', os.path.basename(path)):
+            continue
+        # may be still used by older version running concurrently
+        try:
+            if time.time() - os.stat(path).st_mtime < 3600:
+                continue
+        except OSError:
+            continue
+        run_cmd([
+            'git', 'worktree', 'remove', '-f', path,
+            ])
+
+# abort operations left unfinished in worktree by failed invocation
+# git is spawned only if there is something to abort
+def abort_worktree_operations():
+    if DRY_RUN:
+        return
+    git_dir, _ = find_git_dirs()
+    if not git_dir:
+        return
+    for path, cmd in [
+            ('rebase-merge', ['git', 'rebase', '--abort']),
+            ('rebase-apply', ['git', 'rebase', '--abort']),
+            ('MERGE_HEAD', ['git', 'merge', '--abort']),
+    ]:
+        if os.path.exists(os.path.join(git_dir, path)):
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# acquire worktree slot from pool and chdir to it
+# slots are named rgh-<repo id>-<n> and are locked while in use, so
+# concurrent invocations get different slots; reused slot is reset instead
+# of being recreated, and checking out next pr only updates changed files
+@phase
+def enter_worktree(tmpfs=False):
+    global WORKTREE_LOCK
+
+    config_path = find_git_config()
+    if not config_path:
+        error("not a git repository")
+
+    pool_dir = '/dev/shm' if tmpfs and os.path.isdir('/dev/shm') else WORKTREE_DIR
+    repo_id = hashlib.sha256(
+        os.path.realpath(os.path.dirname(config_path)).encode()).hexdigest()[:8]
+
+    gc_worktrees()
+
+    slot = 0
+    while True:
+        new_path = os.path.join(pool_dir, f'rgh-{repo_id}-{slot}')
+        fd = os.open(new_path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            slot += 1
+            continue
+        # lock file may have been removed by gc_worktree_pool() before we
+        # locked it, then lock is useless and slot is tried again
+        try:
+            if os.fstat(fd).st_ino == os.stat(new_path + '.lock').st_ino:
+                # record last use for gc_worktree_pool()
+                os.utime(new_path + '.lock')
+                break
+        except OSError:
+            pass
+        os.close(fd)
+
+    WORKTREE_LOCK = fd
+
+    old_path = os.path.abspath(os.getcwd())
+    reused = not DRY_RUN and os.path.realpath(new_path) in list_worktrees()
+
+    if not reused:
+        if not DRY_RUN and os.path.exists(new_path):
+            # not registered in this repo anymore
+            shutil.rmtree(new_path)
+        run_cmd([
+            'git', 'worktree', 'add', '--detach', '--no-checkout', new_path
+            ])
 
     print_cmd(['cd', new_path])
     if not DRY_RUN:
         os.chdir(new_path)
 
+    if reused:
+        abort_worktree_operations()
+        run_cmd([
+            'git', 'reset', '-q', '--hard',
+            ])
+        run_cmd([
+            'git', 'clean', '-q', '-ffdx',
+            ])
+
     return old_path
 
-# remove worktree and chdir back to repo
+# detach worktree from pr branch, release its slot and chdir back to repo
+# worktree itself is kept for next invocation
+@phase
 def leave_worktree(old_path):
-    new_path = os.path.abspath(os.getcwd())
+    global WORKTREE_LOCK
+
+    abort_worktree_operations()
+    run_cmd([
+        'git', 'checkout', '-q', '-f', '--detach',
+        ])
 
     print_cmd(['cd', old_path])
     os.chdir(old_path)
 
-    run_cmd([
-        'git', 'worktree', 'remove', '-f', os.path.basename(new_path)
-        ])
+    if WORKTREE_LOCK is not None:
+        os.close(WORKTREE_LOCK)
+        WORKTREE_LOCK = None
 
 # return current head
 def remember_ref():
     if DRY_RUN:
         return 'none'
-    try:
-        output = subprocess.run(
-            ['git', 'symbolic-ref', '--short', 'HEAD'],
-            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
-    except:
-        output = subprocess.run(
-            ['git', 'rev-parse', 'HEAD'],
-            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
-    return output.decode().strip()
+    ref = read_head_ref()
+    if ref and ref.startswith('refs/heads/'):
+        return ref[len('refs/heads/'):]
+    if ref:
+        return ref
+    return git_object('HEAD')[0]
+
+# return sha of current head
+def get_head_sha():
+    if DRY_RUN:
+        return None
+    head = git_object('HEAD')
+    if not head:
+        error("can't resolve HEAD")
+    return head[0]
 
 # restore remembered head
 def restore_ref(ref):
-    if os.path.exists('.git/index.lock'):
+    git_dir, _ = find_git_dirs()
+    if git_dir and os.path.exists(os.path.join(git_dir, 'index.lock')):
         run_cmd(['git', 'rebase', '--abort'])
 
     run_cmd(['git', 'checkout', ref])
@@ -184,11 +1762,9 @@ def restore_ref(ref):
 def delete_ref(ref):
     run_cmd(['git', 'branch', '-D', ref])
 
-# detect issue number from PR text
-def guess_issue(org, repo, text):
-    if not text:
-        return None
-
+# build regexp matching references to issues and prs in free text:
+# #123, gh-123, org/repo#123 and github issue urls
+def make_issue_ref_regexp():
     delim = r'[,:;?!()\[\]|+*_~<> \t\n\r]'
 
     prefix = f'(?:^|(?<={delim}))'
@@ -200,24 +1776,38 @@ def guess_issue(org, repo, text):
         r'https?://github.com/([\w-]+)/([\w-]+)/issues/(\d+)(?:#[\w\d-]+)?',
     ]
 
-    regexp = re.compile('|'.join([prefix + p + suffix for p in patterns]),
+    return re.compile('|'.join([prefix + p + suffix for p in patterns]),
         re.IGNORECASE | re.M)
 
-    for m in regexp.finditer(text):
-        if m.group(1):
-            return org, repo, int(m.group(1))
+# compiled once, since it doesn't depend on repo
+ISSUE_REF_REGEXP = make_issue_ref_regexp()
 
-        if m.group(2) == org:
-            return m.group(2), m.group(3), int(m.group(4))
+# iterate over (org, repo, number) of all issue references in text
+# short references, like #123, are relative to given repo
+def find_issue_refs(org, repo, text):
+    if not text:
+        return
 
-        if m.group(5) == org:
-            return m.group(5), m.group(6), int(m.group(7))
+    for m in ISSUE_REF_REGEXP.finditer(text):
+        if m.group(1):
+            yield org, repo, int(m.group(1))
+        elif m.group(2):
+            yield m.group(2), m.group(3), int(m.group(4))
+        else:
+            yield m.group(5), m.group(6), int(m.group(7))
+
+# detect issue number from PR text
+# only references to repos of the same org are considered
+def guess_issue(org, repo, text):
+    for issue_link in find_issue_refs(org, repo, text):
+        if issue_link[0] == org:
+            return issue_link
 
     return None
 
 # construct regexp for matching prefix or suffix of PR or commit title
 # with issue number
-# returned regexp must be suitable for both python and sed
+# returned regexp is used with re.IGNORECASE
 # see make_message() and reword_pr_commits()
 def make_prefix_suffix_regexp(org, repo, is_prefix):
     kv_rx = "fix|fixes|issue|ticket|task"
@@ -268,18 +1858,12 @@ def make_message(org, repo, issue_link, pr_title):
     else:
         return pr_title
 
-@functools.cache
+@memoize
 def query_issue_info(org, repo, issue_number):
     issue_info = {}
 
-    try:
-        response = json.loads(subprocess.run([
-            'gh', 'api',
-            f'/repos/{org}/{repo}/issues/{issue_number}'
-            ],
-            capture_output=True, text=True, check=True).stdout)
-    except subprocess.CalledProcessError as e:
-        error(f'failed to retrieve issue info: {e.stderr.strip()}')
+    response = api_call('issue info',
+                        'GET', f'/repos/{org}/{repo}/issues/{issue_number}')
 
     issue_info['issue_title'] = response['title']
     issue_info['issue_url'] = response['html_url']
@@ -295,40 +1879,351 @@ def query_issue_info(org, repo, issue_number):
 
     return issue_info
 
-@functools.cache
+# fields of issue (or pull request) linked to pr
+ISSUE_FIELDS = '''
+  title
+  url
+  author { __typename login }
+  milestone { title }
+  labels(first: 100) { nodes { name } }
+'''
+
+# selection for issueOrPullRequest field
+ISSUE_SELECTION = '... on Issue { %s } ... on PullRequest { %s }' % (
+    ISSUE_FIELDS, ISSUE_FIELDS)
+
+# everything that show_pr and merge_pr need to know about pr,
+# fetched in a single graphql round-trip
+PR_FIELDS = '''
+  number
+  title
+  body
+  url
+  state
+  isDraft
+  createdAt
+  mergeable
+  canBeRebased
+  author { __typename login }
+  authorAssociation
+  headRefName
+  headRefOid
+  headRepository { sshUrl }
+  baseRefName
+  baseRepository { sshUrl }
+  milestone { title }
+  labels(first: 100) { nodes { name } }
+  closingIssuesReferences(first: 1) {
+    nodes { number repository { name owner { login } } }
+  }
+  reviewRequests(first: 1) { totalCount }
+  reviews(last: 100) {
+    nodes { author { login } authorAssociation state }
+  }
+  commits(first: 250) {
+    nodes {
+      commit {
+        oid
+        messageHeadline
+        authors(first: 1) { nodes { name email } }
+      }
+    }
+  }
+  headCommit: commits(last: 1) {
+    nodes {
+      commit {
+        statusCheckRollup {
+          contexts(first: 100) {
+            nodes {
+              __typename
+              ... on CheckRun {
+                status
+                conclusion
+                checkSuite { workflowRun { workflow { name } } }
+              }
+              ... on StatusContext {
+                state
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+'''
+
+PR_FRAGMENT = 'fragment prFields on PullRequest {%s}' % PR_FIELDS
+
+# run graphql query and return 'data' field of response
+# if `partial` is true, errors are tolerated as long as some data is returned,
+# e.g. when one of aliased fields refers to non-existent pr
+def query_graphql(what, query, variables={}, partial=False):
+    response = api_call(what, 'POST', 'graphql',
+                        {'query': query, 'variables': variables},
+                        # needed for canBeRebased
+                        {'Accept': 'application/vnd.github.merge-info-preview+json'})
+
+    if response.get('errors') and not (partial and response.get('data')):
+        error(f'failed to retrieve {what}: ' +
+              '; '.join(e.get('message', str(e)) for e in response['errors']))
+
+    return response['data']
+
+# format user login the same way as rest api does
+def format_login(author):
+    if not author:
+        return 'ghost'
+    if author['__typename'] == 'Bot':
+        return author['login'] + '[bot]'
+    return author['login']
+
+# convert issue node from graphql response to issue info
+def parse_issue_node(node):
+    issue_info = {}
+
+    issue_info['issue_title'] = node['title']
+    issue_info['issue_url'] = node['url']
+    issue_info['issue_author'] = format_login(node['author'])
+
+    if node['milestone']:
+        issue_info['issue_milestone'] = node['milestone']['title']
+    else:
+        issue_info['issue_milestone'] = None
+
+    issue_info['issue_labels'] = list(sorted(
+        [label['name'] for label in node['labels']['nodes']]))
+
+    return issue_info
+
+# fetch pr, its reviews, checks and commits
+@memoize
+def query_pr_node(org, repo, pr_number):
+    query = '''
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) { ...prFields }
+  }
+}
+''' + PR_FRAGMENT
+
+    data = query_graphql('pr info', query,
+                         {'owner': org, 'name': repo, 'number': int(pr_number)})
+
+    return data['repository']['pullRequest']
+
+# fetch several prs in one query using field aliases
+# returns dict with pr node (or None if pr does not exist) for every number
+# results are stored in query_pr_node() cache
+def fetch_pr_nodes(org, repo, pr_numbers):
+    fields = [f'pr{n}: pullRequest(number: {n}) {{ ...prFields }}' for n in pr_numbers]
+
+    query = 'query {\n  repository(owner: %s, name: %s) {\n%s\n  }\n}\n' % (
+        json.dumps(org), json.dumps(repo), '\n'.join(fields)) + PR_FRAGMENT
+
+    data = query_graphql('pr info', query, partial=True)
+
+    nodes = {}
+    for n in pr_numbers:
+        nodes[n] = (data['repository'] or {}).get(f'pr{n}')
+        if nodes[n]:
+            query_pr_node.cache_prime(nodes[n], org, repo, n)
+
+    return nodes
+
+# search query matching author's prs created before given one
+def author_history_query(org, repo, pr_node):
+    author = pr_node['author']
+    if author and author['__typename'] == 'Bot':
+        author_query = 'app/' + author['login']
+    else:
+        author_query = format_login(author)
+
+    return f"repo:{org}/{repo} is:pr author:{author_query} created:<{pr_node['createdAt']}"
+
+def author_cache_key(org, repo, pr_node):
+    return json.dumps([API_SCOPE, org, repo, format_login(pr_node['author'])])
+
+# check if pr is author's first pr in repo using AUTHOR_CACHE
+# returns None if cache doesn't know
+def lookup_first_pr(org, repo, pr_node):
+    if not AUTHOR_CACHE:
+        return None
+
+    key = author_cache_key(org, repo, pr_node)
+    entry = AUTHOR_CACHE.get(key)
+    if not entry:
+        return None
+
+    created = pr_node['createdAt']
+    result = None
+    # exact date of author's first pr is known
+    if entry.get('first'):
+        result = entry['first'] == created
+    # author has some pr created before given date
+    elif entry.get('before') and entry['before'] <= created:
+        result = False
+
+    if result is not None:
+        AUTHOR_CACHE.touch(key)
+    return result
+
+# remember number of author's prs created before given pr in AUTHOR_CACHE
+def store_first_pr(org, repo, pr_node, n_before):
+    if not AUTHOR_CACHE:
+        return
+
+    key = author_cache_key(org, repo, pr_node)
+    entry = AUTHOR_CACHE.get(key) or {}
+    created = pr_node['createdAt']
+
+    if n_before == 0:
+        entry['first'] = created
+    elif not entry.get('before') or created < entry['before']:
+        entry['before'] = created
+
+    AUTHOR_CACHE.put(key, entry)
+
+# fetch linked issues and author history for several prs in one query
+# this is the second (and last) round-trip, because issue link is known
+# only after pr body is parsed
+# issues are deduplicated and skipped if already known, and fetched
+# issues are stored in query_issue_info() cache
+def fetch_pr_links(org, repo, pr_numbers):
+    fields = []
+    issues = {}
+    links = {}
+
+    for n in pr_numbers:
+        pr_node = query_pr_node(org, repo, n)
+        issue_link = find_issue_link(org, repo, pr_node)
+        links[n] = {'issue_link': issue_link, 'is_first': lookup_first_pr(org, repo, pr_node)}
+
+        # count author's prs created before this one, unless already known
+        if links[n]['is_first'] is None:
+            fields.append(f'history{n}: search(query: %s, type: ISSUE, first: 1) {{ issueCount }}'
+                          % json.dumps(author_history_query(org, repo, pr_node)))
+
+        if issue_link and issue_link not in issues and \
+           not query_issue_info.cache_contains(*issue_link):
+            alias = f'issue{len(issues)}'
+            issues[issue_link] = alias
+            issue_org, issue_repo, issue_number = issue_link
+            fields.append(f'''
+  {alias}: repository(owner: %s, name: %s) {{
+    issueOrPullRequest(number: {issue_number}) {{ {ISSUE_SELECTION} }}
+  }}''' % (json.dumps(issue_org), json.dumps(issue_repo)))
+
+    data = {}
+    if fields:
+        data = query_graphql('pr links', 'query {\n%s\n}' % '\n'.join(fields),
+                             partial=True)
+
+    for issue_link, alias in issues.items():
+        node = (data.get(alias) or {}).get('issueOrPullRequest')
+        if node:
+            query_issue_info.cache_prime(parse_issue_node(node), *issue_link)
+
+    # if search failed, is_first stays unknown (None)
+    for n in pr_numbers:
+        history = data.get(f'history{n}')
+        if links[n]['is_first'] is None and history:
+            n_before = history['issueCount']
+            store_first_pr(org, repo, query_pr_node(org, repo, n), n_before)
+            links[n]['is_first'] = n_before == 0
+
+    return links
+
+@memoize
+def query_pr_links(org, repo, pr_number):
+    return fetch_pr_links(org, repo, [pr_number])[pr_number]
+
+# fetch several issues in one query using field aliases
+# results are stored in query_issue_info() cache
+def fetch_issue_nodes(org, repo, issue_numbers):
+    fields = [f'issue{n}: issueOrPullRequest(number: {n}) {{ {ISSUE_SELECTION} }}'
+              for n in issue_numbers]
+
+    query = 'query {\n  repository(owner: %s, name: %s) {\n%s\n  }\n}' % (
+        json.dumps(org), json.dumps(repo), '\n'.join(fields))
+
+    data = query_graphql('issue info', query, partial=True)
+
+    nodes = {}
+    for n in issue_numbers:
+        nodes[n] = (data['repository'] or {}).get(f'issue{n}')
+        if nodes[n]:
+            query_issue_info.cache_prime(parse_issue_node(nodes[n]), org, repo, n)
+
+    return nodes
+
+# detect issue associated with pr
+# returns (org, repo, number) or None
+def find_issue_link(org, repo, pr_node):
+    issue_link = guess_issue(org, repo, pr_node['body'])
+
+    if not issue_link:
+        issue_link = guess_issue(org, repo, pr_node['title'])
+
+    # issue linked in sidebar is used only if it belongs to the same repo,
+    # so that links to other repos don't change commit prefixes and milestones
+    if not issue_link:
+        for issue in pr_node['closingIssuesReferences']['nodes']:
+            if (issue['repository']['owner']['login'], issue['repository']['name']) == \
+               (org, repo):
+                issue_link = (org, repo, int(issue['number']))
+            break
+
+    return issue_link
+
+@memoize
 def query_pr_info(org, repo, pr_number, no_git=False):
-    try:
-        response = json.loads(subprocess.run(
-            ['gh', 'api', f'/repos/{org}/{repo}/pulls/{pr_number}'],
-            capture_output=True, text=True, check=True).stdout)
-    except subprocess.CalledProcessError as e:
-        error(f'failed to retrieve pr info: {e.stderr.strip()}')
+    response = query_pr_node(org, repo, pr_number)
+
+    def _mergeable():
+        if response['mergeable'] == 'UNKNOWN':
+            return None
+        return response['mergeable'] == 'MERGEABLE'
+
+    def _rebaseable():
+        if response['mergeable'] == 'UNKNOWN':
+            return None
+        return response['canBeRebased']
+
+    def _ssh_url(repo_node):
+        if not repo_node:
+            return None
+        return repo_node['sshUrl']
 
     pr_info = {
         'pr_link': (org, repo, pr_number),
         'pr_title': response['title'],
-        'pr_url': response['html_url'],
-        'pr_author': response['user']['login'],
-        'pr_state': response['state'],
-        'pr_draft': response['draft'],
-        'pr_mergeable': response['mergeable'],
-        'pr_rebaseable': response['rebaseable'],
+        'pr_url': response['url'],
+        'pr_author': format_login(response['author']),
+        'pr_state': 'open' if response['state'] == 'OPEN' else 'closed',
+        'pr_draft': response['isDraft'],
+        'pr_mergeable': _mergeable(),
+        'pr_rebaseable': _rebaseable(),
         # branch in pr author's repo
-        'source_branch': response['head']['ref'],
-        'source_sha': response['head']['sha'],
-        'source_remote': response['head']['repo']['ssh_url'],
+        'source_branch': response['headRefName'],
+        'source_sha': response['headRefOid'],
+        'source_remote': _ssh_url(response['headRepository']),
         # branch in upstream repo
-        'target_branch': response['base']['ref'],
-        'target_remote': response['base']['repo']['ssh_url'],
+        'target_branch': response['baseRefName'],
+        'target_remote': _ssh_url(response['baseRepository']),
     }
 
+    def _target_sha():
+        if no_git:
+            return None
+        return query_remote_ref(pr_info['target_remote'], pr_info['target_branch'])
+
+    # both depend only on pr node and are independent from each other
+    target_sha, links = run_parallel(
+        _target_sha,
+        lambda: query_pr_links(org, repo, pr_number))
+
     if not no_git:
-        try:
-            pr_info['target_sha'] = subprocess.run(
-                ['git', 'ls-remote', pr_info['target_remote'], pr_info['target_branch']],
-                capture_output=True, text=True, check=True).stdout.split()[0]
-        except subprocess.CalledProcessError as e:
-            error("can't determine target commit")
+        pr_info['target_sha'] = target_sha
 
     if response['milestone']:
         pr_info['pr_milestone'] = response['milestone']['title']
@@ -336,22 +2231,13 @@ def query_pr_info(org, repo, pr_number, no_git=False):
         pr_info['pr_milestone'] = None
 
     pr_info['pr_labels'] = list(sorted(
-        [label['name'] for label in response['labels']]))
-
-    pr_info['issue_link'] = None
-
-    if 'body' in response:
-        pr_info['issue_link'] = pr_info['issue_link_in_body'] = \
-          guess_issue(org, repo, response['body'])
-
-    if not pr_info['issue_link'] and 'title' in response:
-        pr_info['issue_link'] = guess_issue(org, repo, response['title'])
+        [label['name'] for label in response['labels']['nodes']]))
 
-    if not pr_info['issue_link'] and 'issue' in response:
-        pr_info['issue_link'] = (org, repo, int(response['issue']['number']))
+    pr_info['issue_link_in_body'] = guess_issue(org, repo, response['body'])
 
-    if pr_info['issue_link']:
-        issue_info = query_issue_info(*pr_info['issue_link'])
+    pr_info['issue_link'] = links['issue_link']
+    if links['issue_link']:
+        issue_info = query_issue_info(*links['issue_link'])
         pr_info.update(issue_info)
 
     review_info = query_pr_review(org, repo, pr_number)
@@ -359,23 +2245,30 @@ def query_pr_info(org, repo, pr_number, no_git=False):
 
     return pr_info
 
-@functools.cache
-def query_pr_review(org, repo, pr_number):
+# sha of branch in remote repo, or None if it can't be determined
+def query_remote_sha(remote, branch):
     try:
-        response = subprocess.run(
-            ['gh', 'pr', 'view',
-             '--repo', f'{org}/{repo}',
-             str(pr_number),
-             '--json',
-             'reviewRequests,reviews'],
-            capture_output=True, text=True, check=True)
-    except subprocess.CalledProcessError as e:
-        error(f'failed to retrieve review state: {e.stderr.strip()}')
-
-    data = json.loads(response.stdout)
+        return subprocess.run(
+            ['git', 'ls-remote', remote, branch],
+            capture_output=True, text=True, check=True).stdout.split()[0]
+    except (subprocess.CalledProcessError, IndexError):
+        return None
+
+# sha of branch in remote repo
+# memoized, so that prs with the same target share one ls-remote
+@memoize
+def query_remote_ref(remote, branch):
+    sha = query_remote_sha(remote, branch)
+    if not sha:
+        error("can't determine target commit")
+    return sha
+
+@memoize
+def query_pr_review(org, repo, pr_number):
+    data = query_pr_node(org, repo, pr_number)
 
     def _review_decision():
-        reviews = data['reviews']
+        reviews = data['reviews']['nodes']
 
         # filter out non-MEMBERS
         reviews = [r for r in reviews if r.get('authorAssociation') == 'MEMBER']
@@ -403,112 +2296,158 @@ def query_pr_review(org, repo, pr_number):
             return 'changes_requested'
 
     review_info = {}
-    review_info['review_requested'] = len(data['reviewRequests']) != 0
+    review_info['review_requested'] = data['reviewRequests']['totalCount'] != 0
     review_info['review_decision'] = _review_decision()
 
     return review_info
 
-@functools.cache
-def query_pr_actions(org, repo, pr_number, no_git=False, silent_error=False):
-    pr_info = query_pr_info(org, repo, pr_number, no_git)
+# order in which check states override each other when several checks
+# belong to the same workflow: any failure wins, then anything still running
+CHECK_STATE_RANK = {
+    'success': 0,
+    'neutral': 0,
+    'skipped': 0,
+    'expected': 1,
+    'pending': 1,
+    'requested': 1,
+    'queued': 1,
+    'waiting': 1,
+    'in_progress': 1,
+}
+
+# add state of one check to per-workflow results
+def merge_check_state(results, workflow, state):
+    state = (state or 'pending').lower()
+
+    if workflow in results:
+        old_rank = CHECK_STATE_RANK.get(results[workflow], 2)
+        new_rank = CHECK_STATE_RANK.get(state, 2)
+        if new_rank < old_rank:
+            return
+        if new_rank == old_rank and state in ['neutral', 'skipped']:
+            return
 
-    try:
-        response = json.loads(subprocess.run([
-            'gh', 'pr', 'checks',
-            '--repo', f'{org}/{repo}',
-            '--json', 'workflow,state',
-            str(pr_number),
-            ],
-            capture_output=True, text=True, check=True).stdout)
-    except subprocess.CalledProcessError as e:
-        if silent_error:
-            response = []
-        else:
-            error(f'failed to retrieve workflow runs: {e.stderr.strip()}')
+    results[workflow] = state
+
+@memoize
+def query_pr_actions(org, repo, pr_number):
+    data = query_pr_node(org, repo, pr_number)
+
+    checks = []
+    for commit in data['headCommit']['nodes']:
+        rollup = commit['commit']['statusCheckRollup']
+        if rollup:
+            checks += rollup['contexts']['nodes']
 
     results = {}
-    for check in response:
-        results[check['workflow']] = check['state'].lower()
+    for check in checks:
+        # same rules as in 'gh pr checks'
+        if check['__typename'] == 'CheckRun':
+            if check['status'] == 'COMPLETED':
+                state = check['conclusion']
+            else:
+                state = check['status']
+            workflow = ''
+            suite = check.get('checkSuite') or {}
+            if suite.get('workflowRun'):
+                workflow = suite['workflowRun']['workflow']['name']
+        else:
+            state = check['state']
+            workflow = ''
+
+        merge_check_state(results, workflow, state)
 
     return sorted(results.items())
 
-@functools.cache
-def query_pr_commits(org, repo, pr_number, no_git=False):
-    try:
-        response = json.loads(subprocess.run([
-            'gh', 'pr', 'view',
-            '--repo', f'{org}/{repo}',
-            '--json', 'commits',
-            str(pr_number),
-            ],
-            capture_output=True, text=True, check=True).stdout)
-    except subprocess.CalledProcessError as e:
-        error(f'failed to retrieve pr commits: {e.stderr.strip()}')
+@memoize
+def query_pr_commits(org, repo, pr_number):
+    data = query_pr_node(org, repo, pr_number)
 
     results = []
-    for commit in response['commits']:
+    for commit in data['commits']['nodes']:
+        commit = commit['commit']
+        author = commit['authors']['nodes'][0]
         results.append((commit['oid'],
                 commit['messageHeadline'],
-                commit['authors'][0]['name'], commit['authors'][0]['email']))
+                author['name'], author['email']))
 
     return results
 
-@functools.cache
-def query_pr_author(org, repo, pr_number, no_git=False):
-    pr_info = query_pr_info(org, repo, pr_number, no_git)
+@memoize
+def query_pr_author(org, repo, pr_number):
+    data = query_pr_node(org, repo, pr_number)
+    links = query_pr_links(org, repo, pr_number)
 
     author_info = {}
 
-    try:
-        subprocess.run(
-            ['gh', 'api', f'/orgs/{org}/members/'+pr_info['pr_author']],
-            capture_output=True, text=True, check=True)
-        author_info['is_contrib'] = False
-    except subprocess.CalledProcessError as e:
-        author_info['is_contrib'] = True
-
-    try:
-       n_pullreqs = int(subprocess.check_output(
-            ['gh', 'pr', 'list',
-             '--repo', f'{org}/{repo}',
-             '--author', pr_info['pr_author'],
-             '--state', 'all',
-             '--json', 'number',
-             '--jq', 'length',
-             ],
-            text=True))
-    except subprocess.CalledProcessError as e:
-        pass
-
-    author_info['is_first'] = n_pullreqs == 0
+    author_info['is_contrib'] = data['authorAssociation'] not in ['MEMBER', 'OWNER']
+    author_info['is_first'] = links['is_first']
 
     return author_info
 
+# drop cached pr info, so that next query will fetch it again
+def clear_pr_cache():
+    for fn in [query_pr_node, query_pr_links, query_pr_info, query_remote_ref,
+               query_pr_review, query_pr_actions, query_pr_commits, query_pr_author]:
+        fn.cache_clear()
+
 # find commit in target branch from which PR's branch was forked
-@functools.cache
 def find_pr_fork_point(org, repo, pr_number):
     pr_info = query_pr_info(org, repo, pr_number)
 
-    try:
-        # find oldest commit in current branch that is not present in target
-        first_commit = subprocess.run(
-            ['git', 'rev-list', '--first-parent', '^'+pr_info['target_sha'], pr_info['source_sha']],
-            capture_output=True, text=True, check=True).stdout.split()[-1].strip()
-        # find its parent
-        fork_point = subprocess.run(
-            ['git', 'rev-parse', first_commit+'^'],
-            capture_output=True, text=True, check=True).stdout.strip()
-    except subprocess.CalledProcessError as e:
+    return find_fork_point(pr_info['source_sha'], pr_info['target_sha'])
+
+# add commits reachable from given ones to commit-graph
+# walks over commits in graph don't need to inflate and parse commit objects,
+# which is what dominates rev-list on long histories; first call writes graph
+# for whole history, later ones only append missing commits as a new layer,
+# which takes few milliseconds
+# best effort: if repo is read-only or graph is locked, walk just runs slower
+def update_commit_graph(shas):
+    subprocess.run(
+        ['git', 'commit-graph', 'write', '--stdin-commits', '--split', '--no-progress'],
+        input='\n'.join(shas), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        text=True)
+
+# find first-parent ancestor of source that is reachable from target, i.e.
+# parent of the oldest commit on source's first-parent chain that is not
+# present in target
+# depends only on immutable commits, so result is cached persistently;
+# rev-list output is streamed and only the last line is kept
+@memoize
+def find_fork_point(source_sha, target_sha):
+    cache_key = json.dumps(['fork_point', source_sha, target_sha])
+    if GIT_CACHE:
+        cached = GIT_CACHE.get(cache_key)
+        if cached:
+            return cached
+
+    update_commit_graph([source_sha, target_sha])
+
+    # each line is commit followed by its parents
+    proc = subprocess.Popen(
+        ['git', 'rev-list', '--first-parent', '--parents', '^'+target_sha, source_sha],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    last_line = None
+    for line in proc.stdout:
+        last_line = line
+    if proc.wait() != 0 or not last_line or len(last_line.split()) < 2:
         error("can't determine fork point")
 
+    fork_point = last_line.split()[1]
+
+    if GIT_CACHE:
+        GIT_CACHE.put(cache_key, fork_point)
+
     return fork_point
 
 # dump pr info in json format
 def build_pr_json(org, repo, pr_number):
-    pr_info = query_pr_info(org, repo, pr_number, no_git=True)
-    pr_actions = query_pr_actions(org, repo, pr_number, no_git=True, silent_error=True)
-    pr_commits = query_pr_commits(org, repo, pr_number, no_git=True)
-    pr_author = query_pr_author(org, repo, pr_number, no_git=True)
+    pr_info, pr_actions, pr_commits, pr_author = run_parallel(
+        lambda: query_pr_info(org, repo, pr_number, no_git=True),
+        lambda: query_pr_actions(org, repo, pr_number),
+        lambda: query_pr_commits(org, repo, pr_number),
+        lambda: query_pr_author(org, repo, pr_number))
 
     result = OrderedDict()
 
@@ -615,8 +2554,12 @@ def print_arr(key, vals, colors, depth):
         print_text(f'{key}: none', color=None, depth=depth)
 
 # print info about PR and linked issue
-def show_pr(org, repo, pr_number, show_json):
-    js = build_pr_json(org, repo, pr_number)
+# if `snapshot` is set, info is read from that file instead of github
+def show_pr(org, repo, pr_number, show_json, snapshot=None):
+    if snapshot:
+        js = load_snapshot_json(snapshot, 'prs', org, repo, pr_number)
+    else:
+        js = build_pr_json(org, repo, pr_number)
 
     if show_json:
         print_json(js)
@@ -722,8 +2665,12 @@ def show_pr(org, repo, pr_number, show_json):
         print_text('none', Fore.RED, depth=1)
 
 # print info about issue
-def show_issue(org, repo, issue_number, show_json):
-    js = build_issue_json(org, repo, issue_number)
+# if `snapshot` is set, info is read from that file instead of github
+def show_issue(org, repo, issue_number, show_json, snapshot=None):
+    if snapshot:
+        js = load_snapshot_json(snapshot, 'issues', org, repo, issue_number)
+    else:
+        js = build_issue_json(org, repo, issue_number)
 
     if show_json:
         print_json(js)
@@ -747,15 +2694,507 @@ def show_issue(org, repo, issue_number, show_json):
                 v = 'none'
         print_kv(k, v, color, depth=1)
 
+# most recently updated prs go first, so incremental update can stop
+# as soon as it reaches pr that was not updated since previous run
+PR_REFS_QUERY = '''
+query($owner: String!, $name: String!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: 50, after: $after, orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        body
+        updatedAt
+        commits(first: 100) { nodes { commit { message } } }
+      }
+    }
+  }
+}
+'''
+
+def format_issue_ref(issue_link):
+    issue_org, issue_repo, issue_number = issue_link
+    return f'{issue_org}/{issue_repo}#{issue_number}'
+
+# index of references between prs and issues of repo:
+#  'cursor' - updatedAt of most recently updated indexed pr
+#  'pr_refs' - pr number => references from its title, body and commits
+#  'ref_prs' - reference => numbers of prs that mention it
+# references are formatted as 'org/repo#123'
+def load_refs_index(org, repo):
+    index = None
+    if REFS_INDEX:
+        index = REFS_INDEX.get(json.dumps([API_URL, org, repo]))
+    return index or {'cursor': None, 'pr_refs': {}, 'ref_prs': {}}
+
+# replace references of pr in both directions
+def set_pr_refs(index, pr_number, refs):
+    for ref in index['pr_refs'].pop(str(pr_number), []):
+        prs = index['ref_prs'].get(ref, [])
+        if pr_number in prs:
+            prs.remove(pr_number)
+        if not prs:
+            index['ref_prs'].pop(ref, None)
+
+    if refs:
+        index['pr_refs'][str(pr_number)] = refs
+    for ref in refs:
+        index['ref_prs'].setdefault(ref, []).append(pr_number)
+        index['ref_prs'][ref].sort()
+
+# bring index up to date with github
+# only prs updated since previous run are fetched, unless `full` is true
+# returns index and number of fetched prs
+def update_refs_index(org, repo, full=False):
+    if full:
+        index = {'cursor': None, 'pr_refs': {}, 'ref_prs': {}}
+    else:
+        index = load_refs_index(org, repo)
+
+    cursor = index['cursor']
+    n_fetched = 0
+    after = None
+
+    while True:
+        data = query_graphql('pr references', PR_REFS_QUERY,
+                             {'owner': org, 'name': repo, 'after': after})
+        connection = data['repository']['pullRequests']
+
+        reached_cursor = False
+        for node in connection['nodes']:
+            # prs updated in the same second as cursor are indexed again
+            if cursor and node['updatedAt'] < cursor:
+                reached_cursor = True
+                break
+
+            texts = [node['title'], node['body']] + \
+                [commit['commit']['message'] for commit in node['commits']['nodes']]
+            self_ref = format_issue_ref((org, repo, node['number']))
+            refs = []
+            for text in texts:
+                for issue_link in find_issue_refs(org, repo, text):
+                    ref = format_issue_ref(issue_link)
+                    if ref != self_ref and ref not in refs:
+                        refs.append(ref)
+
+            set_pr_refs(index, node['number'], refs)
+            index['cursor'] = max(index['cursor'] or '', node['updatedAt'])
+            n_fetched += 1
+
+        if reached_cursor or not connection['pageInfo']['hasNextPage']:
+            break
+        after = connection['pageInfo']['endCursor']
+
+    if REFS_INDEX:
+        REFS_INDEX.put(json.dumps([API_URL, org, repo]), index)
+
+    return index, n_fetched
+
+# update index of references and optionally print what references issue
+# or pr `ref_number`, or what pr `pr_number` references
+@phase
+def index_refs(org, repo, full, offline, ref_number, pr_number):
+    if offline:
+        index = load_refs_index(org, repo)
+    else:
+        index, n_fetched = update_refs_index(org, repo, full)
+
+    if ref_number:
+        print_json(index['ref_prs'].get(format_issue_ref((org, repo, ref_number)), []))
+        return
+
+    if pr_number:
+        print_json(index['pr_refs'].get(str(pr_number), []))
+        return
+
+    summary = f"{len(index['pr_refs'])} prs with {len(index['ref_prs'])} references indexed"
+    if offline:
+        print_kv(f'{org}/{repo}', summary)
+    else:
+        print_kv(f'{org}/{repo}', f'{n_fetched} prs fetched, {summary}')
+
+# parse list of numbers and ranges, e.g. ['10', '12-15', '20,21']
+def parse_numbers(specs):
+    numbers = []
+    for spec in specs:
+        for part in spec.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            m = re.fullmatch(r'(\d+)(?:-(\d+))?', part)
+            if not m:
+                error(f"invalid number or range '{part}'")
+            first, last = int(m.group(1)), int(m.group(2) or m.group(1))
+            for n in range(first, last + 1):
+                if n not in numbers:
+                    numbers.append(n)
+    return numbers
+
+# print info about many PRs in ndjson format, one line per PR
+# PRs are fetched in chunks; output for every chunk is printed as soon
+# as it's ready
+def show_prs(org, repo, pr_numbers, chunk_size):
+    failed = False
+
+    for pos in range(0, len(pr_numbers), chunk_size):
+        chunk = pr_numbers[pos:pos+chunk_size]
+
+        nodes = fetch_pr_nodes(org, repo, chunk)
+        found = [n for n in chunk if nodes[n]]
+
+        if found:
+            for n, links in fetch_pr_links(org, repo, found).items():
+                query_pr_links.cache_prime(links, org, repo, n)
+
+        for n in chunk:
+            if not nodes[n]:
+                print_error(f"can't find pr #{n}")
+                failed = True
+                continue
+            try:
+                print(json.dumps(build_pr_json(org, repo, n)))
+            except SystemExit:
+                failed = True
+
+        sys.stdout.flush()
+
+    if failed:
+        sys.exit(1)
+
+# print info about many issues in ndjson format, one line per issue
+def show_issues(org, repo, issue_numbers, chunk_size):
+    failed = False
+
+    for pos in range(0, len(issue_numbers), chunk_size):
+        chunk = issue_numbers[pos:pos+chunk_size]
+
+        nodes = fetch_issue_nodes(org, repo, chunk)
+
+        for n in chunk:
+            if not nodes[n]:
+                print_error(f"can't find issue #{n}")
+                failed = True
+                continue
+            print(json.dumps(build_issue_json(org, repo, n)))
+
+        sys.stdout.flush()
+
+    if failed:
+        sys.exit(1)
+
+# all open prs of repo, with everything that show_pr needs
+OPEN_PRS_QUERY = '''
+query($owner: String!, $name: String!, $first: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: $first, after: $after) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...prFields }
+    }
+  }
+}
+''' + PR_FRAGMENT
+
+# all open issues of repo, with everything that show_issue needs
+OPEN_ISSUES_QUERY = '''
+query($owner: String!, $name: String!, $first: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    issues(states: OPEN, first: $first, after: $after) {
+      pageInfo { hasNextPage endCursor }
+      nodes { number %s }
+    }
+  }
+}
+''' % ISSUE_FIELDS
+
+# tables of state snapshot; one file may hold snapshots of several repos,
+# 'repo' is 'org/name' everywhere
+# 'json' columns hold output of show_pr --json and show_issue --json,
+# other columns are for queries from dashboards and scripts
+SNAPSHOT_SCHEMA = '''
+create table if not exists snapshots (
+  repo text primary key,
+  api_url text not null,
+  exported_at text not null
+);
+create table if not exists prs (
+  repo text not null,
+  number integer not null,
+  title text not null,
+  url text not null,
+  author text not null,
+  milestone text,
+  state text not null,
+  is_draft integer not null,
+  source_branch text not null,
+  target_branch text not null,
+  review_requested integer not null,
+  review_decision text not null,
+  checks text,
+  linked_issue text,
+  json text not null,
+  primary key (repo, number)
+);
+create table if not exists issues (
+  repo text not null,
+  number integer not null,
+  title text not null,
+  url text not null,
+  author text not null,
+  milestone text,
+  json text not null,
+  primary key (repo, number)
+);
+create table if not exists labels (
+  repo text not null,
+  number integer not null,
+  label text not null,
+  primary key (repo, number, label)
+);
+create table if not exists checks (
+  repo text not null,
+  number integer not null,
+  workflow text not null,
+  state text not null,
+  primary key (repo, number, workflow)
+);
+create index if not exists prs_milestone on prs (repo, milestone);
+create index if not exists prs_linked_issue on prs (linked_issue);
+create index if not exists issues_milestone on issues (repo, milestone);
+create index if not exists labels_label on labels (repo, label);
+'''
+
+# combine states of all workflows into one, using CHECK_STATE_RANK
+# returns None if pr has no checks
+def rollup_checks(actions):
+    if not actions:
+        return None
+    rank = max(CHECK_STATE_RANK.get(state, 2) for state in actions.values())
+    return ['success', 'pending', 'failure'][rank]
+
+# fetch all open prs and issues of repo and store them into sqlite file
+# prs are fetched page by page with the same fields as show_pr uses, and
+# linked issues and author history of every page are fetched with one more
+# query, so that whole repo costs about two requests per `page_size` prs
+@phase
+def export_state(org, repo, path, page_size):
+    import sqlite3
+
+    pr_jsons = OrderedDict()
+    issue_jsons = OrderedDict()
+
+    after = None
+    while True:
+        data = query_graphql('open prs', OPEN_PRS_QUERY,
+                             {'owner': org, 'name': repo, 'first': page_size, 'after': after})
+        connection = data['repository']['pullRequests']
+
+        numbers = []
+        for node in connection['nodes']:
+            query_pr_node.cache_prime(node, org, repo, node['number'])
+            numbers.append(node['number'])
+
+        if numbers:
+            for n, links in fetch_pr_links(org, repo, numbers).items():
+                query_pr_links.cache_prime(links, org, repo, n)
+            for n in numbers:
+                pr_jsons[n] = (build_pr_json(org, repo, n),
+                               query_pr_info(org, repo, n, no_git=True)['issue_link'])
+
+        if not connection['pageInfo']['hasNextPage']:
+            break
+        after = connection['pageInfo']['endCursor']
+
+    after = None
+    while True:
+        data = query_graphql('open issues', OPEN_ISSUES_QUERY,
+                             {'owner': org, 'name': repo, 'first': page_size, 'after': after})
+        connection = data['repository']['issues']
+
+        for node in connection['nodes']:
+            query_issue_info.cache_prime(parse_issue_node(node), org, repo, node['number'])
+            issue_jsons[node['number']] = build_issue_json(org, repo, node['number'])
+
+        if not connection['pageInfo']['hasNextPage']:
+            break
+        after = connection['pageInfo']['endCursor']
+
+    full_name = f'{org}/{repo}'
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        db = sqlite3.connect(path, timeout=30)
+    except sqlite3.Error as e:
+        error(f"can't open snapshot {path}: {e}")
+    try:
+        db.executescript(SNAPSHOT_SCHEMA)
+        # readers see either previous or new snapshot of repo
+        with db:
+            for table in ['prs', 'issues', 'labels', 'checks']:
+                db.execute(f'delete from {table} where repo = ?', (full_name,))
+
+            for n, (js, issue_link) in pr_jsons.items():
+                pr = js['pull_request']
+                db.execute(
+                    'insert into prs values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                        full_name, n, pr['title'], pr['url'], pr['author'],
+                        pr['milestone'], pr['state'], pr['is_draft'],
+                        pr['source_branch'], pr['target_branch'],
+                        js['review']['requested'], js['review']['decision'],
+                        rollup_checks(js['actions']),
+                        format_issue_ref(issue_link) if issue_link else None,
+                        json.dumps(js)))
+                db.executemany('insert into labels values (?, ?, ?)',
+                               [(full_name, n, label) for label in pr['labels']])
+                db.executemany('insert into checks values (?, ?, ?, ?)',
+                               [(full_name, n, workflow, state)
+                                for workflow, state in js['actions'].items()])
+
+            for n, js in issue_jsons.items():
+                issue = js['issue']
+                db.execute(
+                    'insert into issues values (?, ?, ?, ?, ?, ?, ?)', (
+                        full_name, n, issue['title'], issue['url'], issue['author'],
+                        issue['milestone'], json.dumps(js)))
+                db.executemany('insert into labels values (?, ?, ?)',
+                               [(full_name, n, label) for label in issue['labels']])
+
+            db.execute(
+                'insert or replace into snapshots values (?, ?, ?)', (
+                    full_name, API_URL, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())))
+    except sqlite3.Error as e:
+        error(f"can't write snapshot {path}: {e}")
+    finally:
+        db.close()
+
+    print_kv(full_name,
+             f'{len(pr_jsons)} prs and {len(issue_jsons)} issues exported to {path}')
+
+# read output of show_pr or show_issue from snapshot created by export_state
+# `table` is 'prs' or 'issues'
+def load_snapshot_json(path, table, org, repo, number):
+    import sqlite3
+
+    if not os.path.exists(path):
+        error(f"snapshot {path} doesn't exist, run 'rgh.py export_state' first")
+
+    try:
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+        try:
+            row = db.execute(f'select json from {table} where repo = ? and number = ?',
+                             (f'{org}/{repo}', number)).fetchone()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        error(f"can't read snapshot {path}: {e}")
+
+    if not row:
+        what = 'pr' if table == 'prs' else 'issue'
+        error(f"can't find open {what} #{number} of {org}/{repo} in snapshot {path}")
+
+    return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+# keep only the most recent run of every workflow
+# workflow may run several times for same commit (re-runs, manual
+# triggers), and only the last one tells its current state; re-run of
+# existing run keeps its id and created_at, but gets new run_attempt
+# and run_started_at
+def latest_workflow_runs(runs):
+    latest = {}
+    for run in runs:
+        key = (run.get('run_started_at') or run.get('created_at') or '',
+               run.get('run_attempt') or 1, run.get('id') or 0)
+        if run['name'] not in latest or key > latest[run['name']][0]:
+            latest[run['name']] = (key, run)
+    return [run for _, run in latest.values()]
+
+# wait until workflow runs for PR's head commit are completed
+# polls only PR and its workflow runs, with conditional requests and
+# growing randomized interval, so that long builds cost few requests;
+# if PR's head changes meanwhile, waits for runs of the new head
+# prints final state of every workflow in json format
+@phase
+def wait_checks(org, repo, pr_number, workflows, timeout, interval):
+    deadline = time.monotonic() + timeout
+    max_interval = max(interval, 30)
+
+    head_sha = None
+    states = {}
+    delay = interval
+
+    while True:
+        # pr may be force-pushed while we wait, then runs of old head
+        # don't matter anymore; conditional request is free when pr is
+        # unchanged
+        response = api_request('GET', f'/repos/{org}/{repo}/pulls/{pr_number}')
+        if response.ok():
+            new_head_sha = response.json()['head']['sha']
+            if head_sha and new_head_sha != head_sha:
+                print(f'head changed to {new_head_sha[:8]}, restarting wait',
+                      file=sys.stderr)
+                states = {}
+                delay = interval
+            head_sha = new_head_sha
+        elif not head_sha or (response.status and response.status < 500):
+            error(f'failed to retrieve pr info: {response.error_message()}')
+
+        response = api_request(
+            'GET', f'/repos/{org}/{repo}/actions/runs?head_sha={head_sha}&per_page=100')
+
+        if response.ok():
+            results = {}
+            for run in latest_workflow_runs(response.json()['workflow_runs']):
+                if run['status'] == 'completed':
+                    merge_check_state(results, run['name'], run['conclusion'])
+                else:
+                    merge_check_state(results, run['name'], run['status'])
+
+            new_states = {workflow: results.get(workflow) for workflow in workflows}
+            if new_states != states:
+                for workflow in workflows:
+                    if new_states[workflow] != states.get(workflow):
+                        print(f'{workflow}: {new_states[workflow] or "not started"}',
+                              file=sys.stderr)
+                states = new_states
+                # something is going on, check again soon
+                delay = interval
+        elif response.status and response.status < 500:
+            error(f'failed to retrieve workflow runs: {response.error_message()}')
+
+        if states and all(state and CHECK_STATE_RANK.get(state, 2) != 1
+                          for state in states.values()):
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            error('timed out waiting for workflows: ' + ', '.join(
+                workflow for workflow, state in states.items()
+                if not state or CHECK_STATE_RANK.get(state, 2) == 1))
+
+        # when budget is low, poll no faster than it allows
+        profiled('wait', 'poll interval', time.sleep,
+                 min(remaining, max(delay * random.uniform(0.5, 1.0),
+                                    RATE_LIMITER.pacing())))
+        delay = min(delay * 1.5, max_interval)
+
+    print_json(OrderedDict(sorted(states.items())))
+
 # die if PR does not fulfill all requirements
+@phase
 def verify_pr(org, repo, pr_number, issue_number, issue_miletsone, no_issue, no_milestone,
               ignore_actions, ignore_state, ignore_review):
-    pr_info = query_pr_info(org, repo, pr_number)
+    def _issue_info():
+        if no_issue or not issue_number:
+            return None
+        return query_issue_info(org, repo, issue_number)
+
+    pr_info, issue_info = run_parallel(
+        lambda: query_pr_info(org, repo, pr_number),
+        _issue_info)
 
     if not no_issue:
-        if issue_number:
-            issue_info = query_issue_info(org, repo, issue_number)
-        else:
+        if not issue_number:
             issue_info = pr_info
 
         if not issue_number and not pr_info['issue_link']:
@@ -788,22 +3227,21 @@ def verify_pr(org, repo, pr_number, issue_number, issue_miletsone, no_issue, no_
                   "use --ignore-review to proceed anyway")
 
 # checkout PR's branch
+@phase
 def checkout_pr(org, repo, pr_number):
     pr_info = query_pr_info(org, repo, pr_number)
 
     local_branch = os.path.basename(os.getcwd())
-    target_branch = pr_info['target_branch']
+
+    fetch_pr_commits(org, repo, pr_number)
 
     run_cmd([
-        'gh', 'pr', 'checkout',
-        '--repo', f'{org}/{repo}',
-        '-f',
-        '-b', local_branch,
-        pr_number,
+        'git', 'checkout', '-q', '-f', '-B', local_branch, pr_info['source_sha'],
         ])
 
 # update PR meta-data on github
 # (link issue to PR, set milestone of PR and issue, etc)
+@phase
 def update_pr_metadata(org, repo, pr_number, issue_number, issue_milestone,
                        no_issue, no_milestone):
     def _update_linked_issue():
@@ -823,12 +3261,7 @@ def update_pr_metadata(org, repo, pr_number, issue_number, issue_milestone,
 
         ask(f'Link to issue gh-{issue_number}?')
 
-        try:
-            response = json.loads(subprocess.run(
-                ['gh', 'api', f'/repos/{org}/{repo}/pulls/{pr_number}'],
-                capture_output=True, text=True, check=True).stdout)
-        except subprocess.CalledProcessError as e:
-            error(f'failed to retrieve pr info: {e.stderr.strip()}')
+        response = query_pr_node(org, repo, pr_number)
 
         body = '{}\n\n{}'.format(
             make_prefix(org, repo, (org, repo, issue_number)),
@@ -842,7 +3275,7 @@ def update_pr_metadata(org, repo, pr_number, issue_number, issue_milestone,
             ],
             input=body)
 
-        query_pr_info.cache_clear()
+        clear_pr_cache()
 
     def _update_linked_milestone():
         pr_info = query_pr_info(org, repo, pr_number)
@@ -877,7 +3310,7 @@ def update_pr_metadata(org, repo, pr_number, issue_number, issue_milestone,
                 ])
 
         query_issue_info.cache_clear()
-        query_pr_info.cache_clear()
+        clear_pr_cache()
 
     if not no_issue:
         _update_linked_issue()
@@ -885,20 +3318,99 @@ def update_pr_metadata(org, repo, pr_number, issue_number, issue_milestone,
         if not no_milestone:
             _update_linked_milestone()
 
-# fetch source and target commits
+# check if commit is present in local repo
+def has_commit(sha):
+    return git_object(f'{sha}^{{commit}}') is not None
+
+# check if ref exists in local repo
+def has_ref(ref):
+    return git_object(ref) is not None
+
+# find name of configured remote pointing to the same github repo as `url`,
+# no matter if it uses ssh or https
+def find_remote(url):
+    def _github_repo(url):
+        m = re.search(r'[:/]([^/:]+/[^/]+?)(\.git)?/?$', url)
+        return m.group(1).lower() if m else None
+
+    try:
+        output = subprocess.check_output(
+            ['git', 'config', '--get-regexp', r'^remote\..*\.url$'], text=True)
+    except subprocess.CalledProcessError:
+        return None
+
+    for line in output.splitlines():
+        key, _, remote_url = line.partition(' ')
+        if _github_repo(remote_url) == _github_repo(url):
+            return key[len('remote.'):-len('.url')]
+
+    return None
+
+# name of remote from which repo was partially cloned, if any
+def find_promisor_remote():
+    try:
+        return subprocess.check_output(
+            ['git', 'config', '--get', 'extensions.partialClone'], text=True).strip()
+    except subprocess.CalledProcessError:
+        return None
+
+# ensure that source and target commits are available locally
 def fetch_pr_commits(org, repo, pr_number):
-    pr_info = query_pr_info(org, repo, pr_number)
+    fetch_prs_commits(org, repo, [pr_number])
+
+# ensure that source and target commits of many prs are available locally
+# github exposes head of every pr, including prs from forks, as
+# refs/pull/N/head in target repo, so all commits are fetched from
+# target repo in one request; nothing is fetched if all are already here
+@phase
+def fetch_prs_commits(org, repo, pr_numbers):
+    pr_infos = run_parallel(
+        *[functools.partial(query_pr_info, org, repo, n) for n in pr_numbers])
+
+    wanted_shas = list(dict.fromkeys(
+        sha for info in pr_infos for sha in [info['source_sha'], info['target_sha']]))
+    if not DRY_RUN and all(has_commit(sha) for sha in wanted_shas):
+        return
 
-    run_cmd([
-        'git', 'fetch', pr_info['source_remote'], pr_info['source_sha']
-        ])
+    target_branches = list(dict.fromkeys(info['target_branch'] for info in pr_infos))
+
+    # fetching via configured remote (if any) keeps its url, credentials
+    # and partial clone filter
+    target_remote = pr_infos[0]['target_remote']
+    remote = find_remote(target_remote)
+
+    options = ['--no-tags']
+    if remote:
+        # negotiate only history of target branches, which is what we have
+        # in common with prs, instead of advertising every local ref
+        tips = [f'refs/remotes/{remote}/{branch}' for branch in target_branches]
+        tips = [tip for tip in tips if has_ref(tip)]
+        if tips:
+            if has_ref('HEAD'):
+                tips.append('HEAD')
+            options += [f'--negotiation-tip={tip}' for tip in tips]
+        if find_promisor_remote() == remote:
+            options += ['--filter=blob:none']
 
     run_cmd([
-        'git', 'fetch', pr_info['target_remote'], pr_info['target_sha']
+        'git', 'fetch', *options,
+        remote or target_remote,
+        *[f'refs/pull/{n}/head' for n in pr_numbers],
+        *[f'refs/heads/{branch}' for branch in target_branches],
         ])
 
+    if DRY_RUN:
+        return
+
+    # refs could move after pr info was queried
+    for sha in wanted_shas:
+        if not has_commit(sha):
+            error(f"commit {sha} not found after fetch\n"
+                  "pr or its target branch was updated, try again")
+
 # squash all commits in PR's local branch into one
 # invoked before rebase
+@phase
 def squash_pr_commits(org, repo, pr_number, title, no_issue):
     pr_info = query_pr_info(org, repo, pr_number)
 
@@ -933,6 +3445,7 @@ def squash_pr_commits(org, repo, pr_number, title, no_issue):
         ])
 
 # rebase PR's local branch on its target branch
+@phase
 def rebase_pr_commits(org, repo, pr_number):
     pr_info = query_pr_info(org, repo, pr_number)
 
@@ -944,32 +3457,77 @@ def rebase_pr_commits(org, repo, pr_number):
         'git', 'rebase', '--onto', pr_info['target_sha'], fork_point
         ])
 
+# rewrite messages of commits from `base` to HEAD in place
+# `reword_fn` gets and returns first line of message
+# history is piped through 'git fast-export' and 'git fast-import' without
+# file contents, so unlike filter-branch, trees are never checked out and
+# nothing is forked per commit; trees, authors and dates are preserved
+def rewrite_commit_messages(base, reword_fn):
+    export_cmd = [
+        'git', 'fast-export', '--no-data', '--reference-excluded-parents',
+        '--reencode=yes', '--signed-tags=strip', f'^{base}', 'HEAD',
+        ]
+    import_cmd = [
+        'git', 'fast-import', '--quiet', '--force',
+        ]
+
+    print_cmd(export_cmd + ['|'] + import_cmd)
+    if DRY_RUN:
+        return
+
+    branch = read_head_ref()
+    if not branch:
+        error("can't rewrite commits on detached head")
+    # fast-export names commits by refs given on command line, and
+    # fast-import would create literal 'HEAD' ref
+    export_cmd[-1] = branch
+
+    exporter = subprocess.Popen(export_cmd, stdout=subprocess.PIPE)
+    importer = subprocess.Popen(import_cmd, stdin=subprocess.PIPE)
+
+    src, dst = exporter.stdout, importer.stdin
+    in_commit = False
+    try:
+        while True:
+            line = src.readline()
+            if not line:
+                break
+            if line.startswith(b'commit '):
+                in_commit = True
+            elif line.startswith(b'data '):
+                data = src.read(int(line[len('data '):]))
+                if in_commit:
+                    message = data.decode(errors='surrogateescape')
+                    subject, sep, rest = message.partition('\n')
+                    message = reword_fn(subject) + sep + rest
+                    data = message.encode(errors='surrogateescape')
+                    in_commit = False
+                dst.write(b'data %d\n' % len(data))
+                dst.write(data)
+                continue
+            dst.write(line)
+        dst.close()
+    except BrokenPipeError:
+        pass
+
+    if exporter.wait() != 0 or importer.wait() != 0:
+        error('command failed')
+
 # add issue prefix to every commit in PR's local branch
 # invoked after rebase
+@phase
 def reword_pr_commits(org, repo, pr_number, title, no_issue):
     pr_info = query_pr_info(org, repo, pr_number)
 
-    if no_issue:
-        commit_prefix = ''
-    else:
-        commit_prefix = make_prefix(org, repo, pr_info['issue_link']) + ': '
+    issue_link = None
+    if not no_issue:
+        issue_link = pr_info['issue_link']
+        # fail before rewriting anything if there is no issue
+        make_prefix(org, repo, issue_link)
 
-    target_sha = pr_info['target_sha']
-
-    if title:
-        title = title.replace(r',', r'\,')
-        sed = f"sed -r"+\
-            f" -e '1s,^.*$,{commit_prefix}{title},'"
-    else:
-        sed = f"sed -r"+\
-          f" -e '1s,{make_prefix_regexp(org, repo)},{commit_prefix},I'"+\
-          f" -e '1s,{make_suffix_regexp(org, repo)},,I'"
-
-    run_cmd([
-        'git', 'filter-branch', '-f', '--msg-filter', sed,
-        f'{target_sha}..HEAD',
-        ],
-        env={'FILTER_BRANCH_SQUELCH_WARNING':'1'})
+    rewrite_commit_messages(
+        pr_info['target_sha'],
+        lambda subject: make_message(org, repo, issue_link, title or subject))
 
 # print commits from local PR's branch
 # invoked after rebase
@@ -984,6 +3542,7 @@ def print_pr_commits(org, repo, pr_number):
         ])
 
 # force-push PR's local branch to upstream
+@phase
 def force_push_pr(org, repo, pr_number):
     pr_info = query_pr_info(org, repo, pr_number)
 
@@ -991,13 +3550,23 @@ def force_push_pr(org, repo, pr_number):
     source_branch = pr_info['source_branch']
     source_remote = pr_info['source_remote']
 
+    head_sha = get_head_sha()
+
+    # push is retried only if it didn't reach remote; if it did, but
+    # response was lost, branch is already up to date
+    def done_fn(output):
+        return query_remote_sha(source_remote, source_branch) == head_sha
+
     run_cmd([
         'git', 'push', '-f',
         source_remote,
         f'{local_branch}:{source_branch}'
-        ])
+        ],
+        retry_fn=transient_error,
+        done_fn=done_fn)
 
 # tell github to remove draft status from pr
+@phase
 def undraft_pr(org, repo, pr_number):
     run_cmd([
         'gh', 'pr', 'ready',
@@ -1005,25 +3574,57 @@ def undraft_pr(org, repo, pr_number):
         pr_number,
     ])
 
-# tell github to merge PR
-def merge_pr(org, repo, pr_number):
-    # wait until PR is mereable
+# wait until github computes mergeability of PR after push
+# polls only PR itself, with conditional requests and growing interval, and
+# returns as soon as github reports pushed head and computed merge state
+@phase
+def wait_pr_mergeable(org, repo, pr_number, head_sha, timeout=120):
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+
     while True:
-        query_pr_info.cache_clear()
+        response = api_request('GET', f'/repos/{org}/{repo}/pulls/{pr_number}')
 
-        pr_info = query_pr_info(org, repo, pr_number)
-        if pr_info['pr_mergeable'] is not None \
-            and pr_info['pr_rebaseable'] is not None:
-            break
+        if response.ok():
+            pr = response.json()
+            if (not head_sha or pr['head']['sha'] == head_sha) and \
+               pr['mergeable'] is not None and pr['rebaseable'] is not None:
+                return
+        elif response.status and response.status < 500:
+            error(f'failed to retrieve pr info: {response.error_message()}')
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            error("timed out waiting until github computes pr mergeability")
 
-        time.sleep(0.1)
+        # when budget is low, poll no faster than it allows
+        profiled('wait', 'poll interval', time.sleep,
+                 min(remaining, max(delay * random.uniform(0.5, 1.0),
+                                    RATE_LIMITER.pacing())))
+        delay = min(delay * 1.5, 2)
 
-    # wait more
-    time.sleep(1)
+# check if github already merged PR, asking github and not memoized results
+def is_pr_merged(org, repo, pr_number):
+    response = api_request('GET', f'/repos/{org}/{repo}/pulls/{pr_number}')
+    return response.ok() and bool(response.json().get('merged'))
+
+# tell github to merge PR
+# `head_sha` is the commit we've just pushed to PR's branch
+@phase
+def merge_pr(org, repo, pr_number, head_sha):
+    # wait until PR is mergeable
+    wait_pr_mergeable(org, repo, pr_number, head_sha)
 
     def retry_fn(output):
-        return 'GraphQL: Base branch was modified' in output or \
-            'GraphQL: Pull Request is not mergeable' in output
+        if 'GraphQL: Base branch was modified' in output or \
+           'GraphQL: Pull Request is not mergeable' in output:
+            return True
+        return transient_error(output)
+
+    # merge isn't idempotent: if github applied it, but response was lost,
+    # repeated merge would fail, so pr state is checked before retrying
+    def done_fn(output):
+        return is_pr_merged(org, repo, pr_number)
 
     # tell to merge, retry if needed
     run_cmd([
@@ -1033,7 +3634,159 @@ def merge_pr(org, repo, pr_number):
         '--delete-branch',
         pr_number,
         ],
-        retry_fn=retry_fn)
+        retry_fn=retry_fn,
+        done_fn=done_fn)
+
+# checkout pr into current worktree, update its metadata, squash or rebase
+# it on target, then force-push and merge
+# returns local branch if pr was merged, or None if --no-push was given
+@phase
+def rebase_and_merge_pr(org, repo, pr_number, squash, title, issue_number,
+                        milestone_name, no_issue, no_milestone, ignore_state, no_push):
+    checkout_pr(org, repo, pr_number)
+    pr_ref = remember_ref()
+    # first update metadata, so that subsequent calls to query_xxx_info()
+    # will return correct values
+    update_pr_metadata(org, repo, pr_number, issue_number,
+                       milestone_name, no_issue, no_milestone)
+    # ensure that all commits we're going to manipulate are available locally
+    fetch_pr_commits(org, repo, pr_number)
+    if squash:
+        # if we're going to squash-merge, then squash commits before rebasing
+        # squash-merge may work even when rebase-merge produces conflicts
+        squash_pr_commits(org, repo, pr_number, title, no_issue)
+    # no matter if we do squash-merge or rebase-merge, rebase pr on target
+    rebase_pr_commits(org, repo, pr_number)
+    if not squash:
+        # if we're doing rebase-merge, we must preserve original commits,
+        # but ensure that each commit message has correct prefix
+        reword_pr_commits(org, repo, pr_number, title, no_issue)
+    # show edited history
+    print_pr_commits(org, repo, pr_number)
+    if no_push:
+        return None
+    ask('Force-push and merge?')
+    force_push_pr(org, repo, pr_number)
+    if ignore_state:
+        undraft_pr(org, repo, pr_number)
+    merge_pr(org, repo, pr_number, get_head_sha())
+    return pr_ref
+
+# parse merge_queue arguments like '123', '123:rebase' or '123:squash'
+# returns list of (pr_number, squash) tuples
+def parse_queue(specs, rebase, squash):
+    if rebase and squash:
+        error("--rebase and --squash are mutually exclusive")
+
+    queue = []
+    for spec in specs:
+        number, _, mode = spec.partition(':')
+        if not number.isdigit():
+            error(f"invalid pr: '{spec}'")
+        if not mode:
+            if not rebase and not squash:
+                error(f"merge mode not specified for pr #{number}\n"
+                      f"use {number}:rebase, {number}:squash, --rebase or --squash")
+            mode = 'squash' if squash else 'rebase'
+        if mode not in ['rebase', 'squash']:
+            error(f"invalid merge mode: '{spec}'")
+        queue.append((int(number), mode == 'squash'))
+
+    numbers = [n for n, _ in queue]
+    if len(set(numbers)) != len(numbers):
+        error("pr specified more than once")
+
+    return queue
+
+# merge many prs one after another, each on top of the previous one
+# all prs are verified concurrently before anything is changed, commits
+# of all prs are fetched at once, and one worktree is used for all merges;
+# stops on first failure, e.g. rebase conflict
+def merge_queue(org, repo, queue, milestone_name, no_issue, no_milestone,
+                ignore_actions, ignore_state, ignore_review, no_push, tmpfs):
+    global ASK
+
+    pr_numbers = [n for n, _ in queue]
+
+    nodes = fetch_pr_nodes(org, repo, pr_numbers)
+    for n in pr_numbers:
+        if not nodes[n]:
+            error(f"can't find pr #{n}")
+    for n, links in fetch_pr_links(org, repo, pr_numbers).items():
+        query_pr_links.cache_prime(links, org, repo, n)
+
+    def _verify(pr_number):
+        try:
+            verify_pr(org, repo, pr_number, None, milestone_name, no_issue, no_milestone,
+                      ignore_actions, ignore_state, ignore_review)
+            return True
+        except SystemExit:
+            print_error(f"pr #{pr_number} can't be merged")
+            return False
+
+    verified = run_parallel(*[functools.partial(_verify, n) for n in pr_numbers])
+    if not all(verified):
+        error(f"{verified.count(False)} of {len(queue)} prs failed verification,"
+              " nothing was merged")
+
+    for n, squash in queue:
+        pr_info = query_pr_info(org, repo, n)
+        print_text(f"#{n} {'squash' if squash else 'rebase'}: {pr_info['pr_title']}")
+
+    if not no_push:
+        ask(f'Merge {len(queue)} prs?')
+        # confirmed once for the whole queue
+        ASK = False
+
+    fetch_prs_commits(org, repo, pr_numbers)
+
+    done = []
+    failed = None
+    pr_ref = None
+    stacked_sha = None
+
+    orig_path = enter_worktree(tmpfs)
+    try:
+        for n, squash in queue:
+            if stacked_sha:
+                # without push, target branch doesn't move, so pr is rebased
+                # on local result of previous one instead
+                query_pr_info.cache_update(
+                    lambda args, pr_info: args[:3] == (org, repo, n) and
+                    'target_sha' in pr_info,
+                    lambda pr_info: {**pr_info, 'target_sha': stacked_sha})
+            try:
+                pr_ref = rebase_and_merge_pr(
+                    org, repo, n, squash, None, None, milestone_name,
+                    no_issue, no_milestone, ignore_state, no_push) or pr_ref
+            except SystemExit:
+                failed = n
+                break
+            done.append(n)
+            if no_push:
+                stacked_sha = get_head_sha()
+            else:
+                # target branch has moved, next pr must see its new state
+                clear_pr_cache()
+    finally:
+        leave_worktree(orig_path)
+
+    # like merge_pr, keep branch for inspection if something failed
+    if pr_ref and failed is None:
+        delete_ref(pr_ref)
+
+    for n, _ in queue:
+        if n in done:
+            state, color = ('ready' if no_push else 'merged'), Fore.GREEN
+        elif n == failed:
+            state, color = 'failed', Fore.RED
+        else:
+            state, color = 'skipped', Fore.YELLOW
+        print_kv(f'#{n}', state, color)
+
+    if failed is not None:
+        error(f"stopped at pr #{failed}, {len(done)} of {len(queue)} prs"
+              f" {'ready' if no_push else 'merged'}")
 
 COMMON_LABELS = [
     # category
@@ -1102,47 +3855,514 @@ OTHER_LABELS = [
     ('good first issue', '#a5f2ea', 'Task good for newcomers'),
 ]
 
-# create / update repo labels
-def sync_labels(org, repo):
+# print remaining budgets of github rate limits
+# /rate_limit request itself doesn't count against them
+def show_rate_limit():
+    response = api_call('rate limit', 'GET', '/rate_limit')
+
+    print_json({
+        name: {key: budget.get(key) for key in ['limit', 'remaining', 'used', 'reset']}
+        for name, budget in sorted(response['resources'].items())
+    })
+
+# repos listed in automation.yml
+def automation_repos():
     try:
-        response = json.loads(subprocess.run([
-            'gh', 'label', 'list', '--json', 'name,color,description',
-            '--limit', '999',
-            '--repo', f'{org}/{repo}',
-            ],
-            capture_output=True, text=True, check=True).stdout or '[]')
-    except subprocess.CalledProcessError as e:
-        error(f'failed to retrieve labels: {e.stderr.strip()}')
+        import yaml
+    except ImportError:
+        error("'pyyaml' is required to read automation.yml")
 
-    existing_labels = {label['name']: label for label in response}
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'automation.yml')
+    with open(path) as fp:
+        return list(yaml.safe_load(fp))
 
-    target_labels = COMMON_LABELS[:]
+# labels that should exist in repo
+def repo_labels(repo):
+    labels = COMMON_LABELS[:]
     if repo == 'roc-toolkit':
-        target_labels += TOOLKIT_LABELS
+        labels += TOOLKIT_LABELS
     else:
-        target_labels += OTHER_LABELS
+        labels += OTHER_LABELS
+    return labels
+
+# compare existing labels with desired ones
+# returns list of (mode, label, method, path, body) requests to send
+def plan_labels(org, repo):
+    response = api_call_pages('labels', f'/repos/{org}/{repo}/labels?per_page=100')
+
+    # github label names are case-insensitive
+    existing_labels = {label['name'].lower(): label for label in response}
+
+    ops = []
+    for label, color, description in repo_labels(repo):
+        body = {
+            'color': color.lstrip('#'),
+            'description': description,
+        }
+        existing = existing_labels.get(label.lower())
+        if not existing:
+            ops.append(('create', label,
+                        'POST', f'/repos/{org}/{repo}/labels',
+                        dict(body, name=label)))
+            continue
+        if existing['name'] == label and \
+           existing['color'].lower() == body['color'].lower() and \
+           (existing['description'] or '') == description:
+            continue
+        if existing['name'] != label:
+            body['new_name'] = label
+        ops.append(('edit', label,
+                    'PATCH', f'/repos/{org}/{repo}/labels/' +
+                        urllib.parse.quote(existing['name'], safe=''),
+                    body))
+
+    return ops
+
+# send one planned request
+# at most `semaphore` requests are sent concurrently; rate limit is
+# handled by api layer
+def apply_label_op(org, repo, op, semaphore):
+    mode, label, method, path, body = op
+
+    with semaphore:
+        response = api_request(method, path, body)
+
+    if not response.ok():
+        print_error(f"{org}/{repo}: can't {mode} label '{label}': "
+                    f"{response.error_message()}")
+        return False
+
+    return True
+
+# create / update labels in one or many repos
+# first, labels of all repos are read concurrently and changes are planned;
+# then, all changes are sent by bounded number of concurrent workers
+# repo that is in sync costs one request, usually answered with 304
+@phase
+def sync_labels(org, repos, jobs):
+    def _plan(repo):
+        try:
+            return plan_labels(org, repo)
+        except SystemExit:
+            return None
+
+    plans = run_parallel(*[functools.partial(_plan, repo) for repo in repos])
+
+    all_ops = []
+    for repo, ops in zip(repos, plans):
+        for op in ops or []:
+            mode, label, method, path, body = op
+            print_cmd([method, path, json.dumps(body)])
+            all_ops.append((repo, op))
+
+    results = []
+    if all_ops and not DRY_RUN:
+        semaphore = threading.BoundedSemaphore(jobs)
+        results = run_parallel(
+            *[functools.partial(apply_label_op, org, repo, op, semaphore)
+              for repo, op in all_ops])
+
+    failed = False
+    for repo, ops in zip(repos, plans):
+        if ops is None:
+            print_kv(f'{org}/{repo}', "can't read labels", Fore.RED)
+            failed = True
+            continue
+        if not ops:
+            print_kv(f'{org}/{repo}', 'in sync', Fore.GREEN)
+            continue
 
-    for label, color, description in target_labels:
-        if label in existing_labels:
-            if color == '#' + existing_labels[label]['color'] and \
-               description == existing_labels[label]['description']:
+        counts = {'create': 0, 'edit': 0, 'failed': 0}
+        for (op_repo, op), ok in itertools.zip_longest(all_ops, results):
+            if op_repo != repo:
                 continue
-            mode = 'edit'
+            if DRY_RUN or ok:
+                counts[op[0]] += 1
+            else:
+                counts['failed'] += 1
+
+        summary = f"{counts['create']} created, {counts['edit']} updated"
+        if DRY_RUN:
+            summary += ' (dry run)'
+        if counts['failed']:
+            summary += f", {counts['failed']} failed"
+            failed = True
+        print_kv(f'{org}/{repo}', summary,
+                 Fore.RED if counts['failed'] else Fore.YELLOW)
+
+    if failed:
+        sys.exit(1)
+
+# read-only commands that can be answered by 'rgh.py serve'
+SERVED_COMMANDS = {
+    'show_issue': lambda org, repo, args:
+        show_issue(org, repo, args.issue_number, args.json,
+                   args.snapshot if args.from_snapshot else None),
+    'show_pr': lambda org, repo, args:
+        show_pr(org, repo, args.pr_number, args.json,
+                args.snapshot if args.from_snapshot else None),
+    'show_issues': lambda org, repo, args:
+        show_issues(org, repo, parse_numbers(args.issue_numbers), args.chunk_size),
+    'show_prs': lambda org, repo, args:
+        show_prs(org, repo, parse_numbers(args.pr_numbers), args.chunk_size),
+    'wait_checks': lambda org, repo, args:
+        wait_checks(org, repo, args.pr_number, args.workflows, args.timeout, args.interval),
+}
+
+# output destination of request handled by current thread in 'serve' mode
+REQUEST = threading.local()
+
+# replaces sys.stdout and sys.stderr in 'serve' mode: writes go to buffer
+# of request handled by current thread, or to original stream otherwise
+class RequestStream:
+    def __init__(self, name, stream):
+        self.name = name
+        self.stream = stream
+
+    def _target(self):
+        return getattr(REQUEST, self.name, None) or self.stream
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    # output is formatted as if client's terminal was ours
+    def isatty(self):
+        if getattr(REQUEST, self.name, None) is not None:
+            return REQUEST.tty
+        return self.stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# wrap fn so that, when run by thread pool, it writes to output of request
+# that submitted it
+def inherit_request(fn):
+    stdout = getattr(REQUEST, 'stdout', None)
+    if stdout is None:
+        return fn
+    stderr, tty = REQUEST.stderr, REQUEST.tty
+
+    def wrapper():
+        REQUEST.stdout, REQUEST.stderr, REQUEST.tty = stdout, stderr, tty
+        try:
+            return fn()
+        finally:
+            REQUEST.stdout = REQUEST.stderr = None
+    return wrapper
+
+# run command line `argv` inside server and return its output and status
+def serve_request(argv, tty):
+    REQUEST.stdout, REQUEST.stderr, REQUEST.tty = io.StringIO(), io.StringIO(), tty
+    status = 0
+    try:
+        args = parser.parse_args(argv)
+        if args.command not in SERVED_COMMANDS:
+            error(f"command '{args.command}' can't be served")
+        org, repo = parse_repo(args.repo)
+        SERVED_COMMANDS[args.command](org, repo, args)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception as e:
+        print_error(f'{type(e).__name__}: {e}')
+        status = 1
+    response = {
+        'status': status,
+        'stdout': REQUEST.stdout.getvalue(),
+        'stderr': REQUEST.stderr.getvalue(),
+    }
+    REQUEST.stdout = REQUEST.stderr = None
+    return response
+
+# memoized queries that depend on fields changed by each pull request event,
+# keyed by event type sent by 'redispatch' function without 'pull_request_'
+# prefix; query_pr_node() holds everything fetched for pr, and query_pr_info()
+# is built from results of others, so both are listed everywhere
+PR_EVENT_QUERIES = {
+    # state and draft flag
+    'opened': [query_pr_node, query_pr_info],
+    'reopened': [query_pr_node, query_pr_info],
+    'closed': [query_pr_node, query_pr_info],
+    'ready_for_review': [query_pr_node, query_pr_info],
+    'converted_to_draft': [query_pr_node, query_pr_info],
+    # requested reviewers and review decision
+    'review_requested': [query_pr_node, query_pr_review, query_pr_info],
+    'review_request_removed': [query_pr_node, query_pr_review, query_pr_info],
+    'review_submitted': [query_pr_node, query_pr_review, query_pr_info],
+    'review_edited': [query_pr_node, query_pr_review, query_pr_info],
+    'review_dismissed': [query_pr_node, query_pr_review, query_pr_info],
+    # head sha; new commits also restart checks and may dismiss reviews
+    'synchronize': [query_pr_node, query_pr_review, query_pr_actions, query_pr_commits,
+                    query_pr_info],
+}
+
+# apply event from 'redispatch' function to memoized queries: labels are
+# patched in place, since event carries label name, and results depending
+# on other changed fields are dropped and refetched on next request
+# accepts repository_dispatch payload, as sent by 'redispatch' or as found
+# in $GITHUB_EVENT_PATH of dispatched workflow
+# returns list of (query, action, count) tuples
+def invalidate_caches(event):
+    event_type = event.get('event_type') or event.get('action')
+    payload = event.get('client_payload')
+    if not isinstance(event_type, str) or not isinstance(payload, dict) or \
+       not re.match(r'^[\w.-]+/[\w.-]+$', str(payload.get('repo'))):
+        raise ValueError('expected repository_dispatch payload with client_payload.repo')
+
+    org, repo = payload['repo'].split('/')
+    # json numbers from 'redispatch' are floats
+    number = int(payload['number']) if payload.get('number') is not None else None
+    label = payload.get('label')
+    branch = payload.get('ref')
+
+    actions = []
+
+    def _drop(fn, predicate):
+        n = fn.cache_discard(predicate)
+        if n:
+            actions.append((fn.__name__, 'dropped', n))
+
+    def _patch(fn, predicate, update):
+        n = fn.cache_update(predicate, update)
+        if n:
+            actions.append((fn.__name__, 'patched', n))
+
+    def _this_number(args, _):
+        return args[:3] == (org, repo, number)
+
+    def _this_repo(args, _):
+        return args[:2] == (org, repo)
+
+    # remotes are ssh urls of repos
+    def _this_remote(remote):
+        return bool(remote) and bool(re.search(
+            r'[:/]' + re.escape(f'{org}/{repo}') + r'(\.git)?$', remote))
+
+    def _linked_to_issue(_, pr_info):
+        return pr_info['issue_link'] == (org, repo, number)
+
+    def _relabel(names):
+        names = [name for name in names if name != label]
+        if event_type.endswith('_labeled'):
+            names.append(label)
+        return list(sorted(names))
+
+    pr_queries = [query_pr_node, query_pr_links, query_pr_info,
+                  query_pr_review, query_pr_actions, query_pr_commits, query_pr_author]
+
+    if event_type.endswith(('_labeled', '_unlabeled')) and number and label:
+        # number may belong to pr or issue; issue labels are also merged
+        # into info of prs linked to it
+        _patch(query_pr_node, _this_number, lambda node: {
+            **node,
+            'labels': {
+                **node['labels'],
+                'nodes': [{'name': name} for name in _relabel(
+                    [label_node['name'] for label_node in node['labels']['nodes']])],
+            },
+        })
+        _patch(query_pr_info, _this_number, lambda pr_info: {
+            **pr_info,
+            'pr_labels': _relabel(pr_info['pr_labels']),
+        })
+        _patch(query_issue_info, _this_number, lambda issue_info: {
+            **issue_info,
+            'issue_labels': _relabel(issue_info['issue_labels']),
+        })
+        _patch(query_pr_info, _linked_to_issue, lambda pr_info: {
+            **pr_info,
+            'issue_labels': _relabel(pr_info['issue_labels']),
+        })
+    elif event_type.startswith('pull_request_') and number and \
+         event_type[len('pull_request_'):] in PR_EVENT_QUERIES:
+        for fn in PR_EVENT_QUERIES[event_type[len('pull_request_'):]]:
+            _drop(fn, _this_number)
+    elif event_type in ['issue_opened', 'issue_reopened', 'issue_closed', 'push_tag']:
+        # nothing memoized depends on issue state or tags
+        pass
+    elif event_type == 'push_branch' and branch:
+        # new sha isn't in payload, so target sha of prs is refetched
+        _drop(query_remote_ref,
+              lambda args, _: args[1] == branch and _this_remote(args[0]))
+        _drop(query_pr_info,
+              lambda args, pr_info: _this_repo(args, pr_info) and
+              pr_info['target_branch'] == branch and _this_remote(pr_info['target_remote']))
+    elif number:
+        # unknown event, or labeled event without label name
+        for fn in pr_queries + [query_issue_info]:
+            _drop(fn, _this_number)
+        _drop(query_pr_info, _linked_to_issue)
+    else:
+        for fn in pr_queries + [query_issue_info]:
+            _drop(fn, _this_repo)
+        _drop(query_remote_ref, lambda args, _: _this_remote(args[0]))
+
+    return actions
+
+# run server answering read-only commands on unix socket; http connections,
+# auth state, memoized queries and caches stay warm between requests, and
+# memoized results are reused for `memo_ttl` seconds
+# protocol: client sends one json line {"argv": [...], "tty": bool}, server
+# replies with one json line {"status": N, "stdout": "...", "stderr": "..."}
+# client may also send {"event": {...}} with payload for invalidate_caches(),
+# server replies with {"status": 0, "actions": [[query, action, count], ...]}
+def serve(path, memo_ttl, idle_timeout):
+    global MEMO_TTL
+    import socket
+    import socketserver
+
+    MEMO_TTL = memo_ttl
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            error(f'server is already running on {path}')
+        except OSError:
+            os.unlink(path)
+        finally:
+            probe.close()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    last_active = [time.monotonic()]
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            last_active[0] = time.monotonic()
+            try:
+                request = json.loads(self.rfile.readline())
+                if 'event' in request:
+                    response = {'status': 0, 'actions': invalidate_caches(request['event'])}
+                else:
+                    response = serve_request(
+                        [str(arg) for arg in request['argv']], bool(request.get('tty')))
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'status': 1, 'stdout': '', 'stderr': f'bad request: {e}\n'}
+            try:
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+            except OSError:
+                # client went away
+                pass
+            last_active[0] = time.monotonic()
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    sys.stdout = RequestStream('stdout', sys.stdout)
+    sys.stderr = RequestStream('stderr', sys.stderr)
+
+    # token is used on behalf of clients, so only owner may connect
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    atexit.register(lambda: os.path.exists(path) and os.unlink(path))
+
+    if idle_timeout:
+        def _watchdog():
+            while time.monotonic() - last_active[0] < idle_timeout:
+                time.sleep(min(idle_timeout, 10))
+            print(f'no requests for {idle_timeout:.0f}s, exiting', file=sys.stderr)
+            server.shutdown()
+        threading.Thread(target=_watchdog, daemon=True).start()
+
+    # exit normally, so that socket is removed
+    import signal
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    print(f'serving on {path}', file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# if 'rgh.py serve' is running on `path`, let it execute command and exit
+# with its output and status; returns if server isn't available
+def forward_to_server(path, argv, repo):
+    import socket
+
+    if not repo:
+        # default repo depends on current directory of client
+        org, repo = parse_repo(None)
+        argv = argv + ['-R', f'{org}/{repo}']
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'argv': argv, 'tty': sys.stdout.isatty()}).encode() + b'\n')
+        with sock.makefile('rb') as fp:
+            response = json.loads(fp.readline())
+    except (OSError, ValueError):
+        # not running, or died while handling request; commands are
+        # read-only, so it's safe to run them locally
+        return
+    finally:
+        sock.close()
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    sys.exit(response['status'])
+
+# pass github event from file or stdin to 'rgh.py serve' running on `path`
+# and report which memoized queries it patched or dropped
+def send_event(path, event_path):
+    import socket
+
+    try:
+        if event_path == '-':
+            event = json.load(sys.stdin)
         else:
-            mode = 'create'
+            with open(event_path) as fp:
+                event = json.load(fp)
+    except (OSError, ValueError) as e:
+        error(f"can't read event: {e}")
 
-        run_cmd([
-            'gh', 'label', mode,
-            '--repo', f'{org}/{repo}',
-            label,
-            '--description', description,
-            '--color', color,
-            ])
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except OSError:
+            # queries are memoized only by server, so nothing can be stale
+            print_kv('server', f'not running on {path}', Fore.YELLOW)
+            return
+        sock.sendall(json.dumps({'event': event}).encode() + b'\n')
+        with sock.makefile('rb') as fp:
+            response = json.loads(fp.readline())
+    except (OSError, ValueError) as e:
+        error(f"can't send event to server: {e}")
+    finally:
+        sock.close()
+
+    if response['status'] != 0:
+        error(response['stderr'].strip())
+
+    if not response['actions']:
+        print_kv('caches', 'up to date', Fore.GREEN)
+    for query, action, n in response['actions']:
+        print_kv(query, f'{action} {n}', Fore.GREEN)
 
 parser = argparse.ArgumentParser(prog='rgh.py')
 
 common_parser = argparse.ArgumentParser(add_help=False)
 common_parser.add_argument('-R', '--repo', type=str, help='github repo')
+common_parser.add_argument('--api', choices=['auto', 'http', 'gh'], default='auto',
+                           help="use built-in http client or 'gh api' for github queries"
+                           " (default: http if token is available)")
+common_parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+                           help="don't use persistent caches of github responses and"
+                           " environment checks")
+common_parser.add_argument('--metrics', metavar='FILE', default=os.environ.get('RGH_METRICS'),
+                           help="write counters of requests, caches and subprocesses to"
+                           " FILE: prometheus textfile if it ends with .prom, otherwise"
+                           " append ndjson line (default: $RGH_METRICS)")
+common_parser.add_argument('--profile', metavar='FILE',
+                           help="write timings of commands, requests and phases to FILE"
+                           " in chrome trace format and print summary")
 
 subparsers = parser.add_subparsers(dest='command')
 
@@ -1152,6 +4372,10 @@ show_issue_parser = subparsers.add_parser(
 show_issue_parser.add_argument('issue_number', type=int)
 show_issue_parser.add_argument('--json', action='store_true', dest='json',
                             help="output in json format")
+show_issue_parser.add_argument('--from-snapshot', action='store_true', dest='from_snapshot',
+                            help="read issue from snapshot made by export_state, without network access")
+show_issue_parser.add_argument('--snapshot', metavar='FILE', default=SNAPSHOT_PATH,
+                            help="snapshot path (default: $RGH_SNAPSHOT or %(default)s)")
 
 show_pr_parser = subparsers.add_parser(
     'show_pr', parents=[common_parser],
@@ -1159,6 +4383,58 @@ show_pr_parser = subparsers.add_parser(
 show_pr_parser.add_argument('pr_number', type=int)
 show_pr_parser.add_argument('--json', action='store_true', dest='json',
                             help="output in json format")
+show_pr_parser.add_argument('--from-snapshot', action='store_true', dest='from_snapshot',
+                            help="read pull request from snapshot made by export_state, without network access")
+show_pr_parser.add_argument('--snapshot', metavar='FILE', default=SNAPSHOT_PATH,
+                            help="snapshot path (default: $RGH_SNAPSHOT or %(default)s)")
+
+show_issues_parser = subparsers.add_parser(
+    'show_issues', parents=[common_parser],
+    help="show info about multiple issues in ndjson format")
+show_issues_parser.add_argument('issue_numbers', nargs='+',
+                                help="issue numbers or ranges, e.g. 10 12-15")
+show_issues_parser.add_argument('--chunk-size', type=int, default=50, dest='chunk_size',
+                                help="number of issues fetched per query")
+
+show_prs_parser = subparsers.add_parser(
+    'show_prs', parents=[common_parser],
+    help="show info about multiple pull requests in ndjson format")
+show_prs_parser.add_argument('pr_numbers', nargs='+',
+                             help="pull request numbers or ranges, e.g. 10 12-15")
+show_prs_parser.add_argument('--chunk-size', type=int, default=20, dest='chunk_size',
+                             help="number of pull requests fetched per query")
+
+wait_checks_parser = subparsers.add_parser(
+    'wait_checks', parents=[common_parser],
+    help="wait until pull request workflows complete")
+wait_checks_parser.add_argument('pr_number', type=int)
+wait_checks_parser.add_argument('-w', '--workflow', action='append', dest='workflows',
+                                required=True, help="workflow name (may be repeated)")
+wait_checks_parser.add_argument('--timeout', type=float, default=3600,
+                                help="give up after this many seconds (default: 3600)")
+wait_checks_parser.add_argument('--interval', type=float, default=2,
+                                help="initial polling interval in seconds (default: 2)")
+
+index_refs_parser = subparsers.add_parser(
+    'index_refs', parents=[common_parser],
+    help="update local index of references between prs and issues")
+index_refs_parser.add_argument('--full', action='store_true',
+                               help="rebuild index from scratch")
+index_refs_parser.add_argument('--offline', action='store_true',
+                               help="don't update index, only query it")
+index_refs_parser.add_argument('--refs-to', type=int, dest='ref_number', metavar='NUMBER',
+                               help="print prs that reference given issue or pr")
+index_refs_parser.add_argument('--refs-from', type=int, dest='pr_number', metavar='NUMBER',
+                               help="print references from given pr")
+
+export_state_parser = subparsers.add_parser(
+    'export_state', parents=[common_parser],
+    help="save all open prs and issues to sqlite snapshot")
+export_state_parser.add_argument('--snapshot', metavar='FILE', default=SNAPSHOT_PATH,
+                                 help="snapshot path (default: $RGH_SNAPSHOT or %(default)s)")
+export_state_parser.add_argument('--page-size', type=int, default=25, dest='page_size',
+                                 help="number of prs or issues fetched per query"
+                                 " (default: %(default)s)")
 
 merge_pr_parser = subparsers.add_parser(
     'merge_pr', parents=[common_parser],
@@ -1186,36 +4462,161 @@ merge_pr_parser.add_argument('--ignore-review', action='store_true', dest='ignor
                              help="proceed even if pr has requested changes")
 merge_pr_parser.add_argument('--no-push', action='store_true', dest='no_push',
                              help="don't actually push and merge anything")
+merge_pr_parser.add_argument('--tmpfs', action='store_true', dest='tmpfs',
+                             help="keep worktree in /dev/shm instead of $RGH_WORKTREE_DIR or /tmp")
 merge_pr_parser.add_argument('-y', '--yes', action='store_true', dest='yes',
                              help="don't ask for confirmation, always assume yes")
 merge_pr_parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run',
                              help="don't actually run commands, just print them")
 
+merge_queue_parser = subparsers.add_parser(
+    'merge_queue', parents=[common_parser],
+    help="merge many pull requests one after another")
+merge_queue_parser.add_argument('prs', nargs='+', metavar='pr',
+                                help="pr number, optionally with mode: 123:rebase or 123:squash")
+merge_queue_parser.add_argument('--rebase', action='store_true',
+                                help='merge prs without mode using rebase')
+merge_queue_parser.add_argument('--squash', action='store_true',
+                                help='merge prs without mode using squash')
+merge_queue_parser.add_argument('--no-issue', action='store_true', dest='no_issue',
+                                help="don't link issues")
+merge_queue_parser.add_argument('-m', '--milestone', type=str, dest='milestone_name',
+                                help="overwrite issue milestone")
+merge_queue_parser.add_argument('-M', '--no-milestone', action='store_true', dest='no_milestone',
+                                help="don't set issue milestone")
+merge_queue_parser.add_argument('--ignore-actions', action='store_true', dest='ignore_actions',
+                                help="proceed even if pr github actions are failed")
+merge_queue_parser.add_argument('--ignore-state', action='store_true', dest='ignore_state',
+                                help="proceed even if pr is closed or draft")
+merge_queue_parser.add_argument('--ignore-review', action='store_true', dest='ignore_review',
+                                help="proceed even if pr has requested changes")
+merge_queue_parser.add_argument('--no-push', action='store_true', dest='no_push',
+                                help="don't actually push and merge anything; each pr is"
+                                " rebased on local result of previous one, and worktree"
+                                " branch is kept with result of the whole queue")
+merge_queue_parser.add_argument('--tmpfs', action='store_true', dest='tmpfs',
+                                help="keep worktree in /dev/shm instead of $RGH_WORKTREE_DIR or /tmp")
+merge_queue_parser.add_argument('-y', '--yes', action='store_true', dest='yes',
+                                help="don't ask for confirmation, always assume yes")
+merge_queue_parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run',
+                                help="don't actually run commands, just print them")
+
+rate_limit_parser = subparsers.add_parser(
+    'rate_limit', parents=[common_parser],
+    help="show remaining github rate limit budgets")
+
+serve_parser = subparsers.add_parser(
+    'serve', parents=[common_parser],
+    help="answer show_xxx and wait_checks requests from other invocations,"
+    " keeping connections and caches warm")
+serve_parser.add_argument('--socket', default=SERVE_SOCKET,
+                          help="unix socket path (default: $RGH_SOCKET or %(default)s)")
+serve_parser.add_argument('--memo-ttl', type=float, default=10, dest='memo_ttl',
+                          help="seconds during which repeated queries are answered"
+                          " from memory, 'inf' to keep them until they're invalidated"
+                          " by 'rgh.py invalidate' (default: %(default)s)")
+serve_parser.add_argument('--idle-timeout', type=float, default=3600, dest='idle_timeout',
+                          help="exit after this many seconds without requests,"
+                          " 0 to run forever (default: %(default)s)")
+
+invalidate_parser = subparsers.add_parser(
+    'invalidate',
+    help="apply github event dispatched by 'redispatch' function to memoized"
+    " queries of 'rgh.py serve'")
+invalidate_parser.add_argument('event_path', metavar='EVENT_FILE', nargs='?',
+                               default=os.environ.get('GITHUB_EVENT_PATH', '-'),
+                               help="json payload of repository_dispatch event, '-' for"
+                               " stdin (default: $GITHUB_EVENT_PATH or stdin)")
+invalidate_parser.add_argument('--socket', default=SERVE_SOCKET,
+                               help="unix socket path (default: $RGH_SOCKET or %(default)s)")
+
 sync_labels_parser = subparsers.add_parser(
     'sync_labels', parents=[common_parser],
     help="create or update repo labels")
+sync_labels_parser.add_argument('--all', action='store_true', dest='all',
+                                 help="sync all repos listed in automation.yml")
+sync_labels_parser.add_argument('-j', '--jobs', type=int, default=4,
+                                 help="max number of concurrent requests (default: %(default)s)")
 sync_labels_parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run',
                                  help="don't actually run commands, just print them")
 
 args = parser.parse_args()
 
+# without subcommand, args has no common options
+if not args.command:
+    parser.print_help()
+    sys.exit(1)
+
+if getattr(args, 'profile', None):
+    enable_profiler(args.profile)
+
+if getattr(args, 'metrics', None):
+    enable_metrics(args.metrics, args.command)
+
+# commands are forwarded to server only if they don't need per-invocation
+# settings that server can't apply
+if args.command in SERVED_COMMANDS and os.environ.get('RGH_SOCKET') and \
+   args.api == 'auto' and not args.no_cache and not args.profile and not args.metrics and \
+   not getattr(args, 'from_snapshot', False):
+    forward_to_server(os.environ['RGH_SOCKET'], sys.argv[1:], args.repo)
+
 if hasattr(args, 'dry_run'):
     DRY_RUN = args.dry_run
 
 if hasattr(args, 'yes'):
     ASK = not args.yes
 
-colorama.init()
-check_tools()
+if hasattr(args, 'no_cache') and args.no_cache:
+    HTTP_CACHE = None
+    AUTHOR_CACHE = None
+    STATE_CACHE = None
+    GIT_CACHE = None
+    REFS_INDEX = None
 
-org, repo = parse_repo(args.repo)
+if args.command != 'serve':
+    # output of served commands goes to clients
+    setup_colors()
 
-if args.command == 'show_issue':
-    show_issue(org, repo, args.issue_number, args.json)
+if args.command == 'invalidate':
+    send_event(args.socket, args.event_path)
     sys.exit(0)
 
-if args.command == 'show_pr':
-    show_pr(org, repo, args.pr_number, args.json)
+# snapshot is read without network access, so api isn't set up
+if getattr(args, 'from_snapshot', False):
+    org, repo = parse_repo(args.repo)
+    SERVED_COMMANDS[args.command](org, repo, args)
+    sys.exit(0)
+
+setup_api(args.api)
+check_tools(need_gh=args.command in ['merge_pr', 'merge_queue'])
+
+if args.command == 'rate_limit':
+    show_rate_limit()
+    sys.exit(0)
+
+if args.command == 'serve':
+    serve(args.socket, args.memo_ttl, args.idle_timeout)
+    sys.exit(0)
+
+if args.command == 'sync_labels' and args.all:
+    # repos in automation.yml belong to default org
+    org, repo = 'roc-streaming', None
+else:
+    org, repo = parse_repo(args.repo)
+
+if METRICS is not None:
+    METRICS.repo = f'{org}/{repo}' if repo else org
+
+if args.command in SERVED_COMMANDS:
+    SERVED_COMMANDS[args.command](org, repo, args)
+    sys.exit(0)
+
+if args.command == 'export_state':
+    export_state(org, repo, args.snapshot, args.page_size)
+    sys.exit(0)
+
+if args.command == 'index_refs':
+    index_refs(org, repo, args.full, args.offline, args.ref_number, args.pr_number)
     sys.exit(0)
 
 if args.command == 'merge_pr':
@@ -1224,45 +4625,29 @@ if args.command == 'merge_pr':
     verify_pr(org, repo, args.pr_number, args.issue_number,
               args.milestone_name, args.no_issue, args.no_milestone,
               args.ignore_actions, args.ignore_state, args.ignore_review)
-    # create new worktree in /tmp, where we'll checkout pr's branch
-    orig_path = enter_worktree()
-    merged = False
+    # acquire worktree from pool, where we'll checkout pr's branch
+    orig_path = enter_worktree(args.tmpfs)
+    pr_ref = None
     try:
-        checkout_pr(org, repo, args.pr_number)
-        pr_ref = remember_ref()
-        # first update metadata, so that subsequent calls to query_xxx_info()
-        # will return correct values
-        update_pr_metadata(org, repo, args.pr_number, args.issue_number,
-                           args.milestone_name, args.no_issue, args.no_milestone)
-        # ensure that all commits we're going to manipulate are available locally
-        fetch_pr_commits(org, repo, args.pr_number)
-        if args.squash:
-            # if we're going to squash-merge, then squash commits before rebasing
-            # squash-merge may work even when rebase-merge produces conflicts
-            squash_pr_commits(org, repo, args.pr_number, args.title, args.no_issue)
-        # no matter if we do squash-merge or rebase-merge, rebase pr on target
-        rebase_pr_commits(org, repo, args.pr_number)
-        if args.rebase:
-            # if we're doing rebase-merge, we must preserve original commits,
-            # but ensure that each commit message has correct prefix
-            reword_pr_commits(org, repo, args.pr_number, args.title, args.no_issue)
-        # show edited history
-        print_pr_commits(org, repo, args.pr_number)
-        if not args.no_push:
-            ask('Force-push and merge?')
-            force_push_pr(org, repo, args.pr_number)
-            if args.ignore_state:
-                undraft_pr(org, repo, args.pr_number)
-            merge_pr(org, repo, args.pr_number)
-            merged = True
+        pr_ref = rebase_and_merge_pr(
+            org, repo, args.pr_number, args.squash, args.title, args.issue_number,
+            args.milestone_name, args.no_issue, args.no_milestone,
+            args.ignore_state, args.no_push)
     finally:
-        # remove worktree in /tmp
+        # return worktree to pool
         leave_worktree(orig_path)
-        if merged:
+        if pr_ref:
             # delete temp branch (only on success)
             delete_ref(pr_ref)
     sys.exit(0)
 
+if args.command == 'merge_queue':
+    merge_queue(org, repo, parse_queue(args.prs, args.rebase, args.squash),
+                args.milestone_name, args.no_issue, args.no_milestone,
+                args.ignore_actions, args.ignore_state, args.ignore_review,
+                args.no_push, args.tmpfs)
+    sys.exit(0)
+
 if args.command == 'sync_labels':
-    sync_labels(org, repo)
+    sync_labels(org, automation_repos() if args.all else [repo], args.jobs)
     sys.exit(0)